@@ -0,0 +1,142 @@
+"""
+Concurrency vs. time-to-first-token for the async streaming engine.
+
+The provider is replaced by an in-process httpx transport that streams SSE chunks
+after a fixed latency, so the numbers only reflect our own overhead:
+
+    python -m bench.async_engine --sessions 1 10 100 500
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from chat_utils.engine import stream_text
+
+
+def sse_chunks(tokens: int) -> list[bytes]:
+    """
+    Build the SSE body of a streamed completion
+    :param tokens: Number of content chunks
+    :return: List of encoded SSE events
+    """
+    events = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}]
+        }
+        events.append(f"data: {json.dumps(chunk)}\n\n".encode())
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def run_async(sessions: int, latency: float, tokens: int, gap: float) -> list[float]:
+    events = sse_chunks(tokens)
+
+    async def body():
+        await asyncio.sleep(latency)
+        for event in events:
+            yield event
+            await asyncio.sleep(gap)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+    client = AsyncOpenAI(
+        api_key="bench",
+        base_url="http://bench.local/v1",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+
+    async def session() -> float:
+        start = time.perf_counter()
+        ttft = None
+        async for _ in stream_text(client, "bench", [{"role": "user", "content": "hi"}]):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+        return ttft
+
+    results = await asyncio.gather(*[session() for _ in range(sessions)])
+    await client.close()
+    return list(results)
+
+
+def run_threads(sessions: int, latency: float, tokens: int, gap: float, threads: int) -> list[float]:
+    events = sse_chunks(tokens)
+
+    def body():
+        time.sleep(latency)
+        for event in events:
+            yield event
+            time.sleep(gap)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body())
+
+    client = OpenAI(
+        api_key="bench",
+        base_url="http://bench.local/v1",
+        http_client=httpx.Client(transport=httpx.MockTransport(handler))
+    )
+
+    def session(submitted: float) -> float:
+        response = client.chat.completions.create(
+            model="bench",
+            messages=[{"role": "user", "content": "hi"}],
+            stream=True
+        )
+        ttft = None
+        for chunk in response:
+            if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+                ttft = time.perf_counter() - submitted
+        return ttft
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        submitted = time.perf_counter()
+        results = list(pool.map(session, [submitted] * sessions))
+    client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--latency", type=float, default=0.2, help="Provider latency before the first chunk, s")
+    parser.add_argument("--tokens", type=int, default=50, help="Chunks per reply")
+    parser.add_argument("--gap", type=float, default=0.01, help="Gap between chunks, s")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="Also run the sync client on a thread pool of this size as a baseline")
+    args = parser.parse_args()
+
+    print(f"{'engine':<12}{'sessions':>10}{'p50 ttft ms':>14}{'p99 ttft ms':>14}{'wall s':>10}")
+    for sessions in args.sessions:
+        start = time.perf_counter()
+        ttft = asyncio.run(run_async(sessions, args.latency, args.tokens, args.gap))
+        wall = time.perf_counter() - start
+        print(f"{'async':<12}{sessions:>10}{statistics.median(ttft) * 1000:>14.1f}"
+              f"{percentile(ttft, 0.99) * 1000:>14.1f}{wall:>10.2f}")
+
+        if args.threads:
+            start = time.perf_counter()
+            ttft = run_threads(sessions, args.latency, args.tokens, args.gap, args.threads)
+            wall = time.perf_counter() - start
+            print(f"{f'sync x{args.threads}':<12}{sessions:>10}{statistics.median(ttft) * 1000:>14.1f}"
+                  f"{percentile(ttft, 0.99) * 1000:>14.1f}{wall:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
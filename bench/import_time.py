@@ -0,0 +1,102 @@
+"""
+Cold-start import time of the chat_utils modules the apps load, measured with `python -X importtime`.
+
+Each module is imported in a fresh interpreter after the preloaded modules (panel by default), so its time
+is what chat_utils adds on top of the framework every `panel serve` worker and autoreload pays anyway.
+The run fails when a module exceeds the budget or pulls in a dependency that should load on first use.
+
+    python -m bench.import_time
+    python -m bench.import_time --budget-ms 200 --forbid llama_index openai httpx
+"""
+import argparse
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+MODULES = (
+    "chat_utils.core",
+    "chat_utils.session",
+    "chat_utils.engine",
+    "chat_utils.response_cache",
+    "chat_utils.context",
+    "chat_utils.render",
+    "chat_utils.tool_registry",
+)
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_times(module: str, preload: List[str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """
+    Import a module in a fresh interpreter
+    :param module: Module to import
+    :param preload: Modules imported before it, their time is not counted
+    :return: cumulative microseconds of the module and of every module it imported, and self microseconds
+    """
+    code = "".join(f"import {name}; " for name in preload + [module])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    cumulative, own = {}, {}
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        name = match.group(4)
+        # a module is reported after everything it imported, forget what the preloaded modules brought in
+        if name in preload:
+            cumulative.clear()
+            own.clear()
+            continue
+        cumulative[name] = int(match.group(2))
+        own[name] = int(match.group(1))
+    return cumulative, own
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=list(MODULES))
+    parser.add_argument("--preload", nargs="*", default=["panel"],
+                        help="Modules imported first and not counted, the framework cost")
+    parser.add_argument("--forbid", nargs="*", default=["llama_index", "openai", "httpx"],
+                        help="Top-level packages that must not be imported at startup")
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="Maximum import time of one module")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module, the fastest one is reported")
+    parser.add_argument("--top", type=int, default=5, help="Heaviest imports listed per module")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':<28}{'ms':>10}  heaviest imports")
+    for module in args.modules:
+        try:
+            runs = [import_times(module, args.preload) for _ in range(args.repeat)]
+        except RuntimeError as error:
+            print(f"{module:<28}{'error':>10}  {error}")
+            failures.append(module)
+            continue
+        cumulative, own = min(runs, key=lambda run: run[0].get(module, 0))
+        total = cumulative.get(module, 0) / 1000
+
+        heaviest = sorted((name for name in own if name != module), key=own.get, reverse=True)[:args.top]
+        print(f"{module:<28}{total:>10.1f}  " + ", ".join(f"{name} {own[name] / 1000:.1f}" for name in heaviest))
+
+        loaded = sorted({name.split(".")[0] for name in cumulative} & set(args.forbid))
+        if loaded:
+            print(f"{'':<28}{'':>10}  imports {', '.join(loaded)} at startup")
+            failures.append(module)
+        if total > args.budget_ms:
+            print(f"{'':<28}{'':>10}  over the {args.budget_ms:.0f} ms budget")
+            failures.append(module)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Local stand-in for a key-value server with versioned compare-and-set writes, the protocol of
+chat_utils.store.HttpKeyValueClient, to run KeyValueChatStore without a real cluster.
+
+    python -m bench.kv_server --port 8900
+    CHAT_STORE=http://127.0.0.1:8900 panel serve chat-contexts.py --num-procs 4
+
+Values are kept in memory and lost when the server stops.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class KeyValueServer:
+    """
+    Threaded HTTP server keeping versioned values in memory.
+    Use as a context manager or call start() and stop().
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param host: Interface to listen on
+        :param port: Port, 0 to pick a free one
+        """
+        # key -> (version, JSON text), versions are never reused, even after a delete
+        self.data: Dict[str, Tuple[int, str]] = {}
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, without this every reply waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, body: bytes = b"", version: Optional[int] = None):
+                self.send_response(status)
+                if version is not None:
+                    self.send_header("etag", f'"{version}"')
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def key(self) -> Optional[str]:
+                path = urlparse(self.path).path
+                return unquote(path[len("/kv/"):]) if path.startswith("/kv/") else None
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/kv":
+                    prefix = parse_qs(url.query).get("prefix", [""])[0]
+                    with server._lock:
+                        items = [
+                            {"key": key, "value": json.loads(value), "version": version}
+                            for key, (version, value) in server.data.items() if key.startswith(prefix)
+                        ]
+                    self.reply(200, json.dumps({"items": items}).encode())
+                    return
+                with server._lock:
+                    entry = server.data.get(self.key())
+                if entry is None:
+                    self.reply(404)
+                else:
+                    self.reply(200, entry[1].encode(), entry[0])
+
+            def do_PUT(self):
+                key = self.key()
+                value = self.rfile.read(int(self.headers.get("content-length", 0))).decode()
+                expected = self.headers.get("if-match")
+                with server._lock:
+                    current = server.data.get(key)
+                    if self.headers.get("if-none-match") == "*" and current is not None:
+                        self.reply(412)
+                        return
+                    if expected is not None and (current is None or f'"{current[0]}"' != expected):
+                        self.reply(412)
+                        return
+                    version = next(server._versions)
+                    server.data[key] = (version, value)
+                self.reply(200, b"", version)
+
+            def do_DELETE(self):
+                with server._lock:
+                    server.data.pop(self.key(), None)
+                self.reply(204)
+
+        class Server(ThreadingHTTPServer):
+            # every worker process of every node connects to it
+            request_queue_size = 1024
+
+        self._httpd = Server((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "KeyValueServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _serve(host: str, port: int, urls):
+    server = KeyValueServer(host, port)
+    urls.put(server.url)
+    server._httpd.serve_forever()
+
+
+def start_kv_server_process(host: str = "127.0.0.1", port: int = 0):
+    """
+    Run a KeyValueServer in a child process
+    :param host: Interface to listen on
+    :param port: Port, 0 to pick a free one
+    :return: (process, url), terminate the process when done
+    """
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(host, port, urls), daemon=True)
+    process.start()
+    return process, urls.get(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    args = parser.parse_args()
+
+    server = KeyValueServer(args.host, args.port)
+    print(f"Serving on {server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
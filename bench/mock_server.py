@@ -0,0 +1,268 @@
+"""
+Local stand-in for an OpenAI compatible API, streaming /v1/chat/completions over SSE.
+
+    python -m bench.mock_server --port 8800 --latency 0.2 --token-rate 200
+
+Point a client at http://127.0.0.1:8800/v1 with any API key.
+"""
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+
+@dataclass
+class MockServerConfig:
+    # seconds before the first chunk
+    latency: float = 0.1
+    # completion tokens per reply
+    tokens: int = 100
+    # tokens per content chunk
+    chunk_tokens: int = 1
+    # tokens per second, 0 for as fast as possible
+    token_rate: float = 500.0
+    # tool calls returned when the request offers tools and the last message is from the user,
+    # ex.: [{"name": "get_current_weather", "arguments": {"location": "Paris"}}]
+    tool_calls: List[Dict] = field(default_factory=list)
+    # HTTP status returned instead of a completion, ex.: 429 or 503, None for normal replies
+    status: Optional[int] = None
+
+
+class MockServer:
+    """
+    Threaded HTTP server speaking the streamed chat.completions protocol.
+    Use as a context manager or call start() and stop().
+    """
+
+    def __init__(self, config: MockServerConfig = None, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param config: Reply settings, can be changed while the server runs
+        :param host: Interface to listen on
+        :param port: Port, 0 to pick a free one
+        """
+        self.config = config or MockServerConfig()
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("content-length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                body = json.dumps({"object": "list", "data": [{"id": "mock", "object": "model"}]}).encode()
+                self.send_response(200)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                server.requests += 1
+                server.handle(self, request)
+
+        class Server(ThreadingHTTPServer):
+            # many benchmark sessions connect at once
+            request_queue_size = 1024
+
+        self._httpd = Server((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, handler: BaseHTTPRequestHandler, request: Dict):
+        config = self.config
+
+        if config.status is not None:
+            body = json.dumps({"error": {"message": "mock error", "type": "mock", "code": config.status}}).encode()
+            handler.send_response(config.status)
+            handler.send_header("content-type", "application/json")
+            handler.send_header("content-length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+
+        messages = request.get("messages", [])
+
+        if not request.get("stream"):
+            # plain completion, ex.: the background summaries of chat_utils.summary
+            time.sleep(config.latency)
+            prompt_tokens = sum(len(str(m.get("content") or "")) // 4 + 4 for m in messages)
+            body = json.dumps({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(f" tok{i}" for i in range(config.tokens))},
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": config.tokens,
+                    "total_tokens": prompt_tokens + config.tokens
+                }
+            }).encode()
+            handler.send_response(200)
+            handler.send_header("content-type", "application/json")
+            handler.send_header("content-length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+
+        handler.send_response(200)
+        handler.send_header("content-type", "text/event-stream")
+        handler.send_header("transfer-encoding", "chunked")
+        handler.end_headers()
+
+        def send(data: str):
+            payload = f"data: {data}\n\n".encode()
+            handler.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            handler.wfile.flush()
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> str:
+            return json.dumps({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            })
+
+        time.sleep(config.latency)
+
+        try:
+            if request.get("tools") and config.tool_calls and messages and messages[-1].get("role") == "user":
+                for index, call in enumerate(config.tool_calls):
+                    send(chunk({"tool_calls": [{
+                        "index": index,
+                        "id": f"call_{index}",
+                        "type": "function",
+                        "function": {"name": call["name"], "arguments": ""}
+                    }]}))
+                    arguments = json.dumps(call.get("arguments", {}))
+                    for start in range(0, len(arguments), 8):
+                        send(chunk({"tool_calls": [{
+                            "index": index,
+                            "function": {"arguments": arguments[start:start + 8]}
+                        }]}))
+                send(chunk({}, "tool_calls"))
+            else:
+                send(chunk({"role": "assistant", "content": ""}))
+                delay = config.chunk_tokens / config.token_rate if config.token_rate else 0
+                for start in range(0, config.tokens, config.chunk_tokens):
+                    count = min(config.chunk_tokens, config.tokens - start)
+                    send(chunk({"content": "".join(f" tok{start + i}" for i in range(count))}))
+                    if delay:
+                        time.sleep(delay)
+                send(chunk({}, "stop"))
+
+            if (request.get("stream_options") or {}).get("include_usage"):
+                prompt_tokens = sum(len(str(m.get("content") or "")) // 4 + 4 for m in messages)
+                send(json.dumps({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": config.tokens,
+                        "total_tokens": prompt_tokens + config.tokens
+                    }
+                }))
+
+            send("[DONE]")
+            handler.wfile.write(b"0\r\n\r\n")
+            handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away mid-stream
+            pass
+
+
+def _serve(config: MockServerConfig, host: str, port: int, urls):
+    server = MockServer(config, host, port)
+    urls.put(server.url)
+    server._httpd.serve_forever()
+
+
+def start_mock_server_process(config: MockServerConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """
+    Run a MockServer in a child process, so its CPU time is not counted by the benchmark
+    :param config: Reply settings
+    :param host: Interface to listen on
+    :param port: Port, 0 to pick a free one
+    :return: (process, url), terminate the process when done
+    """
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(config or MockServerConfig(), host, port, urls), daemon=True)
+    process.start()
+    return process, urls.get(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--token-rate", type=float, default=500.0)
+    parser.add_argument("--tool-call", action="append", default=[], metavar="NAME:JSON",
+                        help="Tool call to return when tools are offered, ex.: get_current_weather:'{\"location\": \"Paris\"}'")
+    args = parser.parse_args()
+
+    tool_calls = []
+    for value in args.tool_call:
+        name, _, arguments = value.partition(":")
+        tool_calls.append({"name": name, "arguments": json.loads(arguments or "{}")})
+
+    config = MockServerConfig(
+        latency=args.latency,
+        tokens=args.tokens,
+        chunk_tokens=args.chunk_tokens,
+        token_rate=args.token_rate,
+        tool_calls=tool_calls
+    )
+    server = MockServer(config, args.host, args.port)
+    print(f"Serving on {server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Offline benchmarks of the apps and chat_utils against the local mock server.
+
+    python -m bench.scenarios                      # everything
+    python -m bench.scenarios apps sessions        # some scenarios
+    python -m bench.scenarios --tokens 500 --token-rate 0
+
+Reported numbers:
+  apps         time-to-first-token, tokens/s delivered to the UI, UI updates and CPU per token
+               for the get_response generator of every app
+  sessions     p50/p99 time-to-first-token, delivered tokens/s and memory per session for
+               concurrent sessions sharing one pooled client
+  persistence  turns/s of save_jsonl rewrites against ChatJournal appends, and the time of
+               load_chat_from_file for long chats
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.mock_server import MockServerConfig, start_mock_server_process
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APPS = [
+    "chat-single-model.py",
+    "chat-model-switcher.py",
+    "chat-contexts.py",
+    "chat-single-model-with-tools.py",
+]
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def load_app(file_name: str):
+    """
+    Import an app script as a module, the way `panel serve` runs it for a session
+    :param file_name:
+    :return: module
+    """
+    name = "bench_" + file_name.replace("-", "_").removesuffix(".py")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def drive(get_response, instance, prompt: str) -> dict:
+    """
+    Run one turn of a get_response callback and time what reaches the UI
+    :return: timings of the turn
+    """
+    start = time.perf_counter()
+    cpu = time.process_time()
+    first = last = None
+    updates = 0
+    async for _ in get_response(prompt, "You", instance):
+        last = time.perf_counter()
+        if first is None:
+            first = last
+        updates += 1
+    return {
+        "ttft": (first or time.perf_counter()) - start,
+        "stream": (last or start) - (first or start),
+        "updates": updates,
+        "cpu": time.process_time() - cpu
+    }
+
+
+def run_apps(args, url: str):
+    from chat_utils.engine import client_registry
+
+    client_registry.base_url_override = url
+
+    print(f"\n{'app':<34}{'ttft ms':>10}{'tok/s':>10}{'updates':>9}{'cpu us/tok':>12}")
+    for file_name in APPS:
+        try:
+            app = load_app(file_name)
+        except ImportError as e:
+            print(f"{file_name:<34}skipped: {e}")
+            continue
+
+        async def turns():
+            results = []
+            for turn in range(args.turns):
+                results.append(await drive(app.get_response, app.chat_interface, f"bench question {turn} {time.time()}"))
+            return results
+
+        results = asyncio.run(turns())
+        stream = sum(r["stream"] for r in results)
+        tokens = args.tokens * len(results)
+        print(f"{file_name:<34}{statistics.median(r['ttft'] for r in results) * 1000:>10.1f}"
+              f"{tokens / stream if stream else float('inf'):>10.0f}"
+              f"{statistics.median(r['updates'] for r in results):>9.0f}"
+              f"{sum(r['cpu'] for r in results) / tokens * 1e6:>12.1f}")
+
+
+def run_sessions(args, url: str):
+    from chat_utils.context import ContextWindow
+    from chat_utils.engine import ClientRegistry, stream_text
+    from chat_utils.render import StreamRenderer
+
+    registry = ClientRegistry(max_connections=max(args.sessions), max_keepalive_connections=max(args.sessions))
+    registry.base_url_override = url
+    context_window = ContextWindow()
+
+    async def session(turn: int) -> dict:
+        chat_memory = [{"role": "user", "content": f"bench session {turn}"}]
+        renderer = StreamRenderer()
+        start = time.perf_counter()
+        first = None
+        async for _ in renderer.render(stream_text(registry.get("groq"), "mock", context_window.select(chat_memory, 8192))):
+            if first is None:
+                first = time.perf_counter()
+        chat_memory.append({"role": "assistant", "content": renderer.value})
+        return {"ttft": first - start, "end": time.perf_counter() - start, "memory": chat_memory}
+
+    async def run(count: int):
+        start = time.perf_counter()
+        results = await asyncio.gather(*[session(i) for i in range(count)])
+        return results, time.perf_counter() - start
+
+    async def run_all():
+        # warm up imports and the connection pool outside of the measurements
+        await run(1)
+
+        print(f"\n{'sessions':>8}{'p50 ttft ms':>13}{'p99 ttft ms':>13}{'tok/s':>10}{'KiB/session':>13}")
+        for count in args.sessions:
+            results, wall = await run(count)
+            # tracemalloc slows everything down, so memory is measured on a separate run
+            tracemalloc.start()
+            await run(count)
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            ttft = [r["ttft"] for r in results]
+            print(f"{count:>8}{statistics.median(ttft) * 1000:>13.1f}{percentile(ttft, 0.99) * 1000:>13.1f}"
+                  f"{args.tokens * count / wall:>10.0f}{memory / count / 1024:>13.1f}")
+
+        await registry.close()
+
+    asyncio.run(run_all())
+
+
+def run_persistence(args):
+    from chat_utils.fs import ChatJournal, save_jsonl
+
+    message = {"role": "assistant", "content": "lorem ipsum dolor sit amet " * 20}
+
+    print(f"\n{'writer':<14}{'turns':>8}{'turns/s':>12}{'MiB written':>13}")
+    with tempfile.TemporaryDirectory() as folder:
+        for turns in args.history:
+            history = []
+            path = os.path.join(folder, f"rewrite_{turns}.jsonl")
+            written = 0
+            start = time.perf_counter()
+            for _ in range(turns):
+                history.append(message)
+                save_jsonl(path, history)
+                written += os.path.getsize(path)
+            elapsed = time.perf_counter() - start
+            print(f"{'save_jsonl':<14}{turns:>8}{turns / elapsed:>12.0f}{written / 2 ** 20:>13.1f}")
+
+            history = []
+            journal = ChatJournal(os.path.join(folder, f"journal_{turns}.jsonl"))
+            start = time.perf_counter()
+            for _ in range(turns):
+                history.append(message)
+                journal.extend(history)
+            journal.close()
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(journal.file_path)
+            print(f"{'ChatJournal':<14}{turns:>8}{turns / elapsed:>12.0f}{size / 2 ** 20:>13.1f}")
+
+        try:
+            from panel.chat import ChatInterface
+            from chat_utils.core import load_chat_from_file
+        except ImportError as e:
+            print(f"\nload_chat_from_file skipped: {e}")
+            return
+
+        print(f"\n{'messages':>8}{'load_chat_from_file ms':>25}")
+        for turns in args.history:
+            path = os.path.join(folder, f"journal_{turns}.jsonl")
+            chat_instance = ChatInterface()
+            start = time.perf_counter()
+            load_chat_from_file(chat_context={}, path=path, chat_instance=chat_instance)
+            print(f"{turns:>8}{(time.perf_counter() - start) * 1000:>25.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", default=["apps", "sessions", "persistence"])
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock provider latency, s")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens per reply")
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--token-rate", type=float, default=1000.0, help="Tokens/s, 0 for unthrottled")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per app")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--history", type=int, nargs="+", default=[100, 1000], help="Chat lengths for persistence")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    config = MockServerConfig(
+        latency=args.latency,
+        tokens=args.tokens,
+        chunk_tokens=args.chunk_tokens,
+        token_rate=args.token_rate,
+        tool_calls=[
+            {"name": "get_current_weather", "arguments": {"location": "Paris"}},
+            {"name": "get_product_details", "arguments": {"product_id": "SKU-12345"}}
+        ]
+    )
+
+    process, url = start_mock_server_process(config)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if "apps" in args.scenarios:
+            run_apps(args, url)
+        if "sessions" in args.scenarios:
+            run_sessions(args, url)
+        if "persistence" in args.scenarios:
+            run_persistence(args)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        print(json.dumps({"mock_server": url, "workdir": workdir}))
+
+
+if __name__ == "__main__":
+    main()
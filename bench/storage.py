@@ -0,0 +1,62 @@
+"""
+Size, full-load and tail-load time of the jsonl and compressed (.chatz) chat formats.
+
+    python -m bench.storage --messages 200 2000 20000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from chat_utils.fs import ChatJournal, CompressedChatJournal
+
+WORDS = ("the model context token stream reply user assistant chat history panel server request "
+         "latency provider answer question product weather email python function tool result").split()
+
+
+def make_chat(messages: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 200)))
+        }
+        for i in range(messages)
+    ]
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[200, 2000, 20000])
+    parser.add_argument("--tail", type=int, default=50, help="Messages read by the tail load")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'format':<8}{'messages':>10}{'size KiB':>12}{'full ms':>10}{'tail ms':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for messages in args.messages:
+            chat = make_chat(messages)
+            for name, journal_class in (("jsonl", ChatJournal), ("chatz", CompressedChatJournal)):
+                path = os.path.join(folder, f"chat_{messages}.{name}")
+                journal_class(path).compact(chat)
+                # build the line index once, as the first load_chat_from_file would
+                journal_class(path).load_tail(args.tail)
+
+                full = timed(lambda: journal_class(path).load(), args.repeat)
+                tail = timed(lambda: journal_class(path).load_tail(args.tail), args.repeat)
+                print(f"{name:<8}{messages:>10}{os.path.getsize(path) / 1024:>12.1f}"
+                      f"{full * 1000:>10.2f}{tail * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
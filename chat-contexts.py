@@ -1,24 +1,49 @@
-import os
-
 import panel as pn
-from openai import OpenAI, Stream
-from openai.types.chat import ChatCompletionChunk
-from openai.types.chat.chat_completion_chunk import Choice
 from panel.chat import ChatInterface
 
-from chat_utils.core import get_timestamp, get_models, get_list_of_chats, create_chat_button, \
-    load_chat_from_file, AVATAR_SYSTEM, AVATAR_BOT, AVATAR_USER, start_new_chat
-from chat_utils.fs import prepare_folders, save_jsonl
+from chat_utils.cancellation import cancel_turn, finish_turn, start_turn
+from chat_utils.catalog import get_chat_id, new_chat_id
+from chat_utils.core import get_models, create_chat_button, \
+    load_chat_from_file, save_chat_memory, AVATAR_SYSTEM, AVATAR_BOT, AVATAR_USER, start_new_chat
+from chat_utils.context import ContextWindow, count_tokens
+from chat_utils.engine import client_registry
+from chat_utils.fs import prepare_folders
+from chat_utils.metrics import TurnMetrics, start_metrics_server
+from chat_utils.render import StreamRenderer
+from chat_utils.response_cache import response_cache
+from chat_utils.routing import provider_router
+from chat_utils.scheduler import request_scheduler
+from chat_utils.search import get_search_index
+from chat_utils.session import create_chat_context, get_session_context, get_session_id
+from chat_utils.store import get_chat_store
+from chat_utils.summary import summarizer
+from chat_utils.vector_memory import format_memories, get_vector_memory
 
 # https://panel.holoviz.org/
 pn.extension()
 
 prepare_folders(["chats"])
 
-current_context = {
-    "chat_memory": [],
-    "chat_memory_file": f"chats/chat_memory_{get_timestamp()}.jsonl"
-}
+# Messages of all saved chats, for retrieval; chats saved before it existed are added in the background,
+# once per process, panel serve runs this script again for every session
+vector_memory = get_vector_memory("chats")
+vector_memory.start_backfill()
+
+# Full-text index of all saved chats for the search box, kept up to date as messages are saved
+search_index = get_search_index("chats")
+search_index.start_backfill()
+
+# Prometheus metrics on http://localhost:9464/metrics, see METRICS_PORT
+start_metrics_server()
+
+
+def create_context():
+    return create_chat_context(
+        chat_memory_file=f"chats/{new_chat_id()}.jsonl",
+        provider="groq",
+        base_url="https://api.groq.com/openai/v1"
+    )
+
 
 sidebar_selector = pn.widgets.Select(
     name="Model",
@@ -35,17 +60,43 @@ sidebar_keep_memory = pn.widgets.Checkbox(
 # sidebar_list_of_chats = pn.Column(pn.pane.Markdown("### History"))
 sidebar_list_of_chats = pn.Column(width_policy='max')
 
-client = OpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
+# Number of saved chats added to the sidebar at a time
+CHATS_PAGE_SIZE = 50
+
+chat_store = get_chat_store("chats")
+
+history_page = {
+    "last": None
+}
+
+sidebar_load_more = pn.widgets.Button(
+    name="Load more",
+    button_type='light',
+    width_policy='max'
+)
+
+# Number of search results shown in the sidebar
+SEARCH_RESULTS = 10
+
+sidebar_search = pn.widgets.TextInput(
+    placeholder="Search chats...",
+    width_policy='max'
 )
 
+sidebar_search_results = pn.Column(width_policy='max')
+
 model = "llama3-8b-8192"
 
+context_window = ContextWindow()
+
 
 def model_selected(event):
+    current_context = get_session_context(create_context)
+
     if not sidebar_keep_memory.value:
         current_context["chat_memory"] = []
+        current_context["summary"] = None
+        current_context["unrendered"] = 0
 
     selected_model = sidebar_selector.value
 
@@ -58,50 +109,98 @@ def model_selected(event):
         user='System',
         respond=False
     )
-    if selected_model["provider"] == "groq":
-        client.base_url = selected_model["base_url"]
-        client.api_key = os.getenv("GROQ_API_KEY")
-
-    if selected_model["provider"] == "openai":
-        client.base_url = selected_model["base_url"]
-        client.api_key = os.getenv("OPENAI_API_KEY")
+    # Each provider has one pooled client, connect now so the first request skips the handshake
+    current_context["client"] = client_registry.get(
+        provider=selected_model["provider"],
+        base_url=selected_model["base_url"]
+    )
+    client_registry.prewarm(
+        provider=selected_model["provider"],
+        base_url=selected_model["base_url"]
+    )
 
 
 sidebar_selector.param.watch(model_selected, "value")
 
 
-def get_response(user_input: str, user, instance: ChatInterface):
-    current_context["chat_memory"].append({"role": "user", "content": user_input})
+async def get_response(user_input: str, user, instance: ChatInterface):
+    current_context = get_session_context(create_context)
 
-    response: Stream[ChatCompletionChunk] = client.chat.completions.create(
-        model=sidebar_selector.value["model"],
-        messages=current_context["chat_memory"],
-        stream=True,
-        #tool_choice='auto'
-    )
+    # A new message stops the reply still streaming, its partial text is saved
+    cancel_turn(current_context, "new message")
+
+    async with current_context["lock"]:
+        turn = start_turn(current_context)
+        # Hold on to this turn's history, a new chat started meanwhile gets its own
+        chat_memory = current_context["chat_memory"]
+        chat_journal = current_context["chat_journal"]
+        chat_memory.append({"role": "user", "content": user_input})
 
-    replies = ""
+        selected_model = sidebar_selector.value
+        # Quote related messages of other chats and of this chat's turns that are no longer in memory
+        recalled = format_memories(vector_memory.search(
+            user_input,
+            exclude_chat=get_chat_id(chat_journal.file_path),
+            exclude_from=chat_journal.base
+        ))
+        history = summarizer.messages(current_context)
+        # Send the summary of the older turns and the newest messages that fit the model's context window
+        messages = context_window.select(
+            [recalled, *history] if recalled else history,
+            selected_model["context_window"]
+        )
 
-    try:
-        for chunk in response:
-            if chunk.choices:
-                choice: Choice = chunk.choices[0]
-                text = choice.delta.content
-                if text:
-                    replies += text
+        renderer = StreamRenderer()
+        metrics = TurnMetrics(selected_model["provider"], selected_model["model"])
+
+        try:
+            # A cached reply is replayed at once, only a miss is queued and sent
+            deltas = response_cache.cached(selected_model["model"], messages, metrics)
+            if deltas is None:
+                # Wait for the model's rate limits instead of failing with a 429, showing the place in the queue
+                async for position in request_scheduler.queue(
+                        selected_model,
+                        context_window.count(messages),
+                        get_session_id()
+                ):
+                    yield {
+                        "avatar": AVATAR_BOT,
+                        "user": "Assistant",
+                        "object": f"_Waiting for `{selected_model['model']}`, position {position} in the queue..._"
+                    }
+                deltas = response_cache.fetch(
+                    current_context["client"],
+                    selected_model["model"],
+                    messages,
+                    metrics,
+                    # hedge with the equivalent model of the other provider when this one is slow or failing
+                    stream=provider_router.stream_text
+                )
+            async for replies in renderer.render(turn.iterate(deltas)):
                 yield {
                     "avatar": AVATAR_BOT,
                     "user": "Assistant",
                     "object": replies
                 }
-            if 'end' in chunk and chunk.end:
-                break  # Exit the loop if the stream is marked as ended
-    finally:
-        # Append the collected replies as a single entry to the chat history
-        if replies:  # Ensure we do not add empty responses
-            current_context["chat_memory"].append({"role": "assistant", "content": replies})
-        response.close()  # Ensure the stream is properly closed after processing
-        save_jsonl(current_context["chat_memory_file"], current_context["chat_memory"])
+            if turn.cancelled:
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": f"{renderer.value}\n\n_Stopped: {turn.reason}_"
+                }
+        finally:
+            replies = renderer.value
+            # Append the collected replies as a single entry to the chat history
+            if replies:  # Ensure we do not add empty responses
+                chat_memory.append({"role": "assistant", "content": replies})
+            # Only the records added by this turn are written
+            chat_journal.metadata["model"] = selected_model["model"]
+            with metrics.saving():
+                await save_chat_memory(current_context, chat_journal, chat_memory)
+            metrics.finish(prompt_tokens=context_window.count(messages), completion_tokens=count_tokens(replies))
+            # Fold older turns into the summary in the background once the history grows long
+            summarizer.schedule(current_context)
+            finish_turn(current_context, turn)
 
 
 chat_interface = ChatInterface(
@@ -125,7 +224,7 @@ ui = pn.template.FastListTemplate(
             button_type='primary',
             width_policy='max',
             on_click=lambda event: start_new_chat(
-                chat_context=current_context,
+                chat_context=get_session_context(create_context),
                 chat_instance=chat_interface,
                 list_of_chats=sidebar_list_of_chats
             )
@@ -133,29 +232,80 @@ ui = pn.template.FastListTemplate(
         pn.pane.Markdown("### Model"),
         sidebar_selector,
         sidebar_keep_memory,
+        pn.pane.Markdown("### Search"),
+        sidebar_search,
+        sidebar_search_results,
         pn.pane.Markdown("### History"),
-        sidebar_list_of_chats
+        sidebar_list_of_chats,
+        sidebar_load_more
     ],
     main=[chat_interface]
 )
 
-chat_files = get_list_of_chats("chats")
-for chat in chat_files:
-    chat_button = create_chat_button(
-        label=chat,
-        list_of_chats=sidebar_list_of_chats,
-        click_action=lambda event: load_chat_from_file(
-            chat_context=current_context,
-            path=f"chats/{event.obj.name}.jsonl",
-            chat_instance=chat_interface)
-    )
-    sidebar_list_of_chats.append(chat_button)
+
+def load_more_chats(event=None):
+    """
+    Add the next page of saved chats from the store to the sidebar
+    """
+    chats = chat_store.page(limit=CHATS_PAGE_SIZE, after=history_page["last"])
+    shown = {button.name for button in sidebar_list_of_chats.objects}
+
+    for chat in chats:
+        if chat["id"] in shown:
+            continue
+        chat_button = create_chat_button(
+            label=chat["id"],
+            description=chat["title"],
+            list_of_chats=sidebar_list_of_chats,
+            click_action=lambda event: load_chat_from_file(
+                chat_context=get_session_context(create_context),
+                path=chat_store.path(event.obj.name),
+                chat_instance=chat_interface)
+        )
+        sidebar_list_of_chats.append(chat_button)
+
+    if chats:
+        history_page["last"] = chats[-1]
+    sidebar_load_more.visible = len(chats) == CHATS_PAGE_SIZE
+
+
+sidebar_load_more.on_click(load_more_chats)
+load_more_chats()
+
+
+def search_chats(event):
+    """
+    Show the saved messages matching the search box, each opens its chat at that message
+    """
+    results = []
+    for hit in search_index.search(event.new, limit=SEARCH_RESULTS):
+        chat = chat_store.get(hit["chat"]) or {}
+        open_button = pn.widgets.Button(
+            name=chat.get("title") or hit["chat"],
+            description=hit["chat"],
+            button_type='light',
+            width_policy='max'
+        )
+        open_button.on_click(lambda event, hit=hit: load_chat_from_file(
+            chat_context=get_session_context(create_context),
+            path=chat_store.path(hit["chat"]),
+            chat_instance=chat_interface,
+            position=hit["position"])
+        )
+        results.append(open_button)
+        results.append(pn.pane.Markdown(f"_{hit['role']}_: {hit['snippet']}", width_policy='max'))
+    # replace the previous results in a single update
+    sidebar_search_results.objects = results
+
+
+# Search as the user types, every keystroke is a query of a few milliseconds
+sidebar_search.param.watch(search_chats, "value_input")
 
 if __name__ == "__main__":
     chat_interface.show()
 else:
     start_new_chat(
-        chat_context=current_context,
+        chat_context=get_session_context(create_context),
         chat_instance=chat_interface,
         list_of_chats=sidebar_list_of_chats
     )
@@ -1,25 +1,48 @@
-import os
+import asyncio
 
 import panel as pn
-from openai import OpenAI, Stream
-from openai.types.chat import ChatCompletionChunk
-from openai.types.chat.chat_completion_chunk import Choice
 from panel.chat import ChatInterface
 
-from chat_utils.core import get_timestamp, get_models
-from chat_utils.fs import prepare_folders, save_jsonl
+from chat_utils.cancellation import cancel_turn, finish_turn, start_turn
+from chat_utils.catalog import get_chat_id, new_chat_id
+from chat_utils.core import get_models, save_chat_memory
+from chat_utils.context import ContextWindow, count_tokens
+from chat_utils.engine import client_registry
+from chat_utils.fs import prepare_folders
+from chat_utils.metrics import TurnMetrics, start_metrics_server
+from chat_utils.render import StreamRenderer
+from chat_utils.response_cache import response_cache
+from chat_utils.routing import provider_router
+from chat_utils.scheduler import request_scheduler
+from chat_utils.session import create_chat_context, get_session_context, get_session_id
+from chat_utils.summary import summarizer
+from chat_utils.vector_memory import format_memories, get_vector_memory
 
 # https://panel.holoviz.org/
 pn.extension()
 
 prepare_folders(["chats"])
 
+# Messages of all saved chats, for retrieval; chats saved before it existed are added in the background,
+# once per process, panel serve runs this script again for every session
+vector_memory = get_vector_memory("chats")
+vector_memory.start_backfill()
+
+# Prometheus metrics on http://localhost:9464/metrics, see METRICS_PORT
+start_metrics_server()
+
 AVATAR_USER = "https://api.iconify.design/carbon:user.svg"
 AVATAR_BOT = "https://api.iconify.design/carbon:chat-bot.svg"
 AVATAR_SYSTEM = "https://api.iconify.design/carbon:ibm-event-automation.svg"
 
-chat_memory = []
-chat_memory_file = f"chats/chat_memory_{get_timestamp()}.jsonl"
+
+def create_context():
+    return create_chat_context(
+        chat_memory_file=f"chats/{new_chat_id()}.jsonl",
+        provider="groq",
+        base_url="https://api.groq.com/openai/v1"
+    )
+
 
 sidebar_selector = pn.widgets.Select(
     name="Model",
@@ -27,23 +50,30 @@ sidebar_selector = pn.widgets.Select(
     options=get_models()
 )
 
+sidebar_compare = pn.widgets.MultiChoice(
+    name="Compare models",
+    description="Send each message to all of these models at once, then continue with the reply you pick",
+    options=get_models()
+)
+
 sidebar_keep_memory = pn.widgets.Checkbox(
     name="Keep memory on model switch",
     value=True,
 )
 
-client = OpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
-
 model = "llama3-8b-8192"
 
+context_window = ContextWindow()
+
 
 def model_selected(event):
+    context = get_session_context(create_context)
+
     if not sidebar_keep_memory.value:
-        global chat_memory
-        chat_memory = []
+        discard_branches(context)
+        context["chat_memory"] = []
+        context["summary"] = None
+        context["unrendered"] = 0
 
     selected_model = sidebar_selector.value
 
@@ -56,49 +86,246 @@ def model_selected(event):
         user='System',
         respond=False
     )
-    if selected_model["provider"] == "groq":
-        client.base_url = selected_model["base_url"]
-        client.api_key = os.getenv("GROQ_API_KEY")
-
-    if selected_model["provider"] == "openai":
-        client.base_url = selected_model["base_url"]
-        client.api_key = os.getenv("OPENAI_API_KEY")
+    # Each provider has one pooled client, connect now so the first request skips the handshake
+    context["client"] = client_registry.get(
+        provider=selected_model["provider"],
+        base_url=selected_model["base_url"]
+    )
+    client_registry.prewarm(
+        provider=selected_model["provider"],
+        base_url=selected_model["base_url"]
+    )
 
 
 sidebar_selector.param.watch(model_selected, "value")
 
 
-def get_response(user_input: str, user, instance: ChatInterface):
-    chat_memory.append({"role": "user", "content": user_input})
+def format_readout(metrics: TurnMetrics, replies: str) -> str:
+    """
+    Get the time to first token and the streaming speed of a reply
+    :param metrics: Metrics of the reply
+    :param replies: Text received so far
+    :return: Markdown
+    """
+    if metrics.first_chunk is None:
+        return ""
+    tokens = metrics.completion_tokens if metrics.completion_tokens is not None else count_tokens(replies)
+    streaming = metrics.last_chunk - metrics.first_chunk
+    speed = f"{tokens / streaming:.0f} tokens/s" if streaming > 0 else "- tokens/s"
+    cached = " · cached" if metrics.cached else ""
+    return f"_TTFT {metrics.first_chunk - metrics.started:.2f}s · {speed} · {tokens} tokens{cached}_"
 
-    response: Stream[ChatCompletionChunk] = client.chat.completions.create(
-        model=sidebar_selector.value["model"],
-        messages=chat_memory,
-        stream=True
-    )
 
-    replies = ""
+async def choose_branch(context, index: int = None):
+    """
+    Continue the chat with one reply of a comparison, saving it as the assistant's answer
+    :param context: Chat context with pending branches
+    :param index: Position of the reply, None for the one that finished first
+    :return: None
+    """
+    branches = context.get("branches")
+    if branches is None:
+        return
+    context["branches"] = None
+    if index is None:
+        index = branches["finished"][0]
+    details, replies = branches["replies"][index]
+    for position, button in enumerate(branches["buttons"]):
+        button.disabled = True
+        if position == index:
+            button.name = "Chosen"
 
+    context["chat_memory"].append({"role": "assistant", "content": replies})
+    context["chat_journal"].metadata["model"] = details["model"]
+    await save_chat_memory(context, context["chat_journal"], context["chat_memory"])
+    summarizer.schedule(context)
+
+
+def discard_branches(context):
+    """
+    Drop the replies of a comparison nobody chose, ex.: when the memory is cleared
+    :param context:
+    :return: None
+    """
+    branches = context.get("branches")
+    if branches is not None:
+        context["branches"] = None
+        for button in branches["buttons"]:
+            button.disabled = True
+
+
+async def stream_branch(context, turn, details: dict, history: list, reply: pn.pane.Markdown,
+                        readout: pn.pane.Markdown) -> str:
+    """
+    Stream the reply of one model of a comparison into its pane
+    :return: the reply, partial if the model failed or the turn was stopped
+    """
+    messages = context_window.select(history, details["context_window"])
+    renderer = StreamRenderer()
+    metrics = TurnMetrics(details["provider"], details["model"])
     try:
-        for chunk in response:
-            if chunk.choices:
-                choice: Choice = chunk.choices[0]
-                text = choice.delta.content
-                if text:
-                    replies += text
+        deltas = response_cache.cached(details["model"], messages, metrics)
+        if deltas is None:
+            async for position in request_scheduler.queue(details, context_window.count(messages), get_session_id()):
+                reply.object = f"_Waiting, position {position} in the queue..._"
+            deltas = response_cache.fetch(
+                client_registry.get(details["provider"], details["base_url"]),
+                details["model"],
+                messages,
+                metrics
+            )  # no fallback, the comparison is about this model
+        async for replies in renderer.render(turn.iterate(deltas)):
+            reply.object = replies
+            readout.object = format_readout(metrics, replies)
+    except Exception as error:
+        # one failing model does not stop the others
+        reply.object = f"{renderer.value}\n\n_Failed: {error}_"
+    finally:
+        metrics.finish(prompt_tokens=context_window.count(messages), completion_tokens=count_tokens(renderer.value))
+    readout.object = format_readout(metrics, renderer.value)
+    return renderer.value
+
+
+async def compare_models(context, turn, models: list, history: list):
+    """
+    Send the same history to several models at once, each reply streams into its own pane with a button
+    to continue the chat with it. The comparison takes as long as the slowest model.
+    :param context: Chat context
+    :param turn: CancelToken of the turn, stops every model
+    :param models: Details of the models, as in get_models()
+    :param history: Messages before the selection for each model's context window
+    :return: Async iterator of the panel to show
+    """
+    replies = [pn.pane.Markdown("", sizing_mode="stretch_width") for _ in models]
+    readouts = [pn.pane.Markdown("") for _ in models]
+    buttons = [pn.widgets.Button(name="Continue with this reply", disabled=True) for _ in models]
+    yield pn.Row(*[
+        pn.Column(f"**{details['model']}**", reply, readout, button, sizing_mode="stretch_width")
+        for details, reply, readout, button in zip(models, replies, readouts, buttons)
+    ], sizing_mode="stretch_width")
+
+    finished = []
+
+    async def run(index: int) -> str:
+        result = await stream_branch(context, turn, models[index], history, replies[index], readouts[index])
+        if result:
+            finished.append(index)
+        return result
+
+    results = await asyncio.gather(*[run(index) for index in range(len(models))])
+    if turn.cancelled:
+        for reply in replies:
+            reply.object = f"{reply.object}\n\n_Stopped: {turn.reason}_"
+    if not finished:
+        return
+    context["branches"] = {
+        "replies": list(zip(models, results)),
+        "buttons": buttons,
+        "finished": finished
+    }
+    for index, button in enumerate(buttons):
+        if results[index]:
+            button.disabled = False
+
+            async def choose(event, index=index):
+                await choose_branch(context, index)
+
+            button.on_click(choose)
+
+
+async def get_response(user_input: str, user, instance: ChatInterface):
+    context = get_session_context(create_context)
+
+    # A new message stops the reply still streaming, its partial text is saved
+    cancel_turn(context, "new message")
+
+    async with context["lock"]:
+        turn = start_turn(context)
+        # A reply of the last comparison nobody chose, the one that finished first continues the chat
+        await choose_branch(context)
+        chat_memory = context["chat_memory"]
+        chat_memory.append({"role": "user", "content": user_input})
+
+        selected_model = sidebar_selector.value
+        # Quote related messages of other chats and of this chat's turns that are no longer in memory
+        recalled = format_memories(vector_memory.search(
+            user_input,
+            exclude_chat=get_chat_id(context["chat_journal"].file_path),
+            exclude_from=context["chat_journal"].base
+        ))
+        history = summarizer.messages(context)
+        if recalled:
+            history = [recalled, *history]
+
+        compared = list({details["model"]: details for details in sidebar_compare.value}.values())
+        if len(compared) > 1:
+            try:
+                async for layout in compare_models(context, turn, compared, history):
+                    yield {
+                        "avatar": AVATAR_BOT,
+                        "user": "Assistant",
+                        "object": layout
+                    }
+            finally:
+                # the user's message is saved now, the reply once it is chosen
+                await save_chat_memory(context, context["chat_journal"], chat_memory)
+                finish_turn(context, turn)
+            return
+
+        # Send the summary of the older turns and the newest messages that fit the model's context window
+        messages = context_window.select(history, selected_model["context_window"])
+
+        renderer = StreamRenderer()
+        metrics = TurnMetrics(selected_model["provider"], selected_model["model"])
+
+        try:
+            # A cached reply is replayed at once, only a miss is queued and sent
+            deltas = response_cache.cached(selected_model["model"], messages, metrics)
+            if deltas is None:
+                # Wait for the model's rate limits instead of failing with a 429, showing the place in the queue
+                async for position in request_scheduler.queue(
+                        selected_model,
+                        context_window.count(messages),
+                        get_session_id()
+                ):
+                    yield {
+                        "avatar": AVATAR_BOT,
+                        "user": "Assistant",
+                        "object": f"_Waiting for `{selected_model['model']}`, position {position} in the queue..._"
+                    }
+                deltas = response_cache.fetch(
+                    context["client"],
+                    selected_model["model"],
+                    messages,
+                    metrics,
+                    # hedge with the equivalent model of the other provider when this one is slow or failing
+                    stream=provider_router.stream_text
+                )
+            async for replies in renderer.render(turn.iterate(deltas)):
                 yield {
                     "avatar": AVATAR_BOT,
                     "user": "Assistant",
                     "object": replies
                 }
-            if 'end' in chunk and chunk.end:
-                break  # Exit the loop if the stream is marked as ended
-    finally:
-        # Append the collected replies as a single entry to the chat history
-        if replies:  # Ensure we do not add empty responses
-            chat_memory.append({"role": "assistant", "content": replies})
-        response.close()  # Ensure the stream is properly closed after processing
-        save_jsonl(chat_memory_file, chat_memory)
+            if turn.cancelled:
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": f"{renderer.value}\n\n_Stopped: {turn.reason}_"
+                }
+        finally:
+            replies = renderer.value
+            # Append the collected replies as a single entry to the chat history
+            if replies:  # Ensure we do not add empty responses
+                chat_memory.append({"role": "assistant", "content": replies})
+            # Only the records added by this turn are written
+            context["chat_journal"].metadata["model"] = selected_model["model"]
+            with metrics.saving():
+                await save_chat_memory(context, context["chat_journal"], chat_memory)
+            metrics.finish(prompt_tokens=context_window.count(messages), completion_tokens=count_tokens(replies))
+            # Fold older turns into the summary in the background once the history grows long
+            summarizer.schedule(context)
+            finish_turn(context, turn)
 
 
 chat_interface = ChatInterface(
@@ -118,6 +345,7 @@ ui = pn.template.FastListTemplate(
     header_background="black",
     sidebar=[
         sidebar_selector,
+        sidebar_compare,
         sidebar_keep_memory
     ],
     main=[chat_interface]
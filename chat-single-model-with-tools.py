@@ -1,157 +1,221 @@
-import json
 import panel as pn
-from openai import OpenAI, Stream
-from openai.types.chat import ChatCompletionChunk
+from openai import NOT_GIVEN
 from openai.types.chat.chat_completion_chunk import Choice
 from panel.chat import ChatInterface
 
-from chat_utils.core import get_timestamp
+from chat_utils.cancellation import TurnCancelled, cancel_turn, finish_turn, start_turn
+from chat_utils.catalog import new_chat_id
+from chat_utils.core import get_model_details
+from chat_utils.context import ContextWindow, count_tokens
+from chat_utils.engine import stream_chunks
 from chat_utils.fs import prepare_folders
-from tools.datetime import today
-from tools.mock import get_product_details, send_email, get_current_weather
-
-# Mapping of tool names to functions
-TOOLS = {
-    'today': today,
-    'get_product_details': get_product_details,
-    "send_email": send_email,
-    "get_current_weather": get_current_weather
-}
+from chat_utils.metrics import TurnMetrics, start_metrics_server
+from chat_utils.render import StreamRenderer
+from chat_utils.scheduler import request_scheduler
+from chat_utils.session import create_chat_context, get_session_context, get_session_id
+from chat_utils.tool_calls import collect_tool_calls, run_tool_calls
+from chat_utils.tool_registry import tool_registry
 
 # Setup the environment and prepare folders
 pn.extension()
 prepare_folders(["chats"])
 
-chat_memory = []
-chat_memory_file = f"chats/chat_memory_{get_timestamp()}.jsonl"
+# Prometheus metrics on http://localhost:9464/metrics, see METRICS_PORT
+start_metrics_server()
 
 AVATAR_USER = "https://api.iconify.design/carbon:user.svg"
 AVATAR_BOT = "https://api.iconify.design/carbon:chat-bot.svg"
 
-client = OpenAI()
+
+def create_context():
+    return create_chat_context(
+        chat_memory_file=f"chats/{new_chat_id()}.jsonl",
+        provider="openai"
+    )
+
+
+SYSTEM_PROMPT = """
+You are an assistant that helps users by utilizing available tools whenever possible. 
+Before generating a response, always check if there is a relevant tool available that can 
+provide the necessary information.
+When a user asks for specific details (like product details), extract the necessary 
+information (such as product IDs) from the user's input and use the corresponding tool to get 
+the details.
+Only generate a response directly if no tool is available or applicable.
+"""
+
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": SYSTEM_PROMPT
+}
 
 model = "gpt-4o"
 
+context_window = ContextWindow()
 
-def get_response(
+sidebar_tools = pn.widgets.MultiChoice(
+    name="Tools",
+    description="Tools the model may call",
+    width_policy='max'
+)
+
+
+def load_tools():
+    # Tool modules are imported once the page is shown rather than when the app module loads
+    names = tool_registry.names()
+    sidebar_tools.param.update(options=names, value=names)
+
+
+async def get_response(
         user_input: str,
         user,
         instance: ChatInterface
 ):
-    chat_memory.append({
-        "role": "user",
-        "content": user_input
-    })
-
-    system_prompt = """
-    You are an assistant that helps users by utilizing available tools whenever possible. 
-    Before generating a response, always check if there is a relevant tool available that can 
-    provide the necessary information.
-    When a user asks for specific details (like product details), extract the necessary 
-    information (such as product IDs) from the user's input and use the corresponding tool to get 
-    the details.
-    Only generate a response directly if no tool is available or applicable.
-    """
-
-    response: Stream[ChatCompletionChunk] = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            *chat_memory],
-        stream=True,
-        # tool_choice="auto",
-        tools=[TOOLS[tool_name].tool for tool_name in TOOLS.keys()]
-    )
+    context = get_session_context(create_context)
+
+    # A new message stops the reply still streaming or the tools still running, the partial text is saved
+    cancel_turn(context, "new message")
 
-    replies = ""
-    func_call = {
-        "name": None,
-        "arguments": "",
-    }
-
-    try:
-        for chunk in response:
-            if chunk.choices:
-                choice: Choice = chunk.choices[0]
-
-                if choice.delta.tool_calls:
-                    for tool_call in choice.delta.tool_calls:
-                        if tool_call.function.name:
-                            func_call["name"] = tool_call.function.name
-                        if tool_call.function.arguments:
-                            func_call["arguments"] += tool_call.function.arguments
-
-                if choice.finish_reason == "tool_calls":
-                    if func_call["name"] and func_call["arguments"]:
-                        function_name = func_call["name"]
-                        function_args = json.loads(func_call["arguments"])
-                        if function_name in TOOLS:
+    async with context["lock"]:
+        turn = start_turn(context)
+        chat_memory = context["chat_memory"]
+        client = context["client"]
+
+        chat_memory.append({
+            "role": "user",
+            "content": user_input
+        })
+
+        model_details = get_model_details(model)
+        model_context_window = model_details["context_window"]
+        metrics = TurnMetrics(model_details["provider"], model)
+
+        messages = context_window.select([SYSTEM_MESSAGE, *chat_memory], model_context_window)
+        response = stream_chunks(
+            client,
+            model,
+            messages,
+            metrics,
+            # tool_choice="auto",
+            tools=tool_registry.tools(sidebar_tools.value) or NOT_GIVEN
+        )
+
+        renderer = StreamRenderer()
+        tool_calls = {}
+
+        try:
+            # Wait for the model's rate limits instead of failing with a 429, showing the place in the queue
+            async for position in request_scheduler.queue(
+                    model_details,
+                    context_window.count(messages),
+                    get_session_id()
+            ):
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": f"_Waiting for `{model}`, position {position} in the queue..._"
+                }
+            async for chunk in renderer.pace(turn.iterate(response)):
+                if chunk is None:
+                    # the stream is silent, show the text held back
+                    yield {
+                        "avatar": AVATAR_BOT,
+                        "user": "Assistant",
+                        "object": renderer.value
+                    }
+                elif chunk.choices:
+                    choice: Choice = chunk.choices[0]
+
+                    if choice.delta.tool_calls:
+                        collect_tool_calls(tool_calls, choice.delta.tool_calls)
+
+                    if renderer.feed(choice.delta.content):
+                        yield {
+                            "avatar": AVATAR_BOT,
+                            "user": "Assistant",
+                            "object": renderer.value
+                        }  # Process the text as needed
+
+                    if choice.finish_reason == "tool_calls" and tool_calls:
+                        yield {
+                            "avatar": AVATAR_BOT,
+                            "user": "Assistant",
+                            "object": "Hold a moment, I am processing your request..."
+                        }
+                        calls = [tool_calls[index] for index in sorted(tool_calls)]
+                        # Inject the tool calls and all of their results back into the conversation
+                        chat_memory.append({
+                            "role": "assistant",
+                            "content": None,
+                            "tool_calls": calls
+                        })
+                        try:
+                            with metrics.tool_execution():
+                                results = await turn.run(run_tool_calls(calls, tool_registry))
+                        except TurnCancelled:
+                            # the results will never come, drop the request for them
+                            chat_memory.pop()
+                            break
+                        chat_memory.extend(results)
+                        messages = context_window.select([SYSTEM_MESSAGE, *chat_memory], model_context_window)
+                        async for position in request_scheduler.queue(
+                                model_details,
+                                context_window.count(messages),
+                                get_session_id()
+                        ):
                             yield {
                                 "avatar": AVATAR_BOT,
                                 "user": "Assistant",
-                                "object": "Hold a moment, I am processing your request..."
+                                "object": f"_Waiting for `{model}`, position {position} in the queue..._"
                             }
-                            func = TOOLS[function_name]
-                            output_data = func(**function_args)
-                            print(output_data)
-                            content = ""
-                            # if output is object, convert to string
-                            if isinstance(output_data, dict):
-                                content = json.dumps(output_data)
-                            # Inject the tool result back into the conversation
-                            chat_memory.append({
-                                "role": "function",
-                                "name": function_name,
-                                "content": output_data
-                            })
-                            response_tool = client.chat.completions.create(
-                                model=model,
-                                messages=[
-                                    {
-                                        "role": "system",
-                                        "content": system_prompt
-                                    },
-                                    *chat_memory
-                                ],
-                                stream=True
-                            )
-                            for response_chunk in response_tool:
-                                if response_chunk.choices:
-                                    tool_choice: Choice = response_chunk.choices[0]
-                                    if tool_choice.delta.content:
-                                        replies += tool_choice.delta.content
-                                        yield {
-                                            "avatar": AVATAR_BOT,
-                                            "user": "Assistant",
-                                            "object": replies
-                                        }
-                                if 'end' in response_chunk and response_chunk.end:
-                                    break  # Exit the loop if the stream is marked as ended
-
-                if choice.delta.content:
-                    replies += choice.delta.content
-                    yield {
-                        "avatar": AVATAR_BOT,
-                        "user": "Assistant",
-                        "object": replies
-                    }  # Process the text as needed
+                        response_tool = stream_chunks(
+                            client,
+                            model,
+                            messages,
+                            metrics
+                        )
+                        async for response_chunk in renderer.pace(turn.iterate(response_tool)):
+                            if response_chunk is None:
+                                yield {
+                                    "avatar": AVATAR_BOT,
+                                    "user": "Assistant",
+                                    "object": renderer.value
+                                }
+                            elif response_chunk.choices:
+                                tool_choice: Choice = response_chunk.choices[0]
+                                if renderer.feed(tool_choice.delta.content):
+                                    yield {
+                                        "avatar": AVATAR_BOT,
+                                        "user": "Assistant",
+                                        "object": renderer.value
+                                    }
 
-            if 'end' in chunk and chunk.end:
-                break  # Exit the loop if the stream is marked as ended
+            if renderer.pending:
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": renderer.value
+                }
+            if turn.cancelled:
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": f"{renderer.value}\n\n_Stopped: {turn.reason}_"
+                }
 
-    finally:
-        instance.scroll = True
-        # Append the collected replies as a single entry to the chat history
-        if replies:  # Ensure we do not add empty responses
-            chat_memory.append({
-                "role": "assistant",
-                "content": replies
-            })
-        response.close()  # Ensure the stream is properly closed after processing
-        # save_jsonl(chat_memory_file, chat_memory)
+        finally:
+            replies = renderer.value
+            instance.scroll = True
+            # Append the collected replies as a single entry to the chat history
+            if replies:  # Ensure we do not add empty responses
+                chat_memory.append({
+                    "role": "assistant",
+                    "content": replies
+                })
+            await response.aclose()  # Ensure the stream is properly closed after processing
+            # save_jsonl(context["chat_memory_file"], chat_memory)
+            metrics.finish(prompt_tokens=context_window.count(messages), completion_tokens=count_tokens(replies))
+            finish_turn(context, turn)
 
 
 chat_interface = ChatInterface(
@@ -169,11 +233,14 @@ ui = pn.template.FastListTemplate(
     site="Demo App",
     title=f"Chat",
     header_background="black",
-    sidebar=[],
+    sidebar=[
+        sidebar_tools
+    ],
     main=[chat_interface]
 )
 
 if __name__ == "__main__":
+    load_tools()
     ui.show(open=False)
 else:
     chat_interface.send(
@@ -185,4 +252,5 @@ else:
         avatar=AVATAR_BOT,
         respond=False
     )
+    pn.state.onload(load_tools)
     ui.servable()
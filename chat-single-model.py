@@ -1,66 +1,103 @@
-import os
-
 import panel as pn
-from openai import OpenAI, Stream
-from openai.types.chat import ChatCompletionChunk
-from openai.types.chat.chat_completion_chunk import Choice
 from panel.chat import ChatInterface
 
-from chat_utils.core import get_timestamp
+from chat_utils.cancellation import cancel_turn, finish_turn, start_turn
+from chat_utils.catalog import new_chat_id
+from chat_utils.core import get_model_details
+from chat_utils.context import ContextWindow, count_tokens
 from chat_utils.fs import prepare_folders
+from chat_utils.metrics import TurnMetrics, start_metrics_server
+from chat_utils.render import StreamRenderer
+from chat_utils.response_cache import response_cache
+from chat_utils.routing import provider_router
+from chat_utils.scheduler import request_scheduler
+from chat_utils.session import create_chat_context, get_session_context, get_session_id
 
 # https://panel.holoviz.org/
 pn.extension()
 
 prepare_folders(["chats"])
 
-chat_memory = []
-chat_memory_file = f"chats/chat_memory_{get_timestamp()}.jsonl"
+# Prometheus metrics on http://localhost:9464/metrics, see METRICS_PORT
+start_metrics_server()
 
 AVATAR_USER = "https://api.iconify.design/carbon:user.svg"
 AVATAR_BOT = "https://api.iconify.design/carbon:chat-bot.svg"
 
-client = OpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
-
-model = "llama3-8b-8192"
-
 
-def get_response(user_input: str, user, instance: ChatInterface):
-    chat_memory.append({"role": "user", "content": user_input})
-
-    response: Stream[ChatCompletionChunk] = client.chat.completions.create(
-        model=model,
-        messages=chat_memory,
-        stream=True
+def create_context():
+    return create_chat_context(
+        chat_memory_file=f"chats/{new_chat_id()}.jsonl",
+        provider="groq",
+        base_url="https://api.groq.com/openai/v1"
     )
 
-    replies = ""
 
-    try:
-        for chunk in response:
-            if chunk.choices:
-                choice: Choice = chunk.choices[0]
+model = "llama3-8b-8192"
 
-                text = choice.delta.content
-                if text:
-                    replies += text
+context_window = ContextWindow()
+
+
+async def get_response(user_input: str, user, instance: ChatInterface):
+    context = get_session_context(create_context)
+
+    # A new message stops the reply still streaming, its partial text is saved
+    cancel_turn(context, "new message")
+
+    async with context["lock"]:
+        turn = start_turn(context)
+        chat_memory = context["chat_memory"]
+        chat_memory.append({"role": "user", "content": user_input})
+
+        messages = context_window.select(chat_memory, get_model_details(model)["context_window"])
+
+        renderer = StreamRenderer()
+        metrics = TurnMetrics(get_model_details(model)["provider"], model)
+
+        try:
+            # A cached reply is replayed at once, only a miss is queued and sent
+            deltas = response_cache.cached(model, messages, metrics)
+            if deltas is None:
+                # Wait for the model's rate limits instead of failing with a 429, showing the place in the queue
+                async for position in request_scheduler.queue(
+                        get_model_details(model),
+                        context_window.count(messages),
+                        get_session_id()
+                ):
+                    yield {
+                        "avatar": AVATAR_BOT,
+                        "user": "Assistant",
+                        "object": f"_Waiting for `{model}`, position {position} in the queue..._"
+                    }
+                deltas = response_cache.fetch(
+                    context["client"],
+                    model,
+                    messages,
+                    metrics,
+                    # hedge with the equivalent model of the other provider when this one is slow or failing
+                    stream=provider_router.stream_text
+                )
+            async for replies in renderer.render(turn.iterate(deltas)):
                 yield {
                     "avatar": AVATAR_BOT,
                     "user": "Assistant",
                     "object": replies
                 }  # Process the text as needed
-            if 'end' in chunk and chunk.end:
-                break  # Exit the loop if the stream is marked as ended
-    finally:
-        instance.scroll = True
-        # Append the collected replies as a single entry to the chat history
-        if replies:  # Ensure we do not add empty responses
-            chat_memory.append({"role": "assistant", "content": replies})
-        response.close()  # Ensure the stream is properly closed after processing
-        #save_jsonl(chat_memory_file, chat_memory)
+            if turn.cancelled:
+                yield {
+                    "avatar": AVATAR_BOT,
+                    "user": "Assistant",
+                    "object": f"{renderer.value}\n\n_Stopped: {turn.reason}_"
+                }
+        finally:
+            replies = renderer.value
+            instance.scroll = True
+            # Append the collected replies as a single entry to the chat history
+            if replies:  # Ensure we do not add empty responses
+                chat_memory.append({"role": "assistant", "content": replies})
+            #save_jsonl(context["chat_memory_file"], chat_memory)
+            metrics.finish(prompt_tokens=context_window.count(messages), completion_tokens=count_tokens(replies))
+            finish_turn(context, turn)
 
 
 chat_interface = ChatInterface(
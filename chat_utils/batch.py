@@ -0,0 +1,323 @@
+"""
+Headless batch runs of prompts through the completion path of the apps, ex.: for regression checks or
+offline answer generation.
+
+Every input line is a json object with a "prompt", or a list of chat "messages", and optionally an "id",
+a "model", a "system" prompt and any of "max_tokens", "temperature", "top_p", "seed" and "stop". Prompts run
+concurrently, bounded per provider, and wait for the rate limits of get_models() like the apps do. Results
+are appended to the output as they arrive, one json line per prompt with its reply or error and its timings.
+
+The output is also the checkpoint: running the same command again skips the prompts that already have a
+reply there and retries the failed ones, the last line of an id is its result.
+
+    python -m chat_utils.batch prompts.jsonl answers.jsonl --model llama3-70b-8192
+    python -m chat_utils.batch prompts.jsonl answers.jsonl --concurrency groq=4 openai=32 --no-fallback
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from chat_utils.context import ContextWindow, count_tokens
+from chat_utils.core import get_model_details, get_models
+from chat_utils.engine import client_registry, stream_text
+from chat_utils.metrics import TurnMetrics, start_metrics_server
+from chat_utils.response_cache import response_cache
+from chat_utils.routing import provider_router
+from chat_utils.scheduler import request_scheduler
+
+DEFAULT_MODEL = "llama3-8b-8192"
+
+# Fields of an input line passed on to chat.completions.create
+COMPLETION_ARGUMENTS = ("max_tokens", "temperature", "top_p", "seed", "stop")
+
+# Seconds a request is assumed to take when the concurrency of a provider is derived from its rate limits
+REQUEST_SECONDS = 10.0
+MAX_CONCURRENCY = 64
+
+
+def get_provider_concurrency() -> Dict[str, int]:
+    """
+    Get the default number of requests in flight per provider: enough to reach the largest "rpm" of its
+    models in get_models() when a request takes REQUEST_SECONDS, at most MAX_CONCURRENCY
+    :return: Dictionary of provider -> number of requests
+    """
+    limits = {}
+    for details in get_models().values():
+        wanted = math.ceil(details.get("rpm", 60) / 60 * REQUEST_SECONDS)
+        limits[details["provider"]] = min(MAX_CONCURRENCY, max(limits.get(details["provider"], 1), wanted))
+    return limits
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def read_prompts(path: str) -> List[Dict]:
+    """
+    Read the prompts of an input file, a prompt without an id is identified by its line number
+    :param path: jsonl file
+    :return: List of prompts
+    """
+    prompts = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                prompt = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f"{path}:{number}: {error}") from None
+            if "prompt" not in prompt and "messages" not in prompt:
+                raise ValueError(f"{path}:{number}: a prompt needs \"prompt\" or \"messages\"")
+            prompt.setdefault("id", str(number))
+            prompts.append(prompt)
+    return prompts
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    """
+    Get the ids answered in an output file, cutting off a line left incomplete by an interrupted run
+    :param path: jsonl file written by BatchRunner
+    :return: Set of ids with a reply
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r+b') as f:
+        valid = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            valid += len(line)
+            result = json.loads(line)
+            if "error" in result:
+                done.discard(result["id"])
+            else:
+                done.add(result["id"])
+        f.truncate(valid)
+    return done
+
+
+class BatchStats:
+    """
+    Counters and latencies of a batch run
+    """
+
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.completed = 0
+        self.failed = 0
+        self.completion_tokens = 0
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.started = time.perf_counter()
+
+    def add(self, result: Dict) -> None:
+        if "error" in result:
+            self.failed += 1
+            return
+        self.completed += 1
+        self.completion_tokens += result["completion_tokens"]
+        self.latencies.append(result["latency"])
+        if result["ttft"] is not None:
+            self.ttfts.append(result["ttft"])
+
+    def progress(self) -> str:
+        done = self.completed + self.failed
+        elapsed = time.perf_counter() - self.started
+        return (f"{done + self.skipped}/{self.total} prompts, {self.failed} failed, "
+                f"{done / elapsed:.2f} prompts/s, {self.completion_tokens / elapsed:.1f} tokens/s")
+
+    def report(self) -> str:
+        lines = [self.progress(), f"{self.skipped} skipped from the checkpoint"]
+        for name, values in (("latency", self.latencies), ("ttft", self.ttfts)):
+            if values:
+                lines.append(f"{name:<8} p50 {percentile(values, 0.5):.3f}s  p90 {percentile(values, 0.9):.3f}s  "
+                             f"p99 {percentile(values, 0.99):.3f}s  max {max(values):.3f}s")
+        return "\n".join(lines)
+
+
+class BatchRunner:
+    """
+    Run prompts concurrently through the completion path of the apps, writing each result as it arrives
+    """
+
+    def __init__(
+            self,
+            model: str = DEFAULT_MODEL,
+            concurrency: Optional[Dict[str, int]] = None,
+            stream: Callable = provider_router.stream_text,
+            progress_interval: float = 10.0
+    ):
+        """
+        :param model: Model of the prompts that do not name one
+        :param concurrency: Requests in flight per provider, the missing ones default to get_provider_concurrency()
+        :param stream: Streams the text deltas of a reply, ex.: chat_utils.engine.stream_text to never fail over
+        :param progress_interval: Seconds between progress lines on stderr, None for none
+        """
+        self.model = model
+        self.concurrency = {**get_provider_concurrency(), **(concurrency or {})}
+        self.stream = stream
+        self.progress_interval = progress_interval
+        self.context_window = ContextWindow()
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(provider)
+        if semaphore is None:
+            semaphore = self._semaphores[provider] = asyncio.Semaphore(self.concurrency.get(provider, 1))
+        return semaphore
+
+    @staticmethod
+    def messages(prompt: Dict) -> List[Dict]:
+        messages = list(prompt.get("messages") or [{"role": "user", "content": prompt["prompt"]}])
+        if prompt.get("system"):
+            messages.insert(0, {"role": "system", "content": prompt["system"]})
+        return messages
+
+    async def run_prompt(self, prompt: Dict) -> Dict:
+        """
+        Get the reply to one prompt
+        :param prompt: Line of the input file
+        :return: Result line, with "error" instead of "reply" when the request failed
+        """
+        model = prompt.get("model") or self.model
+        result = {"id": prompt["id"], "model": model}
+        try:
+            details = get_model_details(model)
+        except KeyError:
+            return {**result, "error": f"unknown model {model}"}
+
+        messages = self.messages(prompt)
+        kwargs = {name: prompt[name] for name in COMPLETION_ARGUMENTS if name in prompt}
+        prompt_tokens = self.context_window.count(messages)
+        client = client_registry.get(details["provider"], details["base_url"])
+
+        async with self._semaphore(details["provider"]):
+            async for _ in request_scheduler.queue(details, prompt_tokens, "batch"):
+                pass
+            metrics = TurnMetrics(details["provider"], model)
+            started = time.perf_counter()
+            parts = []
+            try:
+                async for delta in self.stream(client, model, messages, metrics, **kwargs):
+                    parts.append(delta)
+            except Exception as error:
+                return {**result, "error": f"{type(error).__name__}: {error}"}
+            finally:
+                reply = "".join(parts)
+                metrics.finish(prompt_tokens=prompt_tokens, completion_tokens=count_tokens(reply))
+
+        return {
+            **result,
+            "answered_by": metrics.labels["model"],
+            "reply": reply,
+            "cached": metrics.cached,
+            "ttft": None if metrics.first_chunk is None else round(metrics.first_chunk - started, 4),
+            "latency": round(time.perf_counter() - started, 4),
+            "prompt_tokens": metrics.prompt_tokens if metrics.prompt_tokens is not None else prompt_tokens,
+            "completion_tokens": (metrics.completion_tokens if metrics.completion_tokens is not None
+                                  else count_tokens(reply))
+        }
+
+    async def run(self, prompts: Iterable[Dict], output_path: str) -> BatchStats:
+        """
+        Run the prompts that are not answered in the output yet
+        :param prompts: Prompts as returned by read_prompts
+        :param output_path: jsonl file the results are appended to
+        :return: BatchStats of the run
+        """
+        prompts = list(prompts)
+        done = read_checkpoint(output_path)
+        pending = [prompt for prompt in prompts if prompt["id"] not in done]
+        stats = BatchStats(len(prompts), len(prompts) - len(pending))
+        reported = time.perf_counter()
+
+        tasks = [asyncio.ensure_future(self.run_prompt(prompt)) for prompt in pending]
+        try:
+            with open(output_path, 'a') as f:
+                for task in asyncio.as_completed(tasks):
+                    result = await task
+                    # flushed line by line, an interrupted run loses at most the requests in flight
+                    f.write(json.dumps(result) + '\n')
+                    f.flush()
+                    stats.add(result)
+                    if self.progress_interval is not None and time.perf_counter() - reported >= self.progress_interval:
+                        reported = time.perf_counter()
+                        print(stats.progress(), file=sys.stderr)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return stats
+
+
+def parse_concurrency(values: List[str]) -> Dict[str, int]:
+    """
+    Parse --concurrency values, ex.: ["groq=4", "openai=32"], a bare number applies to every provider
+    :param values:
+    :return: Dictionary of provider -> number of requests
+    """
+    limits = {}
+    for value in values:
+        provider, _, number = value.rpartition("=")
+        if provider:
+            limits[provider] = int(number)
+        else:
+            limits.update((name, int(number)) for name in get_provider_concurrency())
+    return limits
+
+
+async def run_batch(args: argparse.Namespace) -> BatchStats:
+    stream = provider_router.stream_text if args.fallback else stream_text
+    if args.cache:
+        stream = partial(response_cache.stream_text, stream=stream)
+    runner = BatchRunner(
+        model=args.model,
+        concurrency=parse_concurrency(args.concurrency),
+        stream=stream,
+        progress_interval=args.progress
+    )
+    try:
+        return await runner.run(read_prompts(args.input), args.output)
+    finally:
+        await client_registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="jsonl file of prompts")
+    parser.add_argument("output", help="jsonl file the results are appended to, also the checkpoint")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model of the prompts that do not name one")
+    parser.add_argument("--concurrency", nargs="*", default=[],
+                        help="Requests in flight per provider, ex.: groq=4 openai=32, derived from the rate limits "
+                             "of get_models() by default")
+    parser.add_argument("--no-fallback", dest="fallback", action="store_false",
+                        help="Only use the requested model, without hedging or failing over to its fallback")
+    parser.add_argument("--cache", action="store_true", help="Answer repeated prompts from the response cache")
+    parser.add_argument("--progress", type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port during the run")
+    args = parser.parse_args()
+
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+    try:
+        stats = asyncio.run(run_batch(args))
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume", file=sys.stderr)
+        sys.exit(130)
+    print(stats.report())
+    if stats.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
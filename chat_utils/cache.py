@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple
+
+_MISSING = object()
+
+
+class MemoryCache:
+    """
+    In-process key/value store with per-entry TTL and LRU eviction.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 256,
+            ttl: Optional[float] = None,
+            on_evict: Optional[Callable[[str], None]] = None
+    ):
+        """
+        :param max_entries: Maximum number of entries, the least recently used entry is evicted first
+        :param ttl: Seconds an entry stays valid, None for no expiry
+        :param on_evict: Called with the key of every entry evicted or found expired, outside the lock
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Look up a key
+        :param key:
+        :return: (hit, value)
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return False, None
+            expires, value = entry
+            expired = expires is not None and expires < time.monotonic()
+            if expired:
+                del self._data[key]
+            else:
+                self._data.move_to_end(key)
+        if expired:
+            self._evicted([key])
+            return False, None
+        return True, value
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Store a value
+        :param key:
+        :param value:
+        :return: None
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        evicted = []
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                evicted.append(self._data.popitem(last=False)[0])
+        self._evicted(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = list(self._data)
+            self._data.clear()
+        self._evicted(evicted)
+
+    def _evicted(self, keys):
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """
+    On-disk key/value store for JSON serializable values, shared by processes using the same file.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: Optional[float] = None):
+        """
+        :param path: Path to the SQLite database
+        :param max_entries: Maximum number of entries, the least recently used entries are evicted first
+        :param ttl: Seconds an entry stays valid, None for no expiry
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False, None
+            value, expires = row
+            if expires is not None and expires < now:
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return False, None
+            self._connection.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+        return True, json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, now)
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
@@ -0,0 +1,163 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class TurnCancelled(Exception):
+    """
+    Raised by CancelToken.run when the turn was cancelled before the awaited work finished
+    """
+
+
+class CancelToken:
+    """
+    Cancellation of one turn of a session.
+
+    A new message, the session being destroyed or any other trigger calls cancel(), the turn
+    notices at its next await through iterate() and run(): the upstream stream is closed at once,
+    pending tool calls are abandoned and the turn ends normally, saving its partial reply.
+    """
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._finished = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "stopped") -> None:
+        """
+        Cancel the turn, may be called from any thread
+        :param reason: Why the turn was cancelled, ex.: "new message"
+        :return: None
+        """
+        if self.reason is not None or self._finished:
+            return
+        self.reason = reason
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def finish(self) -> None:
+        """
+        Mark the turn as finished and run the callbacks waiting for it
+        :return: None
+        """
+        self._finished = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_done_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Call a function once the turn finished, at once if it already did
+        :param callback:
+        :return: None
+        """
+        if self._finished:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    async def iterate(self, iterator: AsyncIterator[T]) -> AsyncIterator[T]:
+        """
+        Iterate until the iterator is exhausted or the turn is cancelled.
+        The iterator is closed either way, for a completion stream that closes the HTTP response.
+        :param iterator: Async generator, ex.: chat_utils.engine.stream_text
+        :return: Async iterator of the same items
+        """
+        cancelled = asyncio.ensure_future(self._event.wait())
+        step = None
+        try:
+            while not self.cancelled:
+                step = asyncio.ensure_future(iterator.__anext__())
+                await asyncio.wait({step, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+                if not step.done():
+                    break
+                try:
+                    item = step.result()
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            cancelled.cancel()
+            # also reached when the task itself is cancelled, ex.: by the Stop button of ChatInterface
+            if step is not None and not step.done():
+                step.cancel()
+                await asyncio.gather(step, return_exceptions=True)
+            await iterator.aclose()
+
+    async def run(self, awaitable: Awaitable[T]) -> T:
+        """
+        Await some work unless the turn is cancelled first, in which case the work is cancelled
+        :param awaitable: ex.: chat_utils.tool_calls.run_tool_calls(...)
+        :return: the result of the work
+        :raises TurnCancelled: if the turn was cancelled
+        """
+        if self.cancelled:
+            raise TurnCancelled(self.reason)
+        work = asyncio.ensure_future(awaitable)
+        cancelled = asyncio.ensure_future(self._event.wait())
+        try:
+            await asyncio.wait({work, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancelled.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+            raise TurnCancelled(self.reason)
+        return work.result()
+
+
+def start_turn(
+        chat_context: Dict
+) -> CancelToken:
+    """
+    Start a turn in a chat context, call it once the turn holds the context's lock
+    :param chat_context:
+    :return: token of the new turn
+    """
+    token = chat_context["turn"] = CancelToken()
+    return token
+
+
+def finish_turn(
+        chat_context: Dict,
+        token: CancelToken
+) -> None:
+    """
+    End a turn started by start_turn
+    :param chat_context:
+    :param token:
+    :return: None
+    """
+    if chat_context.get("turn") is token:
+        chat_context["turn"] = None
+    token.finish()
+
+
+def cancel_turn(
+        chat_context: Dict,
+        reason: str = "stopped"
+) -> bool:
+    """
+    Cancel the running turn of a chat context, if any
+    :param chat_context:
+    :param reason:
+    :return: whether a turn was running
+    """
+    token = chat_context.get("turn")
+    if token is None:
+        return False
+    token.cancel(reason)
+    return True
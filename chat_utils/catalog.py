@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from chat_utils.fs import ChatJournal, CompressedChatJournal, discard_summary
+
+CATALOG_FILE = "catalog.sqlite3"
+
+# Files of a chats folder with a chat extension that are not chats, ex.: the sidecar of chat_utils.vector_memory
+RESERVED_FILES = {"memory.ids.jsonl"}
+
+_catalogs: Dict[str, "ChatCatalog"] = {}
+_catalogs_lock = threading.Lock()
+
+
+def is_chat_file(name: str) -> bool:
+    """
+    Check whether a file of a chats folder holds a chat
+    :param name: File name
+    :return:
+    """
+    return name.endswith((".jsonl", ".chatz")) and name not in RESERVED_FILES
+
+
+def new_chat_id() -> str:
+    """
+    Create the id of a new chat, unique across sessions, processes and nodes, unlike a timestamp alone
+    :return: chat id, ex.: chat_memory_2024-04-25_084851_3f9c2a7b51e0
+    """
+    return f"chat_memory_{datetime.now().strftime('%Y-%m-%d_%H%M%S')}_{uuid.uuid4().hex[:12]}"
+
+
+def get_chat_id(path: str) -> str:
+    """
+    Get the id of a chat from its file path, ex.: chats/chat_memory_2024-04-25_084851.jsonl -> chat_memory_2024-04-25_084851
+    :param path:
+    :return:
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class ChatCatalog:
+    """
+    Persistent index of the chats saved in a folder, so listing them does not scan the folder.
+    """
+
+    def __init__(self, folder: str, path: Optional[str] = None):
+        """
+        :param folder: Folder holding the chat files, the catalog is stored next to them
+        :param path: Path to the SQLite database, defaults to CATALOG_FILE in the folder
+        """
+        self.folder = folder
+        path = path or os.path.join(folder, CATALOG_FILE)
+        is_new = not os.path.exists(path)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL a crash of the app loses nothing, only a power loss can lose the last commits
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+        if is_new:
+            self.rebuild()
+
+    def _create_tables(self) -> None:
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "id TEXT PRIMARY KEY, "
+            "title TEXT, "
+            "model TEXT, "
+            "created REAL NOT NULL, "
+            "updated REAL NOT NULL, "
+            "message_count INTEGER NOT NULL DEFAULT 0, "
+            "byte_size INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chats_created ON chats (created)")
+
+    def rebuild(self) -> None:
+        """
+        Index the chat files already in the folder, used once when the catalog is created
+        :return: None
+        """
+        for name in os.listdir(self.folder):
+            if not is_chat_file(name):
+                continue
+            path = os.path.join(self.folder, name)
+            journal = create_chat_journal(path)
+            try:
+                messages = journal.load()
+            except ValueError as error:
+                # left for the user to repair, the other chats are still indexed
+                print(f"Skipping unreadable chat: {error}", file=sys.stderr)
+                continue
+            stat = os.stat(path)
+            self.register(get_chat_id(path), created=stat.st_mtime)
+            self.update(
+                get_chat_id(path),
+                message_count=len(messages),
+                byte_size=stat.st_size,
+                title=get_title(messages),
+                updated=stat.st_mtime
+            )
+
+    def register(
+            self,
+            chat_id: str,
+            model: Optional[str] = None,
+            created: Optional[float] = None
+    ) -> None:
+        """
+        Add a chat to the catalog, does nothing if it is already there
+        :param chat_id:
+        :param model:
+        :param created: creation time, defaults to now
+        :return: None
+        """
+        now = time.time() if created is None else created
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO chats (id, model, created, updated) VALUES (?, ?, ?, ?)",
+                (chat_id, model, now, now)
+            )
+
+    def update(
+            self,
+            chat_id: str,
+            message_count: int,
+            byte_size: int,
+            title: Optional[str] = None,
+            model: Optional[str] = None,
+            updated: Optional[float] = None
+    ) -> None:
+        """
+        Update the details of a chat, registering it if needed
+        :param chat_id:
+        :param message_count:
+        :param byte_size:
+        :param title: kept as is when None
+        :param model: kept as is when None
+        :param updated: update time, defaults to now
+        :return: None
+        """
+        now = time.time() if updated is None else updated
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO chats (id, title, model, created, updated, message_count, byte_size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET "
+                "title = COALESCE(chats.title, excluded.title), "
+                "model = COALESCE(excluded.model, chats.model), "
+                "updated = excluded.updated, "
+                "message_count = excluded.message_count, "
+                "byte_size = excluded.byte_size",
+                (chat_id, title, model, now, now, message_count, byte_size)
+            )
+
+    def count(self) -> int:
+        """
+        Get the number of chats with at least one message
+        :return:
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM chats WHERE message_count > 0").fetchone()[0]
+
+    def page(
+            self,
+            limit: int = 50,
+            after: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        Get a page of chats with at least one message, newest first.
+        Pages are keyed on the last chat of the previous page, so chats added meanwhile do not shift them.
+        :param limit: number of chats per page
+        :param after: last chat of the previous page, None for the first page
+        :return: list of chat details
+        """
+        with self._lock:
+            if after is None:
+                rows = self._connection.execute(
+                    "SELECT * FROM chats WHERE message_count > 0 ORDER BY created DESC, id DESC LIMIT ?",
+                    (limit,)
+                ).fetchall()
+            else:
+                rows = self._connection.execute(
+                    "SELECT * FROM chats WHERE message_count > 0 AND (created, id) < (?, ?) "
+                    "ORDER BY created DESC, id DESC LIMIT ?",
+                    (after["created"], after["id"], limit)
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, chat_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def on_journal_write(
+            self,
+            journal: ChatJournal,
+            records: List[Dict],
+            replaced: bool
+    ) -> None:
+        """
+        ChatJournal listener keeping the catalog in step with the chat file
+        :param journal:
+        :param records:
+        :param replaced:
+        :return: None
+        """
+        self.update(
+            get_chat_id(journal.file_path),
+            message_count=journal.count,
+            byte_size=os.path.getsize(journal.file_path) if os.path.exists(journal.file_path) else 0,
+            title=get_title(records),
+            model=journal.metadata.get("model")
+        )
+
+
+def get_title(
+        messages: List[Dict],
+        length: int = 80
+) -> Optional[str]:
+    """
+    Get a chat title from the first user message
+    :param messages:
+    :param length: maximum title length
+    :return: title, None if there is no user message
+    """
+    for message in messages:
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            title = " ".join(message["content"].split())
+            return title if len(title) <= length else title[:length - 1] + "…"
+    return None
+
+
+def get_chat_catalog(folder: str) -> ChatCatalog:
+    """
+    Get the catalog of a chats folder, shared by all sessions of the process
+    :param folder:
+    :return: ChatCatalog
+    """
+    key = os.path.abspath(folder)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            os.makedirs(folder, exist_ok=True)
+            catalog = ChatCatalog(folder)
+            _catalogs[key] = catalog
+        return catalog
+
+
+def create_chat_journal(path: str) -> ChatJournal:
+    """
+    Create the journal matching the format of a chat file, .chatz files are compressed
+    :param path:
+    :return: ChatJournal
+    """
+    if path.endswith(".chatz"):
+        return CompressedChatJournal(path)
+    return ChatJournal(path)
+
+
+def open_chat_journal(path: str) -> ChatJournal:
+    """
+    Create a journal for a chat in the store of its folder, see chat_utils.store.get_chat_store,
+    that keeps the catalog, the vector memory and the search index of the folder up to date and
+    discards the chat's summary when the chat is rewritten
+    :param path: Path of the chat file, for other stores it only names the chat and its folder
+    :return: ChatJournal, or a StoreJournal with the same interface
+    """
+    # imported here, chat_utils.store, chat_utils.vector_memory and chat_utils.search depend on this module
+    from chat_utils.search import get_search_index
+    from chat_utils.store import get_chat_store
+    from chat_utils.vector_memory import get_vector_memory
+
+    folder = os.path.dirname(path) or "."
+    journal = get_chat_store(folder).journal(path)
+    journal.listeners.append(get_vector_memory(folder).on_journal_write)
+    journal.listeners.append(get_search_index(folder).on_journal_write)
+    journal.listeners.append(discard_summary)
+    return journal
@@ -0,0 +1,121 @@
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Tokens added by the chat format around every message
+MESSAGE_OVERHEAD = 4
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens in a text, using tiktoken when it is installed and a 4 characters per token estimate otherwise
+    :param text: Text to count
+    :return: Number of tokens
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            _encoding = False
+
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+class ContextWindow:
+    """
+    Pick the newest chat messages that fit a model's context window.
+
+    Token counts are memoized per (role, content) and the selection walks the history from
+    the newest message backwards, so adding a turn only tokenizes the new messages.
+    """
+
+    def __init__(self, reserve: int = 1024, max_cache: int = 10000):
+        """
+        :param reserve: Tokens kept free for the reply
+        :param max_cache: Maximum number of memoized token counts
+        """
+        self.reserve = reserve
+        self.max_cache = max_cache
+        self._cache: OrderedDict = OrderedDict()
+
+    def message_tokens(self, message: Dict) -> int:
+        """
+        Get the number of tokens of a message
+        :param message: Chat message
+        :return: Number of tokens
+        """
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        if message.get("tool_calls"):
+            content += json.dumps(message["tool_calls"])
+        key = (message.get("role"), content)
+
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = count_tokens(content) + MESSAGE_OVERHEAD
+            self._cache[key] = tokens
+            if len(self._cache) > self.max_cache:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return tokens
+
+    def select(
+            self,
+            messages: List[Dict],
+            context_window: int,
+            reserve: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        Select the newest messages that fit the context window minus the reply budget.
+        Leading system messages are always kept, as is the newest message, with the assistant
+        message that requested it when it is a tool result.
+        :param messages: Chat history
+        :param context_window: Context window of the model, in tokens
+        :param reserve: Tokens kept free for the reply, defaults to the instance reserve
+        :return: List of messages to send
+        """
+        budget = context_window - (self.reserve if reserve is None else reserve)
+
+        pinned = 0
+        while pinned < len(messages) and messages[pinned].get("role") == "system":
+            budget -= self.message_tokens(messages[pinned])
+            pinned += 1
+
+        start = len(messages)
+        while start > pinned:
+            tokens = self.message_tokens(messages[start - 1])
+            if tokens > budget and start < len(messages):
+                break
+            budget -= tokens
+            start -= 1
+
+        # tool results cannot be sent without the assistant message that requested them
+        if start < len(messages) and messages[start].get("role") == "tool":
+            end = start
+            while end < len(messages) and messages[end].get("role") == "tool":
+                end += 1
+            if end < len(messages):
+                # drop the results that were cut from their request
+                start = end
+            else:
+                # the newest messages are tool results, the follow-up request needs their request too
+                while start > pinned and messages[start].get("role") == "tool":
+                    start -= 1
+
+        return messages[:pinned] + messages[start:]
+
+    def count(self, messages: List[Dict]) -> int:
+        """
+        Get the number of tokens of a list of messages, ex.: to estimate the prompt size
+        :param messages: Chat messages
+        :return: Number of tokens
+        """
+        return sum(self.message_tokens(message) for message in messages)
@@ -1,20 +1,31 @@
-import json
+import asyncio
 import os
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 
 import panel as pn
-from llama_index.core.tools import FunctionTool
-from panel.chat import ChatInterface
+from panel.chat import ChatInterface, ChatMessage
+
+from chat_utils.catalog import new_chat_id, open_chat_journal
+from chat_utils.fs import load_summary
+from chat_utils.store import StoreJournal, get_chat_store
 
 AVATAR_USER = "https://api.iconify.design/carbon:user.svg"
 AVATAR_BOT = "https://api.iconify.design/carbon:chat-bot.svg"
 AVATAR_SYSTEM = "https://api.iconify.design/carbon:ibm-event-automation.svg"
 
+# Number of messages read when a chat is opened, they are all sent to the model, older ones are read on demand
+HISTORY_PAGE_SIZE = 50
+# Number of messages rendered when a chat is opened and per "Load earlier messages", a ChatMessage is slow to build
+HISTORY_RENDER_SIZE = 10
+
 
 def get_models() -> dict:
     """
-    Get a dictionary of models with their details
+    Get a dictionary of models with their details.
+    "fallback" names an equivalent model of the other provider, used by chat_utils.routing.
+    "rpm" and "tpm" are the requests and tokens per minute allowed by the provider, used by chat_utils.scheduler,
+    they depend on the account tier
     :return:
     """
     return {
@@ -23,60 +34,108 @@ def get_models() -> dict:
                 "model": "llama3-8b-8192",
                 "base_url": "https://api.groq.com/openai/v1",
                 "provider": "groq",
-                "context_window": 8192
+                "context_window": 8192,
+                "fallback": "gpt-3.5-turbo-0125",
+                "rpm": 30,
+                "tpm": 30000
             },
         "LLaMA3 70b":
             {
                 "model": "llama3-70b-8192",
                 "base_url": "https://api.groq.com/openai/v1",
                 "provider": "groq",
-                "context_window": 8192
+                "context_window": 8192,
+                "fallback": "gpt-4o",
+                "rpm": 30,
+                "tpm": 6000
             },
         "Mixtral 8x7b":
             {
                 "model": "mixtral-8x7b-32768",
                 "base_url": "https://api.groq.com/openai/v1",
                 "provider": "groq",
-                "context_window": 32768
+                "context_window": 32768,
+                "fallback": "gpt-3.5-turbo-0125",
+                "rpm": 30,
+                "tpm": 5000
             },
         "Gemma 7b":
             {
                 "model": "gemma-7b-it",
                 "base_url": "https://api.groq.com/openai/v1",
                 "provider": "groq",
-                "context_window": 8192
+                "context_window": 8192,
+                "fallback": "gpt-3.5-turbo-0125",
+                "rpm": 30,
+                "tpm": 15000
+            },
+        "GPT-4o":
+            {
+                "model": "gpt-4o",
+                "base_url": "https://api.openai.com/v1",
+                "provider": "openai",
+                "context_window": 128000,
+                "fallback": "llama3-70b-8192",
+                "rpm": 500,
+                "tpm": 30000
             },
         "GPT-4 Turbo":
             {
                 "model": "gpt-4-turbo",
                 "base_url": "https://api.openai.com/v1",
                 "provider": "openai",
-                "context_window": 128000
+                "context_window": 128000,
+                "fallback": "llama3-70b-8192",
+                "rpm": 500,
+                "tpm": 30000
             },
         "GPT-4":
             {
                 "model": "gpt-4",
                 "base_url": "https://api.openai.com/v1",
                 "provider": "openai",
-                "context_window": 8192
+                "context_window": 8192,
+                "fallback": "llama3-70b-8192",
+                "rpm": 500,
+                "tpm": 10000
             },
         "GPT-3.5 Turbo":
             {
                 "model": "gpt-3.5-turbo",
                 "base_url": "https://api.openai.com/v1",
                 "provider": "openai",
-                "context_window": 16385
+                "context_window": 16385,
+                "fallback": "llama3-70b-8192",
+                "rpm": 3500,
+                "tpm": 60000
             },
         "GPT-3.5 Turbo (Updated)":
             {
                 "model": "gpt-3.5-turbo-0125",
                 "base_url": "https://api.openai.com/v1",
                 "provider": "openai",
-                "context_window": 16385
+                "context_window": 16385,
+                "fallback": "llama3-70b-8192",
+                "rpm": 3500,
+                "tpm": 60000
             }
     }
 
 
+def get_model_details(
+        model: str
+) -> dict:
+    """
+    Get the details of a model by its API name, ex.: 'llama3-8b-8192'
+    :param model:
+    :return:
+    """
+    for details in get_models().values():
+        if details["model"] == model:
+            return details
+    raise KeyError(model)
+
+
 def get_timestamp() -> str:
     """
     Get timestamp string in YYYY-MM-DD_HHMMSS format
@@ -86,36 +145,45 @@ def get_timestamp() -> str:
 
 
 def get_list_of_chats(
-        path: str
+        path: str,
+        limit: int = None
 ) -> list[str]:
     """
-    Get a list of chat files in the directory
+    Get a list of chats in the directory, newest first, from the directory's chat store
     :param path:
+    :param limit: maximum number of chats, None for all of them
     :return:
     """
-    # check if the path exists
-    if not os.path.exists(path):
-        return []
-
     # check if the path is a directory
     if not os.path.isdir(path):
         return []
 
-    # get the list of files in the directory, only with the jsonl extension
-    files = [f for f in os.listdir(path) if f.endswith(".jsonl")]
+    store = get_chat_store(path)
+    return [chat["id"] for chat in store.page(limit=limit if limit is not None else -1)]
+
 
-    # return list of files without extensions and sorted by date, because they are stored
-    # as chat_memory_2024-04-25_084851.jsonl
-    return sorted([f.replace(".jsonl", "") for f in files])
+def get_chat_path(
+        folder: str,
+        chat_id: str
+) -> str:
+    """
+    Get the path of a saved chat from its id, ex.: the .chatz file of a compressed chat
+    :param folder: Folder of the chats
+    :param chat_id: Chat id, see chat_utils.catalog.get_chat_id
+    :return: path to open with load_chat_from_file
+    """
+    return get_chat_store(folder).path(chat_id)
 
 
 def create_chat_button(
         label: str,
         list_of_chats,
-        click_action
+        click_action,
+        description: str = None
 ):
     button = pn.widgets.Button(
         name=label,
+        description=description,
         button_type='light',
         button_style='solid',
         width_policy='max'
@@ -139,49 +207,176 @@ def create_chat_button(
     return button
 
 
+def create_chat_message(
+        message: Dict
+) -> ChatMessage:
+    """
+    Create a ChatMessage for a chat history record
+    :param message:
+    :return:
+    """
+    return ChatMessage(
+        object=message.get("content") or "",
+        user="You" if message["role"] == "user" else "Assistant",
+        avatar=AVATAR_USER if message["role"] == "user" else AVATAR_BOT
+    )
+
+
+def create_load_earlier_message(
+        chat_context: Dict,
+        chat_instance: ChatInterface,
+        page_size: int,
+        render_size: int = HISTORY_RENDER_SIZE
+) -> ChatMessage:
+    button = pn.widgets.Button(
+        name="Load earlier messages",
+        button_type='light',
+        on_click=lambda event: load_earlier_messages(
+            chat_context=chat_context,
+            chat_instance=chat_instance,
+            page_size=page_size,
+            render_size=render_size
+        )
+    )
+    return ChatMessage(object=button, user='System', avatar=AVATAR_SYSTEM, show_reaction_icons=False)
+
+
+def load_earlier_messages(
+        chat_context: Dict,
+        chat_instance: ChatInterface,
+        page_size: int = HISTORY_PAGE_SIZE,
+        render_size: int = HISTORY_RENDER_SIZE
+) -> None:
+    """
+    Render the previous messages of a loaded chat, reading the previous page into the history once every
+    message read so far is rendered
+    :param chat_context:
+    :param chat_instance:
+    :param page_size: number of messages to read
+    :param render_size: number of messages to render
+    :return:
+    """
+    journal = chat_context["chat_journal"]
+    unrendered = chat_context.get("unrendered", 0)
+    if unrendered == 0:
+        # not while save_chat_memory writes the history from a worker thread
+        with chat_context["history_lock"]:
+            records = journal.load_before(page_size)
+            # the history is extended in place, so a reply being streamed still lands in it
+            chat_context["chat_memory"][:0] = records
+        unrendered = len(records)
+
+    start = max(0, unrendered - render_size)
+    objects = [create_chat_message(message) for message in chat_context["chat_memory"][start:unrendered]]
+    chat_context["unrendered"] = start
+    if start > 0 or journal.base > 0:
+        objects.insert(0, create_load_earlier_message(chat_context, chat_instance, page_size, render_size))
+
+    # replace the "load earlier" entry in a single update
+    chat_instance.objects = objects + chat_instance.objects[1:]
+
+
+async def save_chat_memory(
+        chat_context: Dict,
+        chat_journal,
+        chat_memory: List[Dict]
+) -> None:
+    """
+    Write the records added to a chat history to its journal. A chat store, ex.: a key-value server,
+    is written from a worker thread so the event loop keeps serving the other sessions
+    :param chat_context:
+    :param chat_journal: Journal of the chat of the turn, the context may have opened another chat since
+    :param chat_memory: History of the chat of the turn
+    :return: None
+    """
+    if not isinstance(chat_journal, StoreJournal):
+        # a chat file, appending to it takes no time
+        chat_journal.extend(chat_memory)
+        return
+
+    def save():
+        with chat_context["history_lock"]:
+            chat_journal.extend(chat_memory)
+
+    await asyncio.to_thread(save)
+
+
 def load_chat_from_file(
         chat_context: Dict,
         path: str,
-        chat_instance: ChatInterface
+        chat_instance: ChatInterface,
+        page_size: int = HISTORY_PAGE_SIZE,
+        position: int = None,
+        render_size: int = HISTORY_RENDER_SIZE
 ) -> None:
     """
-    Load chat from a file
+    Load chat from a file, or from the chat store of its folder, only the newest page of messages is read and
+    only the newest of them are rendered
     :param chat_context:
     :param chat_instance:
-    :param path:
+    :param path: Path of the chat file, it names the chat in other stores
+    :param page_size: number of messages to read, older ones are read on demand
+    :param position: index of a message to scroll to, ex.: a search result, loaded even if it is older than the page
+    :param render_size: number of messages to render, older ones are rendered on demand
     :return:
     """
     chat_instance.clear()
 
+    close_chat_journal(chat_context)
+
     chat_context["chat_memory"] = []
     chat_context["chat_memory_file"] = path
+    chat_context["chat_journal"] = open_chat_journal(path)
+    chat_context["summary"] = None
+
+    journal = chat_context["chat_journal"]
+    chat_context["chat_memory"] = journal.load_tail(page_size)
+    if position is not None and position < journal.base:
+        chat_context["chat_memory"][:0] = journal.load_before(journal.base - position)
+    # the messages read but not rendered yet, at the start of the history
+    first = len(chat_context["chat_memory"]) - render_size
+    if position is not None:
+        first = min(first, position - journal.base)
+    first = max(0, first)
+    chat_context["unrendered"] = first
 
-    if not os.path.exists(path):
+    if journal.count == 0:
         chat_instance.send("Hello, how can I help you?",
                            user='Assistant',
                            avatar=AVATAR_BOT,
                            respond=False)
     else:
-        with open(path, 'r') as f:
-            for line in f:
-                message = json.loads(line.strip())
-                chat_context["chat_memory"].append(message)
-
-                user = "You" if message["role"] == "user" else "Assistant"
-
-                chat_instance.send(
-                    value=message["content"],
-                    user=user,
-                    avatar=AVATAR_USER if message["role"] == "user" else AVATAR_BOT,
-                    respond=False
-                )
-
-        chat_instance.send(
-            value=f"_Loaded from file: {path}_",
-            user=user,
-            avatar=AVATAR_SYSTEM,
-            respond=False
-        )
+        # the summary of older turns is read back, never recomputed, a rewrite of the chat deletes it
+        summary = load_summary(path)
+        if summary is not None and summary["summarized"] <= journal.count:
+            chat_context["summary"] = summary
+
+        objects = [create_chat_message(message) for message in chat_context["chat_memory"][first:]]
+        if first > 0 or journal.base > 0:
+            objects.insert(0, create_load_earlier_message(chat_context, chat_instance, page_size, render_size))
+        objects.append(ChatMessage(
+            object=f"_Loaded from file: {path}_",
+            user='System',
+            avatar=AVATAR_SYSTEM
+        ))
+
+        # add the whole history in a single update instead of one send per message
+        chat_instance.objects = objects
+        if position is not None:
+            chat_instance.scroll_to(position - journal.base - first + (1 if first > 0 or journal.base > 0 else 0))
+
+
+def close_chat_journal(
+        chat_context: Dict
+) -> None:
+    """
+    Close the journal of the chat context, if any
+    :param chat_context:
+    :return:
+    """
+    journal = chat_context.get("chat_journal")
+    if journal is not None:
+        journal.close()
 
 
 def start_new_chat(
@@ -195,11 +390,17 @@ def start_new_chat(
     """
     chat_instance.clear()
 
-    chat_label = f"chat_memory_{get_timestamp()}"
+    chat_label = new_chat_id()
+
+    close_chat_journal(chat_context)
 
     chat_context["chat_memory"] = []
     chat_context["chat_memory_file"] = f"chats/{chat_label}.jsonl"
+    chat_context["chat_journal"] = open_chat_journal(chat_context["chat_memory_file"])
+    chat_context["summary"] = None
+    chat_context["unrendered"] = 0
 
+    # the chat is added to the store by its first write, a page view without a message leaves nothing behind
     chat_instance.send("Hello, how can I help you?",
                        user='Assistant',
                        avatar=AVATAR_BOT,
@@ -211,7 +412,7 @@ def start_new_chat(
         click_action=lambda
             event: load_chat_from_file(
             chat_context=chat_context,
-            path=f"chats/{event.obj.name}.jsonl",
+            path=get_chat_path("chats", event.obj.name),
             chat_instance=chat_instance)
     )
     list_of_chats.insert(0, button)
@@ -221,4 +422,7 @@ def llamaindex_tool(
         func,
         description: str = None
 ):
+    # llama-index takes seconds to import, only apps that build llama-index tools pay for it
+    from llama_index.core.tools import FunctionTool
+
     return FunctionTool.from_defaults(fn=func, description=description)
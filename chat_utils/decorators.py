@@ -1,6 +1,14 @@
+import copy
+import functools
 import inspect
+import json
+import logging
 from typing import Any, Dict, Annotated
 
+from chat_utils.cache import MemoryCache
+
+logger = logging.getLogger(__name__)
+
 # Mapping Python types to JSON schema types
 TYPE_MAP = {
     str: "string",
@@ -12,9 +20,98 @@ TYPE_MAP = {
 }
 
 
+class ToolCacheInfo:
+    """
+    Hit and miss counters of a cached tool
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"ToolCacheInfo(hits={self.hits}, misses={self.misses})"
+
+
+def _cached(
+        func,
+        signature: inspect.Signature,
+        cache
+):
+    info = ToolCacheInfo()
+
+    def make_key(args, kwargs) -> str:
+        # canonicalize arguments so f(a=1, b=2), f(b=2, a=1) and f(1, 2) share one entry
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return f"{func.__module__}.{func.__qualname__}:" + json.dumps(bound.arguments, sort_keys=True, default=str)
+
+    def store(key: str, value) -> None:
+        # the call already succeeded, a cache that cannot store its result must not turn it into a failure
+        try:
+            cache.set(key, copy.deepcopy(value))
+        except Exception:
+            logger.exception("Could not cache the result of %s", func.__qualname__)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            hit, value = cache.get(key)
+            if hit:
+                info.hits += 1
+                # every caller gets its own copy, changing it does not change later hits
+                return copy.deepcopy(value)
+            info.misses += 1
+            value = await func(*args, **kwargs)
+            store(key, value)
+            return value
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            hit, value = cache.get(key)
+            if hit:
+                info.hits += 1
+                return copy.deepcopy(value)
+            info.misses += 1
+            value = func(*args, **kwargs)
+            store(key, value)
+            return value
+
+    wrapper.cache = cache
+    wrapper.cache_info = lambda: info
+    return wrapper
+
+
 def openai_tool(
-        func
-        ):
+        func=None,
+        *,
+        cache_ttl: float = None,
+        cache_size: int = 128,
+        cache_backend=None,
+        side_effects: bool = False
+):
+    """
+    Describe a function as an OpenAI tool, optionally caching its results.
+    Can be used as @openai_tool or @openai_tool(cache_ttl=60).
+    :param func: Tool function
+    :param cache_ttl: Seconds a result is reused for the same arguments, None disables caching
+    :param cache_size: Maximum number of cached results, least recently used results are evicted first
+    :param cache_backend: Store with get(key) -> (hit, value) and set(key, value), ex.: SQLiteCache,
+        defaults to an in-process MemoryCache
+    :param side_effects: The tool changes something outside (ex.: sends an email), its results are never cached
+    :return: Tool function with a `tool` schema attribute
+    """
+    if func is None:
+        return functools.partial(
+            openai_tool,
+            cache_ttl=cache_ttl,
+            cache_size=cache_size,
+            cache_backend=cache_backend,
+            side_effects=side_effects
+        )
+
     signature = inspect.signature(func)
     parameters = {
         "type": "object",
@@ -33,6 +130,14 @@ def openai_tool(
             }
             parameters["required"].append(name)
 
+    if not side_effects and (cache_ttl is not None or cache_backend is not None):
+        func = _cached(
+            func,
+            signature,
+            cache_backend if cache_backend is not None else MemoryCache(max_entries=cache_size, ttl=cache_ttl)
+        )
+
+    func.side_effects = side_effects
     func.tool = {
         "type": "function",
         "function": {
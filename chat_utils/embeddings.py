@@ -0,0 +1,53 @@
+import hashlib
+import re
+from typing import List
+
+import numpy as np
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    CPU-only text embedder using the hashing trick over word unigrams and bigrams.
+
+    It needs no model download and is good enough to spot near-identical texts. Any callable
+    taking a list of texts and returning an (n, dim) array can be used in its place.
+    """
+
+    def __init__(self, dim: int = 512):
+        """
+        :param dim: Number of dimensions of the embeddings
+        """
+        self.dim = dim
+
+    def _bucket(self, feature: str) -> int:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts
+        :param texts: List of texts
+        :return: float32 array of shape (len(texts), dim), rows normalized to unit length
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORD.findall(text.lower())
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            for feature in features:
+                bucket = self._bucket(feature)
+                # the top bit picks the sign so colliding features tend to cancel out
+                vectors[row, bucket % self.dim] += 1.0 if bucket >> 63 else -1.0
+        return normalize(vectors)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale rows to unit length, leaving zero rows untouched
+    :param vectors: 2D array
+    :return: normalized array
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
@@ -0,0 +1,229 @@
+import asyncio
+import importlib.util
+import os
+import threading
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Set
+
+from chat_utils.metrics import TurnMetrics
+
+# openai and httpx take most of a cold start, they are imported when the first client is created
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI
+    from openai.types.chat import ChatCompletionChunk
+
+
+def get_api_key(
+        provider: str
+) -> str:
+    """
+    Get the API key of a provider from the environment
+    :param provider: Provider name as used in get_models()
+    :return: API key
+    """
+    return os.getenv("GROQ_API_KEY") if provider == "groq" else os.getenv("OPENAI_API_KEY")
+
+
+def get_async_client(
+        provider: str = "groq",
+        base_url: str = None
+) -> "AsyncOpenAI":
+    """
+    Create an AsyncOpenAI client for the given provider
+    :param provider: Provider name as used in get_models()
+    :param base_url: Base URL of the OpenAI compatible API, None to use the client default
+    :return: AsyncOpenAI client
+    """
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=get_api_key(provider), base_url=base_url)
+
+
+class ClientRegistry:
+    """
+    One long-lived AsyncOpenAI client per provider, each with its own HTTP connection pool.
+
+    Sessions share these clients, so switching models never mutates a client another request
+    is using and warm keep-alive connections survive model switches.
+    """
+
+    def __init__(
+            self,
+            max_connections: int = 100,
+            max_keepalive_connections: int = 20,
+            keepalive_expiry: float = 120.0,
+            http2: bool = True
+    ):
+        """
+        :param max_connections: Maximum number of connections per provider
+        :param max_keepalive_connections: Maximum number of idle connections kept per provider
+        :param keepalive_expiry: Seconds an idle connection is kept open
+        :param http2: Use HTTP/2 when the h2 package is installed
+        """
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        # route every provider to this URL instead, ex.: the local server in bench.mock_server
+        self.base_url_override: Optional[str] = None
+        self._clients: Dict[str, "AsyncOpenAI"] = {}
+        self._http_clients: Dict[str, "httpx.AsyncClient"] = {}
+        # the event loop only keeps weak references to tasks, a warm-up in flight is kept here
+        self._warm_ups: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            provider: str,
+            base_url: str = None
+    ) -> "AsyncOpenAI":
+        """
+        Get the client of a provider, creating it on first use
+        :param provider: Provider name as used in get_models()
+        :param base_url: Base URL of the provider API
+        :return: AsyncOpenAI client
+        """
+        with self._lock:
+            client = self._clients.get(provider)
+            if client is None:
+                import httpx
+                from openai import AsyncOpenAI
+
+                http_client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive_connections,
+                        keepalive_expiry=self.keepalive_expiry
+                    ),
+                    http2=self.http2,
+                    timeout=httpx.Timeout(600.0, connect=10.0)
+                )
+                client = AsyncOpenAI(
+                    api_key=get_api_key(provider),
+                    base_url=self.base_url_override or base_url,
+                    http_client=http_client
+                )
+                self._clients[provider] = client
+                self._http_clients[provider] = http_client
+            return client
+
+    async def warm_up(
+            self,
+            provider: str,
+            base_url: str = None
+    ) -> None:
+        """
+        Open a connection to the provider so the next request skips the TCP and TLS handshake
+        :param provider: Provider name as used in get_models()
+        :param base_url: Base URL of the provider API
+        :return: None
+        """
+        import httpx
+
+        client = self.get(provider, base_url)
+        try:
+            # any response will do, the point is to leave an open connection in the pool
+            await self._http_clients[provider].head(str(client.base_url))
+        except httpx.HTTPError:
+            pass
+
+    def prewarm(
+            self,
+            provider: str,
+            base_url: str = None
+    ) -> None:
+        """
+        Schedule warm_up on the running event loop, does nothing outside of one
+        :param provider: Provider name as used in get_models()
+        :param base_url: Base URL of the provider API
+        :return: None
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.warm_up(provider, base_url))
+        self._warm_ups.add(task)
+        task.add_done_callback(self._warm_up_done)
+
+    def _warm_up_done(self, task: asyncio.Task) -> None:
+        self._warm_ups.discard(task)
+        # a warm-up is best effort, its failure is retrieved so it is not reported as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def close(self) -> None:
+        """
+        Close all clients and their connections
+        :return: None
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._http_clients.clear()
+        for client in clients:
+            await client.close()
+
+
+client_registry = ClientRegistry()
+
+
+async def stream_chunks(
+        client: "AsyncOpenAI",
+        model: str,
+        messages: List[Dict],
+        metrics: Optional[TurnMetrics] = None,
+        **kwargs
+) -> AsyncIterator["ChatCompletionChunk"]:
+    """
+    Stream completion chunks without blocking the event loop
+    :param client: AsyncOpenAI client
+    :param model: Model name
+    :param messages: List of chat messages
+    :param metrics: Timings and token usage of the turn are recorded here, if given
+    :param kwargs: Extra arguments for chat.completions.create
+    :return: Async iterator of chunks
+    """
+    if metrics is not None:
+        metrics.request_started()
+        # Groq rejects stream_options, its token counts are estimated by the caller instead
+        if metrics.labels["provider"] == "openai":
+            kwargs.setdefault("stream_options", {"include_usage": True})
+    response = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **kwargs
+    )
+    try:
+        async for chunk in response:
+            if metrics is not None:
+                metrics.chunk_received()
+                if chunk.usage is not None:
+                    metrics.usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            yield chunk
+    finally:
+        await response.close()  # Ensure the stream is properly closed after processing
+
+
+async def stream_text(
+        client: "AsyncOpenAI",
+        model: str,
+        messages: List[Dict],
+        metrics: Optional[TurnMetrics] = None,
+        **kwargs
+) -> AsyncIterator[str]:
+    """
+    Stream the text deltas of a completion, skipping chunks without content
+    :param client: AsyncOpenAI client
+    :param model: Model name
+    :param messages: List of chat messages
+    :param metrics: Timings and token usage of the turn are recorded here, if given
+    :param kwargs: Extra arguments for chat.completions.create
+    :return: Async iterator of text deltas
+    """
+    async for chunk in stream_chunks(client, model, messages, metrics, **kwargs):
+        if chunk.choices:
+            text = chunk.choices[0].delta.content
+            if text:
+                yield text
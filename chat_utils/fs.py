@@ -1,6 +1,12 @@
+import functools
 import json
+import mmap
 import os
-from typing import List, Dict
+import struct
+import time
+import zlib
+from array import array
+from typing import Callable, List, Dict, Optional
 
 
 def prepare_folders(folders: List[str]):
@@ -37,3 +43,629 @@ def load_jsonl(file_path: str) -> List[Dict]:
         for line in f:
             data.append(json.loads(line))
     return data
+
+
+class LineIndex:
+    """
+    Sidecar file with the start offset of every complete line of a jsonl file.
+
+    The index is extended from where it left off, so reading the last lines of a long
+    chat never scans the lines that were already indexed.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: Path to the jsonl file, the index is stored as <file_path>.idx
+        """
+        self.file_path = file_path
+        self.index_path = f"{file_path}.idx"
+
+    def offsets(self) -> array:
+        """
+        Get the start offsets of the complete lines, updating the index file if the jsonl file grew
+        :return: array of offsets, plus the end offset of the last complete line as the last item
+        """
+        size = os.path.getsize(self.file_path)
+
+        offsets = array('Q')
+        stored = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            stored = len(data)
+            # an interrupted append may have left part of an offset
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        if not offsets or offsets[0] != 0:
+            offsets = array('Q', [0])
+            kept = 0
+        else:
+            # the file was rewritten or truncated, drop what no longer fits
+            while len(offsets) > 1 and offsets[-1] > size:
+                offsets.pop()
+            kept = len(offsets)
+
+        end = offsets[-1]
+        if end < size:
+            with open(self.file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                position = mm.find(b'\n', end)
+                while position != -1:
+                    offsets.append(position + 1)
+                    position = mm.find(b'\n', position + 1)
+
+        if stored != kept * offsets.itemsize or len(offsets) > kept:
+            # only the new offsets are written, a turn costs the size of the turn
+            with open(self.index_path, 'ab') as f:
+                if stored != kept * offsets.itemsize:
+                    f.truncate(kept * offsets.itemsize)
+                offsets[kept:].tofile(f)
+
+        return offsets
+
+    def invalidate(self):
+        """
+        Remove the index, for files that were rewritten
+        :return: None
+        """
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+
+def read_jsonl_lines(file_path: str, offsets: array, start: int, stop: int) -> List[Dict]:
+    """
+    Read a range of lines from a jsonl file using a line index
+    :param file_path: Path to the file
+    :param offsets: Line offsets from LineIndex.offsets
+    :param start: Index of the first line
+    :param stop: Index after the last line
+    :return: List of dictionaries
+    """
+    if start >= stop:
+        return []
+    with open(file_path, 'rb') as f:
+        f.seek(offsets[start])
+        block = f.read(offsets[stop] - offsets[start])
+    return [json.loads(line) for line in block.splitlines()]
+
+
+def get_summary_path(
+        chat_file: str
+) -> str:
+    """
+    Get the path of the summary stored next to a chat file, ex.: chats/chat_memory_X.summary.json
+    :param chat_file:
+    :return:
+    """
+    return os.path.splitext(chat_file)[0] + ".summary.json"
+
+
+def load_summary(
+        chat_file: str
+) -> Optional[Dict]:
+    """
+    Load the summary of a chat
+    :param chat_file: Path to the chat file
+    :return: {"summary": text, "summarized": number of leading records folded into it}, None if there is none
+    """
+    try:
+        with open(get_summary_path(chat_file), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_summary(
+        chat_file: str,
+        state: Dict
+) -> None:
+    """
+    Save the summary of a chat, replacing the previous one atomically
+    :param chat_file: Path to the chat file
+    :param state: Summary as returned by load_summary
+    :return: None
+    """
+    path = get_summary_path(chat_file)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def discard_summary(
+        journal: "ChatJournal",
+        records: List[Dict],
+        replaced: bool
+) -> None:
+    """
+    ChatJournal listener deleting the summary of a chat when the chat is rewritten,
+    the records it covers may be gone or different
+    :param journal:
+    :param records:
+    :param replaced:
+    :return: None
+    """
+    if not replaced:
+        return
+    try:
+        os.remove(get_summary_path(journal.file_path))
+    except FileNotFoundError:
+        pass
+
+
+class ChatJournal:
+    """
+    Append-only writer for a chat history stored as jsonl.
+
+    Only records that are not yet on disk are written, so persisting a turn costs
+    the size of the turn instead of the size of the whole history.
+    """
+
+    def __init__(self, file_path: str, fsync_interval: Optional[float] = 1.0):
+        """
+        :param file_path: Path to the jsonl file
+        :param fsync_interval: Minimum number of seconds between two fsync calls, 0 to fsync on every append,
+            None to leave it to the operating system
+        """
+        self.file_path = file_path
+        self.fsync_interval = fsync_interval
+        self.count = 0
+        # number of records on disk before the first record held in memory, see load_tail
+        self.base = 0
+        # free-form details about the chat, ex.: the model in use, available to listeners
+        self.metadata: Dict = {}
+        # called as listener(journal, records, replaced) after records are written,
+        # replaced is True when the journal was rewritten with exactly these records
+        self.listeners: List[Callable[["ChatJournal", List[Dict], bool], None]] = []
+        self._file = None
+        self._offsets = None
+        self._last_fsync = 0.0
+        self._dirty = False
+
+    def load(self) -> List[Dict]:
+        """
+        Load the records from the journal, dropping a torn last line left by an interrupted write
+        :return: List of dictionaries
+        :raises ValueError: if a complete line is not valid JSON, the file is left untouched
+        """
+        data = []
+        if not os.path.exists(self.file_path):
+            self.count = 0
+            return data
+
+        valid_size = 0
+        with open(self.file_path, 'rb') as f:
+            for number, line in enumerate(f, 1):
+                if not line.endswith(b'\n'):
+                    # only the last line can lack its newline
+                    break
+                try:
+                    data.append(json.loads(line))
+                except ValueError as error:
+                    raise ValueError(f"{self.file_path}:{number}: {error}") from None
+                valid_size += len(line)
+
+        if valid_size != os.path.getsize(self.file_path):
+            with open(self.file_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+        self.count = len(data)
+        self.base = 0
+        return data
+
+    def load_tail(self, limit: int) -> List[Dict]:
+        """
+        Load only the newest records through the line index, the journal then treats the
+        in-memory history as starting at `base`
+        :param limit: Maximum number of records
+        :return: List of dictionaries
+        """
+        if not os.path.exists(self.file_path):
+            self.count = self.base = 0
+            return []
+
+        self._recover_tail()
+        self._offsets = LineIndex(self.file_path).offsets()
+        self.count = len(self._offsets) - 1
+        self.base = max(0, self.count - limit)
+        return read_jsonl_lines(self.file_path, self._offsets, self.base, self.count)
+
+    def load_before(self, limit: int) -> List[Dict]:
+        """
+        Load the page of records just before the ones already loaded by load_tail or load_before
+        :param limit: Maximum number of records
+        :return: List of dictionaries, empty when everything is loaded
+        """
+        if self.base == 0:
+            return []
+        start = max(0, self.base - limit)
+        records = read_jsonl_lines(self.file_path, self._offsets, start, self.base)
+        self.base = start
+        return records
+
+    def read(self, start: int, stop: int) -> List[Dict]:
+        """
+        Read a range of the records on disk, without changing what load_tail and load_before loaded
+        :param start: Index of the first record
+        :param stop: Index after the last record
+        :return: List of dictionaries
+        """
+        if not os.path.exists(self.file_path):
+            return []
+        offsets = LineIndex(self.file_path).offsets()
+        return read_jsonl_lines(self.file_path, offsets, start, min(stop, len(offsets) - 1))
+
+    def append(self, records: List[Dict]):
+        """
+        Append records to the end of the journal
+        :param records: List of dictionaries
+        :return: None
+        """
+        if not records:
+            return
+
+        if self._file is None:
+            self._recover_tail()
+            self._file = open(self.file_path, 'a')
+
+        self._file.write(''.join(json.dumps(item) + '\n' for item in records))
+        self._file.flush()
+        self.count += len(records)
+        self._dirty = True
+
+        if self.fsync_interval is not None and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self.sync()
+
+        self._notify(records, False)
+
+    def extend(self, data: List[Dict]):
+        """
+        Persist a chat history, writing only the records added since the last call.
+        If the history became shorter than the journal, the journal is compacted instead.
+        :param data: Full list of dictionaries, or the records from `base` on after load_tail
+        :return: None
+        """
+        if self.base + len(data) < self.count:
+            self.compact(data)
+        else:
+            self.append(data[self.count - self.base:])
+
+    def compact(self, data: List[Dict]):
+        """
+        Atomically rewrite the journal with the given records
+        :param data: List of dictionaries
+        :return: None
+        """
+        self.close()
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for item in data:
+                f.write(json.dumps(item) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        LineIndex(self.file_path).invalidate()
+        self.count = len(data)
+        self.base = 0
+
+        self._notify(data, True)
+
+    def sync(self):
+        """
+        Force written records to disk
+        :return: None
+        """
+        if self._file is not None and self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        """
+        Sync and close the underlying file
+        :return: None
+        """
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def _notify(self, records: List[Dict], replaced: bool):
+        for listener in self.listeners:
+            listener(self, records, replaced)
+
+    def _recover_tail(self):
+        # cut off a torn last line so the next record starts on its own line
+        if not os.path.exists(self.file_path):
+            return
+
+        with open(self.file_path, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                block = f.read(step)
+                index = block.rfind(b'\n')
+                if index != -1:
+                    f.truncate(position + index + 1)
+                    return
+            f.truncate(0)
+
+
+# Compressed chat storage: a header, framed compressed blocks of messages and a footer index
+#
+#   header   CHATZ1 + codec byte
+#   block    <payload length u32><record count u32><payload crc32 u32><compressed JSON rows>
+#   footer   <offset u64><length u32><count u32> per block
+#   trailer  <footer offset u64><block count u32>CHZI
+CHATZ_MAGIC = b"CHATZ1"
+CHATZ_FOOTER_MAGIC = b"CHZI"
+CHATZ_CODECS = {1: "zstd", 2: "zlib"}
+
+_frame = struct.Struct("<III")
+_index_entry = struct.Struct("<QII")
+_trailer = struct.Struct("<QI4s")
+
+
+def _get_codec(codec_id: int):
+    if CHATZ_CODECS[codec_id] == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    return functools.partial(zlib.compress, level=6), zlib.decompress
+
+
+def _default_codec_id() -> int:
+    try:
+        import zstandard  # noqa: F401
+        return 1
+    except ImportError:
+        return 2
+
+
+def _encode_rows(records: List[Dict]) -> bytes:
+    # plain messages are stored as [role, content] so the keys are not repeated on every message
+    rows = [
+        [record["role"], record["content"]] if record.keys() == {"role", "content"} else record
+        for record in records
+    ]
+    return json.dumps(rows, separators=(",", ":")).encode()
+
+
+def _decode_rows(payload: bytes) -> List[Dict]:
+    return [
+        {"role": row[0], "content": row[1]} if isinstance(row, list) else row
+        for row in json.loads(payload)
+    ]
+
+
+class CompressedChatJournal(ChatJournal):
+    """
+    ChatJournal storing the history as compressed blocks, zstd when the zstandard package
+    is installed and zlib otherwise. The footer index lets load_tail read only the last blocks.
+    Appended messages go to a plain jsonl tail, <file_path>.tail, and are compressed into one block
+    once block_size of them are pending, so an append does not rewrite the footer every turn.
+    compact regroups the history into blocks of block_size messages.
+    """
+
+    def __init__(self, file_path: str, fsync_interval: Optional[float] = 1.0, block_size: int = 64):
+        """
+        :param file_path: Path to the .chatz file
+        :param fsync_interval: see ChatJournal
+        :param block_size: Number of messages per block
+        """
+        super().__init__(file_path, fsync_interval)
+        self.block_size = block_size
+        self._codec_id = None
+        self._blocks: Optional[List[tuple]] = None
+        # messages of the tail, not in a block yet, None until the tail is read
+        self._pending: Optional[List[Dict]] = None
+        self._tail = ChatJournal(f"{file_path}.tail", fsync_interval)
+        self._tail_valid = False
+
+    def _read_index(self, f) -> List[tuple]:
+        header = f.read(len(CHATZ_MAGIC) + 1)
+        if header[:len(CHATZ_MAGIC)] != CHATZ_MAGIC:
+            raise ValueError(f"Not a compressed chat file: {self.file_path}")
+        self._codec_id = header[-1]
+
+        size = f.seek(0, os.SEEK_END)
+        if size >= len(header) + _trailer.size:
+            f.seek(size - _trailer.size)
+            footer_offset, block_count, magic = _trailer.unpack(f.read(_trailer.size))
+            if magic == CHATZ_FOOTER_MAGIC and footer_offset + block_count * _index_entry.size + _trailer.size == size:
+                f.seek(footer_offset)
+                footer = f.read(block_count * _index_entry.size)
+                return [entry for entry in _index_entry.iter_unpack(footer)]
+
+        # no valid footer, an append was interrupted: recover the complete blocks
+        blocks = []
+        position = len(header)
+        while position + _frame.size <= size:
+            f.seek(position)
+            length, count, crc = _frame.unpack(f.read(_frame.size))
+            if position + _frame.size + length > size or zlib.crc32(f.read(length)) != crc:
+                break
+            blocks.append((position, length, count))
+            position += _frame.size + length
+        return blocks
+
+    def _index(self) -> List[tuple]:
+        if self._blocks is None:
+            if not os.path.exists(self.file_path):
+                self._blocks = []
+            else:
+                with open(self.file_path, 'rb') as f:
+                    self._blocks = self._read_index(f)
+        return self._blocks
+
+    def _stamp(self) -> Dict:
+        # the first line of the tail names the blocks it follows, the tail of a flushed or compacted
+        # journal left behind by a crash does not match them anymore
+        blocks = self._index()
+        end = blocks[-1][0] + _frame.size + blocks[-1][1] if blocks else 0
+        return {"blocks": len(blocks), "messages": sum(block[2] for block in blocks), "end": end}
+
+    def _pending_records(self) -> List[Dict]:
+        if self._pending is None:
+            records = self._tail.load()
+            self._tail_valid = bool(records) and records[0] == self._stamp()
+            self._pending = records[1:] if self._tail_valid else []
+        return self._pending
+
+    def _read_blocks(self, blocks: List[tuple]) -> List[Dict]:
+        if not blocks:
+            return []
+        _, decompress = _get_codec(self._codec_id)
+        records = []
+        with open(self.file_path, 'rb') as f:
+            for offset, length, count in blocks:
+                f.seek(offset + _frame.size)
+                records.extend(_decode_rows(decompress(f.read(length))))
+        return records
+
+    def _read_range(self, start: int, stop: int) -> List[Dict]:
+        selected = []
+        first = position = 0
+        for block in self._index():
+            block_start, position = position, position + block[2]
+            if position > start and block_start < stop:
+                if not selected:
+                    first = block_start
+                selected.append(block)
+        records = self._read_blocks(selected)
+        if stop > position:
+            # the range reaches into the tail
+            if not selected:
+                first = position
+            records += self._pending_records()
+        return records[start - first:stop - first]
+
+    def read(self, start: int, stop: int) -> List[Dict]:
+        return self._read_range(start, stop)
+
+    def load(self) -> List[Dict]:
+        self._blocks = self._pending = None
+        data = self._read_blocks(self._index()) + self._pending_records()
+        self.count = len(data)
+        self.base = 0
+        return data
+
+    def load_tail(self, limit: int) -> List[Dict]:
+        self._blocks = self._pending = None
+        self.count = sum(block[2] for block in self._index()) + len(self._pending_records())
+        self.base = max(0, self.count - limit)
+        return self._read_range(self.base, self.count)
+
+    def load_before(self, limit: int) -> List[Dict]:
+        if self.base == 0:
+            return []
+        start = max(0, self.base - limit)
+        records = self._read_range(start, self.base)
+        self.base = start
+        return records
+
+    def _write_blocks(self, f, position: int, chunks: List[List[Dict]]):
+        compress, _ = _get_codec(self._codec_id)
+        f.seek(position)
+        for chunk in chunks:
+            payload = compress(_encode_rows(chunk))
+            f.write(_frame.pack(len(payload), len(chunk), zlib.crc32(payload)))
+            f.write(payload)
+            self._blocks.append((position, len(payload), len(chunk)))
+            position += _frame.size + len(payload)
+
+        for entry in self._blocks:
+            f.write(_index_entry.pack(*entry))
+        f.write(_trailer.pack(position, len(self._blocks), CHATZ_FOOTER_MAGIC))
+        f.truncate()
+        f.flush()
+
+    def append(self, records: List[Dict]):
+        if not records:
+            return
+
+        pending = self._pending_records()
+        if not self._tail_valid:
+            self._tail.compact([self._stamp()])
+            self._tail_valid = True
+        self._tail.append(records)
+        pending.extend(records)
+        self.count += len(records)
+
+        if len(pending) >= self.block_size:
+            self._flush()
+
+        self._notify(records, False)
+
+    def _flush(self):
+        # compress the pending messages into a block, the tail is only removed once the block is on disk
+        blocks = self._index()
+        exists = os.path.exists(self.file_path)
+        with open(self.file_path, 'r+b' if exists else 'w+b') as f:
+            if not exists:
+                self._codec_id = _default_codec_id()
+                f.write(CHATZ_MAGIC + bytes([self._codec_id]))
+            # the new block overwrites the old footer, which is written again after it
+            position = blocks[-1][0] + _frame.size + blocks[-1][1] if blocks else len(CHATZ_MAGIC) + 1
+            self._write_blocks(f, position, [self._pending])
+            os.fsync(f.fileno())
+
+        self._remove_tail()
+
+    def _remove_tail(self):
+        self._tail.close()
+        if os.path.exists(self._tail.file_path):
+            os.remove(self._tail.file_path)
+        self._pending = []
+        self._tail_valid = False
+
+    def compact(self, data: List[Dict]):
+        tmp_path = f"{self.file_path}.tmp"
+        if self._codec_id is None:
+            self._codec_id = _default_codec_id()
+        self._blocks = []
+        with open(tmp_path, 'w+b') as f:
+            f.write(CHATZ_MAGIC + bytes([self._codec_id]))
+            chunks = [data[i:i + self.block_size] for i in range(0, len(data), self.block_size)]
+            self._write_blocks(f, len(CHATZ_MAGIC) + 1, chunks)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        # a crash before the tail is removed leaves a tail whose stamp no longer matches the blocks
+        self._remove_tail()
+        self.count = len(data)
+        self.base = 0
+
+        self._notify(data, True)
+
+    def sync(self):
+        self._tail.sync()
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        self._tail.close()
+
+
+def jsonl_to_chatz(src_path: str, dst_path: str, block_size: int = 64):
+    """
+    Convert a jsonl chat file to the compressed format
+    :param src_path: Path to the jsonl file
+    :param dst_path: Path to the .chatz file
+    :param block_size: Number of messages per block
+    :return: None
+    """
+    CompressedChatJournal(dst_path, block_size=block_size).compact(ChatJournal(src_path).load())
+
+
+def chatz_to_jsonl(src_path: str, dst_path: str):
+    """
+    Convert a compressed chat file back to jsonl
+    :param src_path: Path to the .chatz file
+    :param dst_path: Path to the jsonl file
+    :return: None
+    """
+    ChatJournal(dst_path).compact(CompressedChatJournal(src_path).load())
@@ -0,0 +1,241 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 131072)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    Prometheus style histogram with labels
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # per bucket counts, then +Inf count and sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """
+    Prometheus style counter with labels
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labelnames, key))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return "\n".join(lines)
+
+
+class Gauge(Counter):
+    """
+    Prometheus style gauge with labels
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+LABELS = ("provider", "model")
+
+METRICS = {
+    "ttft": Histogram("chat_time_to_first_token_seconds", "Time from request start to the first chunk", LABELS,
+                      LATENCY_BUCKETS),
+    "gap": Histogram("chat_inter_chunk_seconds", "Time between two streamed chunks", LABELS, LATENCY_BUCKETS),
+    "duration": Histogram("chat_request_duration_seconds", "Time from request start to the end of the stream",
+                          LABELS, LATENCY_BUCKETS),
+    "prompt_tokens": Histogram("chat_prompt_tokens", "Prompt tokens per request", LABELS, TOKEN_BUCKETS),
+    "completion_tokens": Histogram("chat_completion_tokens", "Completion tokens per request", LABELS, TOKEN_BUCKETS),
+    "tools": Histogram("chat_tool_execution_seconds", "Time spent running the tool calls of a turn", LABELS,
+                       LATENCY_BUCKETS),
+    "save": Histogram("chat_save_seconds", "Time spent saving a turn to disk", LABELS, LATENCY_BUCKETS),
+    "turns": Counter("chat_turns_total", "Completed turns", LABELS + ("cached",)),
+    "failovers": Counter("chat_failovers_total", "Backup requests sent by the router, by the backup model",
+                         LABELS + ("reason",)),
+    "queue_depth": Gauge("chat_queue_depth", "Requests waiting for the rate limits of a model", LABELS),
+    "queue_wait": Histogram("chat_queue_wait_seconds", "Time a request waited for the rate limits of a model",
+                            LABELS + ("priority",), LATENCY_BUCKETS),
+}
+
+
+def render_metrics() -> str:
+    """
+    Render all metrics in the Prometheus text format
+    :return:
+    """
+    return "\n".join(metric.render() for metric in METRICS.values()) + "\n"
+
+
+class TurnMetrics:
+    """
+    Timings and token counts of one turn, recorded into METRICS when the turn finishes
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.labels = {"provider": provider, "model": model}
+        self.started: Optional[float] = None
+        self.requested: Optional[float] = None
+        self.first_chunk: Optional[float] = None
+        self.last_chunk: Optional[float] = None
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.cached = False
+
+    def request_started(self) -> None:
+        # a turn with tool calls makes several requests, the turn starts with the first one
+        self.requested = time.perf_counter()
+        if self.started is None:
+            self.started = self.requested
+
+    def chunk_received(self) -> None:
+        now = time.perf_counter()
+        if self.first_chunk is None:
+            self.first_chunk = now
+            METRICS["ttft"].observe(now - self.started, **self.labels)
+        elif self.last_chunk > self.requested:
+            # the wait for a follow-up request, ex.: after tool calls, is not a gap
+            METRICS["gap"].observe(now - self.last_chunk, **self.labels)
+        self.last_chunk = now
+
+    def usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.prompt_tokens = (self.prompt_tokens or 0) + prompt_tokens
+        self.completion_tokens = (self.completion_tokens or 0) + completion_tokens
+
+    @contextmanager
+    def tool_execution(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            METRICS["tools"].observe(time.perf_counter() - start, **self.labels)
+
+    @contextmanager
+    def saving(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            METRICS["save"].observe(time.perf_counter() - start, **self.labels)
+
+    def finish(self, prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None) -> None:
+        """
+        Record the turn
+        :param prompt_tokens: estimate used when the provider did not report usage
+        :param completion_tokens: estimate used when the provider did not report usage
+        :return: None
+        """
+        if self.started is None:
+            return
+        METRICS["duration"].observe((self.last_chunk or time.perf_counter()) - self.started, **self.labels)
+        prompt = self.prompt_tokens if self.prompt_tokens is not None else prompt_tokens
+        completion = self.completion_tokens if self.completion_tokens is not None else completion_tokens
+        if prompt is not None:
+            METRICS["prompt_tokens"].observe(prompt, **self.labels)
+        if completion is not None:
+            METRICS["completion_tokens"].observe(completion, **self.labels)
+        METRICS["turns"].inc(cached=str(self.cached).lower(), **self.labels)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = None, host: str = None) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve /metrics in a background thread, once per process.
+    When the port is taken, ex.: by another worker process, no server is started and a warning is logged.
+    :param port: Port, defaults to the METRICS_PORT environment variable or 9464
+    :param host: Interface to listen on, defaults to the METRICS_HOST environment variable or 127.0.0.1,
+        0.0.0.0 exposes the metrics on every interface
+    :return: the server, None if it could not be started
+    """
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_metrics().encode()
+                self.send_response(200)
+                self.send_header("content-type", "text/plain; version=0.0.4")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        address = (host or os.getenv("METRICS_HOST", "127.0.0.1"), port or int(os.getenv("METRICS_PORT", "9464")))
+        try:
+            _server = ThreadingHTTPServer(address, Handler)
+        except OSError as error:
+            logger.warning("Metrics are not served by process %d, cannot listen on %s:%d: %s",
+                           os.getpid(), *address, error)
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True, name="metrics").start()
+        return _server
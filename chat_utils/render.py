@@ -0,0 +1,109 @@
+import asyncio
+import time
+from typing import AsyncIterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class StreamRenderer:
+    """
+    Coalesce streamed text deltas into a bounded number of UI updates.
+
+    Deltas are collected in a list buffer and only joined into the reply when an update
+    is due, either because `1 / fps` seconds have passed since the last one or because
+    `flush_size` characters are pending. While the stream is silent, pending text is still
+    shown once `1 / fps` seconds have passed, see pace.
+    """
+
+    def __init__(self, fps: float = 15.0, flush_size: int = 512):
+        """
+        :param fps: Maximum number of UI updates per second
+        :param flush_size: Number of pending characters that forces an update regardless of fps
+        """
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.flush_size = flush_size
+        self._text = ""
+        self._pending: List[str] = []
+        self._pending_size = 0
+        self._last_flush = 0.0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    @property
+    def value(self) -> str:
+        """
+        Full reply collected so far, including pending deltas
+        :return: reply text
+        """
+        if self._pending:
+            self._text += "".join(self._pending)
+            self._pending.clear()
+            self._pending_size = 0
+        return self._text
+
+    def feed(self, delta: str) -> bool:
+        """
+        Add a delta to the buffer
+        :param delta: Text delta, empty deltas are ignored
+        :return: True if the UI should be updated with `value`
+        """
+        if not delta:
+            return False
+
+        self._pending.append(delta)
+        self._pending_size += len(delta)
+
+        now = time.monotonic()
+        if self._pending_size >= self.flush_size or now - self._last_flush >= self.interval:
+            self._last_flush = now
+            return True
+        return False
+
+    def _due(self) -> Optional[float]:
+        # seconds until the pending text is shown, None when nothing is pending
+        if not self._pending:
+            return None
+        return max(0.0, self._last_flush + self.interval - time.monotonic())
+
+    async def pace(self, items: AsyncIterator[T]) -> AsyncIterator[Optional[T]]:
+        """
+        Iterate over a stream, yielding None when pending text is due while the stream is silent,
+        ex.: after a delta smaller than flush_size was held back and no other one follows
+        :param items: Async iterator, ex.: of text deltas or completion chunks
+        :return: Async iterator of the same items, None meaning the UI should be updated with `value`
+        """
+        iterator = items.__aiter__()
+        step = None
+        try:
+            while True:
+                if step is None:
+                    step = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({step}, timeout=self._due())
+                if not done:
+                    self._last_flush = time.monotonic()
+                    yield None
+                    continue
+                try:
+                    item = step.result()
+                except StopAsyncIteration:
+                    break
+                step = None
+                yield item
+        finally:
+            if step is not None and not step.done():
+                step.cancel()
+                await asyncio.gather(step, return_exceptions=True)
+
+    async def render(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Throttle a stream of deltas into a stream of reply snapshots
+        :param deltas: Async iterator of text deltas
+        :return: Async iterator of the accumulated reply, the last item is always the full reply
+        """
+        async for delta in self.pace(deltas):
+            if delta is None or self.feed(delta):
+                yield self.value
+        if self._pending:
+            yield self.value
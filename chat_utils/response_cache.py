@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from chat_utils.cache import MemoryCache
+from chat_utils.engine import stream_text
+from chat_utils.metrics import TurnMetrics
+
+
+# Arguments of chat.completions.create that do not change the reply, the others are part of the key
+NEUTRAL_ARGUMENTS = ("stream_options", "timeout", "extra_headers", "extra_query", "user")
+
+
+def _canonical(messages: List[Dict]) -> List[Dict]:
+    return [
+        {**message, "content": message["content"].strip()} if isinstance(message.get("content"), str) else message
+        for message in messages
+    ]
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of complete replies in front of chat.completions.
+
+    Replies are looked up by a hash of (model, messages, tools, options), the options being the other
+    arguments of the request, ex.: temperature or max_tokens. When an embedder is given, a miss falls
+    back to a semantic lookup: the last user message is compared by cosine similarity against cached
+    questions asked after the same earlier conversation with the same options.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            ttl: Optional[float] = 3600.0,
+            embedder: Optional[Callable] = None,
+            similarity: float = 0.95,
+            replay_chunk_size: int = 24
+    ):
+        """
+        :param max_entries: Maximum number of cached replies, least recently used replies are evicted first
+        :param ttl: Seconds a reply stays valid, None for no expiry
+        :param embedder: Callable embedding a list of texts into unit vectors, ex.: HashingEmbedder(), None
+            to only use exact matches
+        :param similarity: Minimum cosine similarity for a semantic hit
+        :param replay_chunk_size: Number of characters per chunk when a cached reply is replayed
+        """
+        self.store = MemoryCache(max_entries=max_entries, ttl=ttl, on_evict=self._forget)
+        self.embedder = embedder
+        self.similarity = similarity
+        self.replay_chunk_size = replay_chunk_size
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        # prefix digest -> (vectors, keys) of the questions cached after that prefix
+        self._semantic: Dict[str, tuple] = {}
+        # key -> prefix digest, to drop a question from its bucket when the store evicts its reply
+        self._buckets: Dict[str, str] = {}
+        # reentrant, the store may evict while put holds it
+        self._lock = threading.RLock()
+
+    def key(
+            self,
+            model: str,
+            messages: List[Dict],
+            tools: Optional[List[Dict]] = None,
+            options: Optional[Dict] = None
+    ) -> str:
+        """
+        Get the exact-match key of a request
+        :param model: Model name
+        :param messages: Messages as sent to the model
+        :param tools: Tools as sent to the model
+        :param options: Other arguments of the request that change the reply, ex.: {"temperature": 0}
+        :return: hex digest
+        """
+        return _digest([model, _canonical(messages), tools, options or {}])
+
+    def _semantic_bucket(self, model, messages, tools, options) -> Optional[str]:
+        if self.embedder is None or not messages or messages[-1].get("role") != "user":
+            return None
+        return _digest([model, _canonical(messages[:-1]), tools, options or {}])
+
+    def lookup(
+            self,
+            model: str,
+            messages: List[Dict],
+            tools: Optional[List[Dict]] = None,
+            options: Optional[Dict] = None
+    ) -> Optional[str]:
+        """
+        Look up a cached reply
+        :param model: Model name
+        :param messages: Messages as sent to the model
+        :param tools: Tools as sent to the model
+        :param options: Other arguments of the request that change the reply, ex.: {"temperature": 0}
+        :return: reply, None on a miss
+        """
+        hit, reply = self.store.get(self.key(model, messages, tools, options))
+        if hit:
+            self.hits += 1
+            return reply
+
+        bucket = self._semantic_bucket(model, messages, tools, options)
+        if bucket is not None:
+            with self._lock:
+                entry = self._semantic.get(bucket)
+            if entry is not None:
+                vectors, keys = entry
+                query = self.embedder([messages[-1]["content"].strip()])[0]
+                scores = vectors @ query
+                best = int(scores.argmax())
+                if scores[best] >= self.similarity:
+                    hit, reply = self.store.get(keys[best])
+                    if hit:
+                        self.semantic_hits += 1
+                        return reply
+
+        self.misses += 1
+        return None
+
+    def put(
+            self,
+            model: str,
+            messages: List[Dict],
+            reply: str,
+            tools: Optional[List[Dict]] = None,
+            options: Optional[Dict] = None
+    ) -> None:
+        """
+        Cache a complete reply
+        :param model: Model name
+        :param messages: Messages as sent to the model
+        :param reply: Reply text
+        :param tools: Tools as sent to the model
+        :param options: Other arguments of the request that change the reply, ex.: {"temperature": 0}
+        :return: None
+        """
+        key = self.key(model, messages, tools, options)
+        self.store.set(key, reply)
+
+        bucket = self._semantic_bucket(model, messages, tools, options)
+        if bucket is None:
+            return
+
+        import numpy as np
+
+        vector = self.embedder([messages[-1]["content"].strip()])
+        with self._lock:
+            if key in self._buckets or not self.store.get(key)[0]:
+                # already in the bucket, or evicted again at once
+                return
+            vectors, keys = self._semantic.get(bucket, (None, []))
+            vectors = vector if vectors is None else np.vstack([vectors, vector])
+            self._semantic[bucket] = (vectors, keys + [key])
+            self._buckets[key] = bucket
+
+    def _forget(self, key: str) -> None:
+        # the store evicted or expired a reply: drop its question, and its bucket once empty
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                return
+            vectors, keys = self._semantic[bucket]
+            index = keys.index(key)
+            if len(keys) == 1:
+                del self._semantic[bucket]
+            else:
+                keys = keys[:index] + keys[index + 1:]
+                self._semantic[bucket] = (vectors[[i for i in range(len(vectors)) if i != index]], keys)
+
+    async def replay(self, reply: str) -> AsyncIterator[str]:
+        """
+        Replay a cached reply as a stream of deltas
+        :param reply: Reply text
+        :return: Async iterator of text deltas
+        """
+        for start in range(0, len(reply), self.replay_chunk_size):
+            yield reply[start:start + self.replay_chunk_size]
+            await asyncio.sleep(0)
+
+    @staticmethod
+    def _options(kwargs: Dict) -> tuple:
+        # ex.: a reply cut by max_tokens or sampled at another temperature is not the same reply
+        options = {name: value for name, value in kwargs.items() if name != "tools" and name not in NEUTRAL_ARGUMENTS}
+        return kwargs.get("tools"), options
+
+    def cached(
+            self,
+            model: str,
+            messages: List[Dict],
+            metrics: Optional[TurnMetrics] = None,
+            **kwargs
+    ) -> Optional[AsyncIterator[str]]:
+        """
+        Look up the reply of a request before it is queued or sent
+        :param model: Model name
+        :param messages: List of chat messages
+        :param metrics: Timings of the turn are recorded here while the reply is replayed, if given
+        :param kwargs: Extra arguments for chat.completions.create
+        :return: Async iterator of the text deltas of the cached reply, None on a miss
+        """
+        tools, options = self._options(kwargs)
+        reply = self.lookup(model, messages, tools, options)
+        if reply is None:
+            return None
+
+        async def deltas():
+            if metrics is not None:
+                metrics.cached = True
+                metrics.request_started()
+            async for delta in self.replay(reply):
+                if metrics is not None:
+                    metrics.chunk_received()
+                yield delta
+
+        return deltas()
+
+    async def fetch(
+            self,
+            client,
+            model: str,
+            messages: List[Dict],
+            metrics: Optional[TurnMetrics] = None,
+            stream: Callable[..., AsyncIterator[str]] = stream_text,
+            **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Stream the reply of a request that missed the cache, and cache it once complete.
+
+        The reply is cached under the model that answered, as labelled in `metrics` by
+        chat_utils.routing.provider_router, so a fallback model's reply is never served for the primary model.
+        :param client: AsyncOpenAI client
+        :param model: Model name
+        :param messages: List of chat messages
+        :param metrics: Timings and token usage of the turn are recorded here, if given
+        :param stream: Streams the reply, ex.: chat_utils.routing.provider_router.stream_text
+        :param kwargs: Extra arguments for chat.completions.create
+        :return: Async iterator of text deltas
+        """
+        tools, options = self._options(kwargs)
+        parts = []
+        async for delta in stream(client, model, messages, metrics, **kwargs):
+            parts.append(delta)
+            yield delta
+
+        # only complete replies get here, an interrupted stream is never cached
+        if parts:
+            answered = metrics.labels["model"] if metrics is not None else model
+            self.put(answered, messages, "".join(parts), tools, options)
+
+    async def stream_text(
+            self,
+            client,
+            model: str,
+            messages: List[Dict],
+            metrics: Optional[TurnMetrics] = None,
+            stream: Callable[..., AsyncIterator[str]] = stream_text,
+            **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Drop-in replacement for chat_utils.engine.stream_text that serves cached replies without a request
+        :param client: AsyncOpenAI client
+        :param model: Model name
+        :param messages: List of chat messages
+        :param metrics: Timings and token usage of the turn are recorded here, if given
+        :param stream: Streams the reply on a cache miss, ex.: chat_utils.routing.provider_router.stream_text
+        :param kwargs: Extra arguments for chat.completions.create
+        :return: Async iterator of text deltas
+        """
+        deltas = self.cached(model, messages, metrics, **kwargs)
+        if deltas is None:
+            deltas = self.fetch(client, model, messages, metrics, stream, **kwargs)
+        async for delta in deltas:
+            yield delta
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,265 @@
+import asyncio
+import random
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+
+from chat_utils.context import ContextWindow
+from chat_utils.core import get_model_details
+from chat_utils.engine import client_registry, get_api_key, stream_text
+from chat_utils.metrics import METRICS, TurnMetrics
+from chat_utils.scheduler import request_scheduler
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# Statuses worth sending again, to the same or to the other provider
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable(
+        error: BaseException
+) -> bool:
+    """
+    Check whether a failed request may succeed when sent again, ex.: rate limits, server errors and timeouts
+    :param error: Exception raised by the OpenAI client
+    :return:
+    """
+    import openai
+
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, openai.APIStatusError) and (
+            error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    )
+
+
+def get_retry_after(
+        error: BaseException
+) -> Optional[float]:
+    """
+    Get the delay a provider asked for in the Retry-After header of an error response
+    :param error: Exception raised by the OpenAI client
+    :return: Seconds, None if the provider did not say
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AttemptUsage:
+    """
+    Stands in for TurnMetrics in the request of one candidate model: chat_utils.engine.stream_chunks asks
+    the provider for the token usage and records it here, the timings are recorded by the router for the turn
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.labels = {"provider": provider, "model": model}
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+
+    def request_started(self) -> None:
+        pass
+
+    def chunk_received(self) -> None:
+        pass
+
+    def usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.prompt_tokens = (self.prompt_tokens or 0) + prompt_tokens
+        self.completion_tokens = (self.completion_tokens or 0) + completion_tokens
+
+
+class ProviderRouter:
+    """
+    Drop-in replacement for chat_utils.engine.stream_text that hedges and fails over to the
+    "fallback" model of get_models().
+
+    When the primary model has not produced a first token after `hedge_delay` seconds, the same
+    request is sent to the fallback model, whichever answers first is streamed and the other is
+    cancelled. A rate limited or failing request fails over to the fallback at once, and when every
+    model failed the round is repeated after a capped exponential backoff.
+    """
+
+    def __init__(
+            self,
+            hedge_delay: Optional[float] = 2.0,
+            max_attempts: int = 3,
+            backoff: float = 0.5,
+            max_backoff: float = 8.0
+    ):
+        """
+        :param hedge_delay: Seconds without a first token before the fallback is asked too, None to never hedge
+        :param max_attempts: Rounds over the primary and fallback models before giving up
+        :param backoff: Delay before the second round, doubled for every further round
+        :param max_backoff: Upper bound of a delay, also applied to Retry-After
+        """
+        self.hedge_delay = hedge_delay
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.context_window = ContextWindow()
+
+    def candidates(
+            self,
+            client: "AsyncOpenAI",
+            model: str
+    ) -> List[Tuple["AsyncOpenAI", Dict]]:
+        """
+        Get the clients and details of the models to try, the primary model first
+        :param client: Client of the primary model
+        :param model: Primary model name
+        :return:
+        """
+        # the router does its own retries, the client's would delay the fail over
+        try:
+            details = get_model_details(model)
+        except KeyError:
+            return [(client.with_options(max_retries=0), {"model": model, "provider": "unknown"})]
+
+        candidates = [(client.with_options(max_retries=0), details)]
+        if details.get("fallback"):
+            fallback = get_model_details(details["fallback"])
+            # a provider without an API key cannot be a fallback
+            if get_api_key(fallback["provider"]):
+                fallback_client = client_registry.get(fallback["provider"], fallback["base_url"])
+                candidates.append((fallback_client.with_options(max_retries=0), fallback))
+        return candidates
+
+    def get_delay(
+            self,
+            attempt: int,
+            error: Optional[BaseException]
+    ) -> float:
+        """
+        Get the backoff before a round
+        :param attempt: Number of the round, 1 for the first repeated one
+        :param error: Last error of the previous round
+        :return: Seconds
+        """
+        delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+        retry_after = get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.max_backoff)
+
+    @staticmethod
+    async def _first_delta(
+            client: "AsyncOpenAI",
+            details: Dict,
+            messages: List[Dict],
+            kwargs: Dict
+    ) -> Tuple[str, AsyncIterator[str], AttemptUsage]:
+        usage = AttemptUsage(details["provider"], details["model"])
+        deltas = stream_text(client, details["model"], messages, usage, **kwargs)
+        try:
+            return await deltas.__anext__(), deltas, usage
+        except StopAsyncIteration:
+            return "", deltas, usage
+        except BaseException:
+            # cancelled or failed, the request is closed before the exception leaves
+            await deltas.aclose()
+            raise
+
+    async def _race(
+            self,
+            candidates: List[Tuple["AsyncOpenAI", Dict]],
+            messages: List[Dict],
+            kwargs: Dict
+    ) -> Tuple[str, AsyncIterator[str], AttemptUsage, Dict]:
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(self.get_delay(attempt, last_error))
+
+            waiting = list(candidates)
+            pending = {}
+
+            def launch(reason: Optional[str]):
+                # send the request to the first waiting candidate within its limits, if any
+                while waiting:
+                    client, details = waiting.pop(0)
+                    selected = messages
+                    if details is not candidates[0][1] and "context_window" in details:
+                        # the fallback may have a smaller context window than the primary model
+                        selected = self.context_window.select(messages, details["context_window"])
+                    if reason is not None:
+                        # the caller queued for the first request, a backup over its model's limits would only
+                        # get a 429, the next candidate is asked instead
+                        if not request_scheduler.try_acquire(details, self.context_window.count(selected)):
+                            continue
+                        METRICS["failovers"].inc(provider=details["provider"], model=details["model"], reason=reason)
+                    task = asyncio.ensure_future(self._first_delta(client, details, selected, kwargs))
+                    pending[task] = details
+                    return
+
+            launch(None if attempt == 0 else "retry")
+            try:
+                while pending:
+                    hedge = self.hedge_delay if waiting else None
+                    done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        launch("hedge")
+                        continue
+                    for task in done:
+                        details = pending.pop(task)
+                        error = task.exception()
+                        if error is None:
+                            first, deltas, usage = task.result()
+                            return first, deltas, usage, details
+                        if not is_retryable(error):
+                            raise error
+                        last_error = error
+                        if waiting:
+                            launch("error")
+            finally:
+                # cancel the losers, their requests are closed by _first_delta
+                for task in pending:
+                    task.cancel()
+                for result in await asyncio.gather(*pending, return_exceptions=True):
+                    # a loser that got its first token in the same instant as the winner
+                    if isinstance(result, tuple):
+                        await result[1].aclose()
+        raise last_error
+
+    async def stream_text(
+            self,
+            client: "AsyncOpenAI",
+            model: str,
+            messages: List[Dict],
+            metrics: Optional[TurnMetrics] = None,
+            **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Stream the text deltas of a completion from the primary or the fallback model
+        :param client: AsyncOpenAI client of the primary model
+        :param model: Primary model name
+        :param messages: List of chat messages, selected for the primary model's context window
+        :param metrics: Timings and token usage of the turn are recorded here, labelled with the model that answered
+        :param kwargs: Extra arguments for chat.completions.create
+        :return: Async iterator of text deltas
+        """
+        if metrics is not None:
+            metrics.request_started()
+
+        first, deltas, usage, details = await self._race(self.candidates(client, model), messages, kwargs)
+        try:
+            if metrics is not None:
+                metrics.labels = {"provider": details["provider"], "model": details["model"]}
+            if first:
+                if metrics is not None:
+                    metrics.chunk_received()
+                yield first
+            async for delta in deltas:
+                if metrics is not None:
+                    metrics.chunk_received()
+                yield delta
+        finally:
+            await deltas.aclose()
+            # the usage of the request that answered, reported in its last chunk
+            if metrics is not None and usage.prompt_tokens is not None:
+                metrics.usage(usage.prompt_tokens, usage.completion_tokens)
+
+
+provider_router = ProviderRouter()
@@ -0,0 +1,219 @@
+import asyncio
+import itertools
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from chat_utils.metrics import METRICS
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per minute rate, holding at most one minute of tokens
+    """
+
+    def __init__(self, rate_per_minute: float):
+        """
+        :param rate_per_minute: Tokens added per minute, also the capacity of the bucket
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """
+        Get the time until the bucket holds an amount of tokens
+        :param amount: Tokens needed, capped to the capacity so a large request still goes through eventually
+        :return: Seconds, 0 if the tokens are available now
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("session", "priority", "tokens", "tag", "seq", "position", "granted", "changed", "enqueued")
+
+    def __init__(self, session: str, priority: int, tokens: int, tag: float, seq: int):
+        self.session = session
+        self.priority = priority
+        self.tokens = tokens
+        self.tag = tag
+        self.seq = seq
+        self.position: Optional[int] = None
+        self.granted = False
+        self.changed = asyncio.Event()
+        self.enqueued = time.perf_counter()
+
+    def order(self) -> Tuple:
+        return -self.priority, self.tag, self.seq
+
+
+class RateLimiter:
+    """
+    Requests per minute and tokens per minute limits of one model, with a fair queue.
+
+    Waiting requests are served by priority, then round-robin across sessions: each request gets
+    a virtual finish tag one past the later of its session's previous tag and the tag of the last
+    request served, so a session queueing many requests cannot starve the others.
+    """
+
+    def __init__(self, provider: str, model: str, rpm: float, tpm: float):
+        self.labels = {"provider": provider, "model": model}
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.waiters: List[_Waiter] = []
+        self._tags: Dict[str, float] = {}
+        self._virtual = 0.0
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump: Optional[asyncio.Task] = None
+
+    def delay(self, tokens: int) -> float:
+        return max(self.requests.delay(1), self.tokens.delay(tokens))
+
+    def _take(self, tokens: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def try_acquire(self, tokens: int) -> bool:
+        """
+        Take a request and its tokens if they are available now and nobody is waiting
+        :param tokens: Estimated prompt tokens
+        :return: whether the request may be sent
+        """
+        if self.waiters or self.delay(tokens) > 0:
+            return False
+        self._take(tokens)
+        return True
+
+    def _update(self) -> None:
+        for position, waiter in enumerate(self.waiters, 1):
+            if waiter.position != position:
+                waiter.position = position
+                waiter.changed.set()
+        METRICS["queue_depth"].set(len(self.waiters), **self.labels)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _serve(self) -> None:
+        try:
+            while self.waiters:
+                head = self.waiters[0]
+                delay = self.delay(head.tokens)
+                if delay > 0:
+                    # woken early when the queue changes, ex.: a request with a higher priority arrived
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.waiters.pop(0)
+                self._take(head.tokens)
+                self._virtual = head.tag
+                if self._tags.get(head.session) == head.tag:
+                    del self._tags[head.session]
+                head.granted = True
+                head.changed.set()
+                self._update()
+        finally:
+            self._pump = None
+
+    async def queue(self, tokens: int, session: str = "", priority: int = 0) -> AsyncIterator[int]:
+        """
+        Wait for the limits, yielding the position in the queue whenever it changes.
+        The iteration ends when the request may be sent, at once if the limits allow it.
+        :param tokens: Estimated prompt tokens
+        :param session: Session the request belongs to, sessions are served round-robin
+        :param priority: Requests with a higher priority are served first
+        :return: Async iterator of 1-based queue positions
+        """
+        if self.try_acquire(tokens):
+            METRICS["queue_wait"].observe(0.0, priority=priority, **self.labels)
+            return
+
+        tag = max(self._virtual, self._tags.get(session, 0.0)) + 1
+        self._tags[session] = tag
+        waiter = _Waiter(session, priority, tokens, tag, next(self._seq))
+        self.waiters.append(waiter)
+        self.waiters.sort(key=_Waiter.order)
+        if self._pump is None:
+            self._wakeup = asyncio.Event()
+            self._pump = asyncio.ensure_future(self._serve())
+        self._update()
+        waiter.changed.clear()
+
+        try:
+            while not waiter.granted:
+                yield waiter.position
+                await waiter.changed.wait()
+                waiter.changed.clear()
+            METRICS["queue_wait"].observe(time.perf_counter() - waiter.enqueued, priority=priority, **self.labels)
+        finally:
+            # given up, ex.: the turn was cancelled, make room for the next request
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+                self._update()
+
+
+class RequestScheduler:
+    """
+    One RateLimiter per model of get_models() that has "rpm" and "tpm" limits
+    """
+
+    def __init__(self):
+        self._limiters: Dict[Tuple[str, str], RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, details: Dict) -> Optional[RateLimiter]:
+        """
+        Get the limiter of a model
+        :param details: Model details as returned by get_models()
+        :return: None when the model has no limits
+        """
+        if "rpm" not in details or "tpm" not in details:
+            return None
+        key = (details["provider"], details["model"])
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = RateLimiter(*key, rpm=details["rpm"], tpm=details["tpm"])
+            return limiter
+
+    def try_acquire(self, details: Dict, tokens: int) -> bool:
+        """
+        Take a request of a model if its limits allow it now
+        :param details: Model details as returned by get_models()
+        :param tokens: Estimated prompt tokens
+        :return:
+        """
+        limiter = self.limiter(details)
+        return limiter is None or limiter.try_acquire(tokens)
+
+    async def queue(self, details: Dict, tokens: int, session: str = "", priority: int = 0) -> AsyncIterator[int]:
+        """
+        Wait for the limits of a model, see RateLimiter.queue
+        :param details: Model details as returned by get_models()
+        :param tokens: Estimated prompt tokens
+        :param session: Session the request belongs to
+        :param priority: Requests with a higher priority are served first
+        :return: Async iterator of 1-based queue positions
+        """
+        limiter = self.limiter(details)
+        if limiter is not None:
+            async for position in limiter.queue(tokens, session, priority):
+                yield position
+
+
+request_scheduler = RequestScheduler()
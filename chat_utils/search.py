@@ -0,0 +1,210 @@
+import os
+import re
+import sqlite3
+import sys
+import threading
+from typing import Dict, List, Optional
+
+from chat_utils.catalog import get_chat_id
+from chat_utils.store import get_chat_store
+
+SEARCH_FILE = "search.sqlite3"
+
+# Words of context around the matches in a snippet
+SNIPPET_WORDS = 16
+
+# Shortest last word searched as a prefix, shorter prefixes match most messages and ranking them all is slow
+MIN_PREFIX = 3
+
+_indexes: Dict[str, "SearchIndex"] = {}
+_indexes_lock = threading.Lock()
+
+
+def build_query(text: str) -> Optional[str]:
+    """
+    Turn what the user typed into an FTS5 query matching messages with all of its words,
+    the last word as a prefix since it may still be being typed, once it has MIN_PREFIX characters
+    :param text:
+    :return: query, None if there is no word to search for
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    query = " ".join(f'"{word}"' for word in words)
+    return query + "*" if len(words[-1]) >= MIN_PREFIX else query
+
+
+class SearchIndex:
+    """
+    Full-text index of the messages of every chat of a folder, in a SQLite FTS5 table.
+
+    Messages are added as they are written, through the journal listener, so the index is never
+    rebuilt. A search ranks the matches with BM25 and returns a highlighted snippet and the position
+    of the message in its chat.
+    """
+
+    def __init__(self, folder: str):
+        """
+        :param folder: Folder of the chats, the index is stored next to them
+        """
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._backfill: Optional[threading.Thread] = None
+        self._connection = sqlite3.connect(
+            os.path.join(folder, SEARCH_FILE),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # an index can be rebuilt from the chats, it does not need an fsync per turn
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+            "content, chat_id UNINDEXED, position UNINDEXED, role UNINDEXED, "
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS indexed (chat_id TEXT PRIMARY KEY, count INTEGER NOT NULL)"
+        )
+
+    def indexed(self, chat_id: str) -> int:
+        """
+        Get the number of leading records of a chat in the index
+        :param chat_id:
+        :return:
+        """
+        with self._lock:
+            return self._indexed(chat_id)
+
+    def _indexed(self, chat_id: str) -> int:
+        row = self._connection.execute("SELECT count FROM indexed WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def add(
+            self,
+            chat_id: str,
+            start: int,
+            records: List[Dict],
+            replaced: bool = False
+    ) -> int:
+        """
+        Index the user and assistant messages of a chat
+        :param chat_id: Chat id, see chat_utils.catalog.get_chat_id
+        :param start: Index of the first record in the chat
+        :param records: Records to add
+        :param replaced: Whether the records replace everything indexed for the chat
+        :return: number of messages added
+        """
+        rows = [
+            (record["content"], chat_id, start + offset, record["role"])
+            for offset, record in enumerate(records)
+            if record.get("role") in ("user", "assistant") and isinstance(record.get("content"), str)
+            and record["content"].strip()
+        ]
+        with self._lock:
+            # other worker processes may write to the index too
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                if replaced:
+                    self._connection.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                else:
+                    # skip what a backfill running at the same time already indexed
+                    indexed = self._indexed(chat_id)
+                    rows = [row for row in rows if row[2] >= indexed]
+                self._connection.executemany(
+                    "INSERT INTO messages (content, chat_id, position, role) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                self._connection.execute(
+                    "INSERT INTO indexed (chat_id, count) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET count = "
+                    "CASE WHEN ? THEN excluded.count ELSE MAX(indexed.count, excluded.count) END",
+                    (chat_id, start + len(records), replaced)
+                )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return len(rows)
+
+    def search(
+            self,
+            text: str,
+            limit: int = 20
+    ) -> List[Dict]:
+        """
+        Find the messages matching a text, best first
+        :param text: Words to search for, as typed by the user
+        :param limit: Maximum number of results
+        :return: List of {"chat", "position", "role", "snippet", "score"}, matches in the snippet are in bold
+        """
+        query = build_query(text)
+        if query is None:
+            return []
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT chat_id, position, role, snippet(messages, 0, '**', '**', '…', ?), bm25(messages) "
+                "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ?",
+                (SNIPPET_WORDS, query, limit)
+            ).fetchall()
+        return [
+            {"chat": chat_id, "position": position, "role": role, "snippet": snippet, "score": -score}
+            for chat_id, position, role, snippet, score in rows
+        ]
+
+    def backfill(self) -> int:
+        """
+        Index the records of the folder's chats that are not in the index yet, ex.: saved before it existed
+        or by another node
+        :return: number of messages added
+        """
+        added = 0
+        store = get_chat_store(self.folder)
+        for chat in store.page(limit=-1):
+            start = self.indexed(chat["id"])
+            if start < chat["message_count"]:
+                added += self.add(chat["id"], start, store.read(chat["id"], start, sys.maxsize))
+        return added
+
+    def start_backfill(self) -> threading.Thread:
+        """
+        Run backfill in a background thread, once per process however many sessions ask for it
+        :return: the thread
+        """
+        with self._lock:
+            if self._backfill is None:
+                self._backfill = threading.Thread(target=self.backfill, daemon=True, name="search-backfill")
+                self._backfill.start()
+            return self._backfill
+
+    def on_journal_write(
+            self,
+            journal,
+            records: List[Dict],
+            replaced: bool
+    ) -> None:
+        """
+        ChatJournal listener indexing the messages of a chat as they are written
+        :param journal:
+        :param records:
+        :param replaced:
+        :return: None
+        """
+        start = 0 if replaced else journal.count - len(records)
+        self.add(get_chat_id(journal.file_path), start, records, replaced)
+
+
+def get_search_index(folder: str) -> SearchIndex:
+    """
+    Get the search index of a chats folder, shared by all sessions of the process
+    :param folder:
+    :return: SearchIndex
+    """
+    key = os.path.abspath(folder)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            os.makedirs(folder, exist_ok=True)
+            index = SearchIndex(folder)
+            _indexes[key] = index
+        return index
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from typing import Callable, Dict, Optional
+
+import panel as pn
+
+from chat_utils.engine import client_registry
+from chat_utils.catalog import open_chat_journal
+
+_sessions: Dict[Optional[str], Dict] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session_id() -> Optional[str]:
+    """
+    Get the id of the current Panel session
+    :return: session id, None when running outside a server session
+    """
+    curdoc = pn.state.curdoc
+    if curdoc is None or curdoc.session_context is None:
+        return None
+    return curdoc.session_context.id
+
+
+def create_chat_context(
+        chat_memory_file: str,
+        provider: str = "groq",
+        base_url: str = None
+) -> Dict:
+    """
+    Create a chat context with its own history, journal and lock, using the pooled client of the provider
+    :param chat_memory_file: Path to the chat file
+    :param provider: Provider name as used in get_models()
+    :param base_url: Base URL of the provider API
+    :return: chat context
+    """
+    return {
+        "chat_memory": [],
+        "chat_memory_file": chat_memory_file,
+        "chat_journal": open_chat_journal(chat_memory_file),
+        # running summary of the older turns, see chat_utils.summary
+        "summary": None,
+        # messages at the start of chat_memory that are not rendered yet, see chat_utils.core.load_chat_from_file
+        "unrendered": 0,
+        # held while the history is written from a worker thread, see chat_utils.core.save_chat_memory
+        "history_lock": threading.Lock(),
+        # CancelToken of the turn in progress, see chat_utils.cancellation
+        "turn": None,
+        "client": client_registry.get(provider=provider, base_url=base_url),
+        # serializes the turns of one session, sessions never wait on each other
+        "lock": asyncio.Lock()
+    }
+
+
+def get_session_context(
+        factory: Callable[[], Dict]
+) -> Dict:
+    """
+    Get the chat context of the current Panel session, creating it on first use.
+    The context is released when the session is destroyed.
+    :param factory: Function creating a new chat context
+    :return: chat context
+    """
+    session_id = get_session_id()
+
+    with _sessions_lock:
+        context = _sessions.get(session_id)
+        if context is None:
+            context = factory()
+            _sessions[session_id] = context
+            created = True
+        else:
+            created = False
+
+    if created and session_id is not None:
+        pn.state.on_session_destroyed(lambda session_context: release_session_context(session_context.id))
+
+    return context
+
+
+def release_session_context(
+        session_id: Optional[str]
+) -> None:
+    """
+    Drop the chat context of a session, stop its turn in progress and close its journal.
+    The client is shared by all sessions of the provider and stays open.
+    :param session_id:
+    :return:
+    """
+    with _sessions_lock:
+        context = _sessions.pop(session_id, None)
+
+    if context is None:
+        return
+
+    journal = context.get("chat_journal")
+    turn = context.get("turn")
+    if turn is not None:
+        # nobody is reading the reply anymore, the turn saves what it has before the journal is closed
+        turn.cancel("session destroyed")
+        if journal is not None:
+            turn.add_done_callback(journal.close)
+    elif journal is not None:
+        journal.close()
@@ -0,0 +1,673 @@
+"""
+Chat stores: where the chat histories and the list of chats of a chats folder live.
+
+Every store lists chats like ChatCatalog (page, count, get, register), reads and writes records by chat id
+(length, read, append, save), names the path of a chat (path) and creates the journal a chat context writes
+through (journal). Appends are
+optimistic: they name the number of records the writer expects the chat to hold and fail with ConflictError
+when another process wrote first, StoreJournal then saves its history as a new chat, so no write is lost and
+no session sees the records of another in its history.
+
+- FileChatStore keeps the jsonl and .chatz files of the folder, the default, for a single process
+- SQLiteChatStore keeps the chats in one SQLite database in WAL mode, for several processes of one node,
+  ex.: `panel serve --num-procs 4`
+- KeyValueChatStore keeps the chats in a key-value server with compare-and-set writes, for several nodes,
+  bench.kv_server is a local stand-in for one
+
+Sessions stay in their process, a session is bound to the websocket of one worker, but any worker finds
+the chats of any other.
+"""
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from chat_utils.catalog import ChatCatalog, create_chat_journal, get_chat_catalog, get_chat_id, get_title, is_chat_file, \
+    new_chat_id
+from chat_utils.fs import ChatJournal
+
+STORE_FILE = "chats.sqlite3"
+
+_stores: Dict[str, Any] = {}
+_stores_lock = threading.Lock()
+
+
+class ConflictError(Exception):
+    """
+    Raised when a write expected a version of a chat, or of a key, that another writer already replaced
+    """
+
+
+class StoreJournal:
+    """
+    ChatJournal interface over a chat store, so chat contexts work the same on every store.
+
+    When extend conflicts, ex.: two sessions continued the same saved chat, the history of this session is
+    saved as a new chat and the journal names that chat from then on, see fork.
+    """
+
+    def __init__(self, store, file_path: str):
+        """
+        :param store: SQLiteChatStore or KeyValueChatStore
+        :param file_path: Path naming the chat, ex.: chats/chat_memory_2024-04-25_084851.jsonl, nothing is written there
+        """
+        self.store = store
+        self.file_path = file_path
+        self.chat_id = get_chat_id(file_path)
+        self.count = 0
+        # number of records in the store before the first record held in memory, see load_tail
+        self.base = 0
+        self.metadata: Dict = {}
+        self.listeners: List[Callable[["StoreJournal", List[Dict], bool], None]] = []
+
+    def load(self) -> List[Dict]:
+        records = self.store.read(self.chat_id, 0, sys.maxsize)
+        self.count = len(records)
+        self.base = 0
+        return records
+
+    def load_tail(self, limit: int) -> List[Dict]:
+        self.count = self.store.length(self.chat_id)
+        self.base = max(0, self.count - limit)
+        return self.store.read(self.chat_id, self.base, self.count)
+
+    def load_before(self, limit: int) -> List[Dict]:
+        if self.base == 0:
+            return []
+        start = max(0, self.base - limit)
+        records = self.store.read(self.chat_id, start, self.base)
+        self.base = start
+        return records
+
+    def read(self, start: int, stop: int) -> List[Dict]:
+        return self.store.read(self.chat_id, start, stop)
+
+    def append(self, records: List[Dict]):
+        """
+        Append records after the newest records of the chat, even if another process added some since
+        :param records: List of dictionaries
+        :return: None
+        """
+        if not records:
+            return
+        while True:
+            try:
+                self.store.append(self.chat_id, records, self.count, model=self.metadata.get("model"))
+                break
+            except ConflictError:
+                self.count = self.store.length(self.chat_id)
+        self.count += len(records)
+        self._notify(records, False)
+
+    def extend(self, data: List[Dict]):
+        """
+        Persist a chat history, writing only the records added since the last call.
+        When another process wrote to the chat meanwhile, the history is saved as a new chat instead.
+        :param data: Full list of dictionaries, or the records from `base` on after load_tail
+        :return: None
+        """
+        if self.base + len(data) < self.count:
+            self.compact(data)
+            return
+        records = data[self.count - self.base:]
+        if not records:
+            return
+        try:
+            self.store.append(self.chat_id, records, self.count, model=self.metadata.get("model"))
+        except ConflictError:
+            # the records of the other writer are never spliced into this history, the prompt would change under it
+            self.fork(data)
+            return
+        self.count += len(records)
+        self._notify(records, False)
+
+    def fork(self, data: List[Dict]):
+        """
+        Save a chat history as a new chat, the journal names that chat from then on
+        :param data: Full list of dictionaries, or the records from `base` on after load_tail
+        :return: None
+        """
+        # the records before `base` are only in the store, they were never rewritten by this session
+        head = self.store.read(self.chat_id, 0, self.base)
+        records = head + data
+        self.chat_id = new_chat_id()
+        self.file_path = self.store.path(self.chat_id)
+        self.store.save(self.chat_id, records, model=self.metadata.get("model"))
+        self.count = len(records)
+        self.base = len(head)
+        self._notify(records, True)
+
+    def compact(self, data: List[Dict]):
+        """
+        Replace the records of the chat, the last writer wins
+        :param data: List of dictionaries
+        :return: None
+        """
+        self.store.save(self.chat_id, data, model=self.metadata.get("model"))
+        self.count = len(data)
+        self.base = 0
+        self._notify(data, True)
+
+    def sync(self):
+        # every write is durable when the store returns
+        pass
+
+    def close(self):
+        pass
+
+    def _notify(self, records: List[Dict], replaced: bool):
+        for listener in self.listeners:
+            listener(self, records, replaced)
+
+
+class FileChatStore:
+    """
+    Chat files of a folder, listed by the folder's ChatCatalog.
+    Appends are checked but not atomic across processes, use it with a single process.
+    """
+
+    def __init__(self, folder: str):
+        """
+        :param folder: Folder holding the chat files
+        """
+        self.folder = folder
+        self.catalog = get_chat_catalog(folder)
+
+    def page(self, limit: int = 50, after: Optional[Dict] = None) -> List[Dict]:
+        return self.catalog.page(limit=limit, after=after)
+
+    def count(self) -> int:
+        return self.catalog.count()
+
+    def get(self, chat_id: str) -> Optional[Dict]:
+        return self.catalog.get(chat_id)
+
+    def register(self, chat_id: str, model: Optional[str] = None, created: Optional[float] = None) -> None:
+        self.catalog.register(chat_id, model=model, created=created)
+
+    def path(self, chat_id: str) -> str:
+        """
+        Get the file of a chat, a compressed one if it exists
+        :param chat_id:
+        :return: path
+        """
+        compressed = os.path.join(self.folder, chat_id + ".chatz")
+        return compressed if os.path.exists(compressed) else os.path.join(self.folder, chat_id + ".jsonl")
+
+    def journal(self, file_path: str) -> ChatJournal:
+        """
+        Create the journal of a chat file that keeps the catalog up to date
+        :param file_path:
+        :return: ChatJournal
+        """
+        journal = create_chat_journal(file_path)
+        journal.listeners.append(self.catalog.on_journal_write)
+        return journal
+
+    def length(self, chat_id: str) -> int:
+        journal = create_chat_journal(self.path(chat_id))
+        journal.load_tail(0)
+        return journal.count
+
+    def read(self, chat_id: str, start: int, stop: int) -> List[Dict]:
+        return create_chat_journal(self.path(chat_id)).read(start, stop)
+
+    def append(self, chat_id: str, records: List[Dict], expected: int, model: Optional[str] = None) -> None:
+        """
+        Append records to a chat
+        :param chat_id:
+        :param records: List of dictionaries
+        :param expected: Number of records the chat holds before them
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        :raises ConflictError: if the chat does not hold `expected` records
+        """
+        journal = self.journal(self.path(chat_id))
+        journal.load_tail(0)
+        if journal.count != expected:
+            raise ConflictError(f"{chat_id} holds {journal.count} records, not {expected}")
+        journal.metadata["model"] = model
+        journal.append(records)
+        journal.close()
+
+    def save(self, chat_id: str, records: List[Dict], model: Optional[str] = None) -> None:
+        """
+        Replace the records of a chat, the store's save_jsonl
+        :param chat_id:
+        :param records: List of dictionaries
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        """
+        journal = self.journal(self.path(chat_id))
+        journal.metadata["model"] = model
+        journal.compact(records)
+
+
+class SQLiteChatStore(ChatCatalog):
+    """
+    Chats and their catalog in one SQLite database in WAL mode, shared by the processes of a node.
+
+    A message is a row keyed by chat and position. An append checks the length of the chat and inserts its
+    rows in one short write transaction, readers never wait for it. Chat files found in the folder when the
+    database is created are imported.
+    """
+
+    def __init__(self, folder: str, path: Optional[str] = None):
+        """
+        :param folder: Folder of the chats, its files are imported into a new database
+        :param path: Path to the SQLite database, defaults to STORE_FILE in the folder
+        """
+        super().__init__(folder, path or os.path.join(folder, STORE_FILE))
+
+    def _create_tables(self) -> None:
+        super()._create_tables()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "chat_id TEXT NOT NULL, "
+            "position INTEGER NOT NULL, "
+            "record TEXT NOT NULL, "
+            "PRIMARY KEY (chat_id, position)) WITHOUT ROWID"
+        )
+
+    def rebuild(self) -> None:
+        """
+        Import the chat files of the folder, used once when the database is created
+        :return: None
+        """
+        for name in os.listdir(self.folder):
+            if not is_chat_file(name):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                records = create_chat_journal(path).read(0, sys.maxsize)
+            except ValueError as error:
+                print(f"Skipping unreadable chat: {path}: {error}", file=sys.stderr)
+                continue
+            self.register(get_chat_id(path), created=os.stat(path).st_mtime)
+            try:
+                self.append(get_chat_id(path), records, 0)
+            except ConflictError:
+                # another process imported it first
+                pass
+
+    def path(self, chat_id: str) -> str:
+        # only names the chat and its folder, nothing is written there
+        return os.path.join(self.folder, chat_id + ".jsonl")
+
+    def journal(self, file_path: str) -> StoreJournal:
+        return StoreJournal(self, file_path)
+
+    def length(self, chat_id: str) -> int:
+        with self._lock:
+            row = self._connection.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def read(self, chat_id: str, start: int, stop: int) -> List[Dict]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT record FROM messages WHERE chat_id = ? AND position >= ? AND position < ? ORDER BY position",
+                (chat_id, start, stop)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _write(self, chat_id: str, records: List[Dict], start: int, model: Optional[str], replaced: bool) -> None:
+        rows = [(chat_id, start + offset, json.dumps(record)) for offset, record in enumerate(records)]
+        size = sum(len(row[2]) + 1 for row in rows)
+        now = time.time()
+        self._connection.executemany("INSERT INTO messages (chat_id, position, record) VALUES (?, ?, ?)", rows)
+        self._connection.execute(
+            "INSERT INTO chats (id, title, model, created, updated, message_count, byte_size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "title = CASE WHEN ? THEN excluded.title ELSE COALESCE(chats.title, excluded.title) END, "
+            "model = COALESCE(excluded.model, chats.model), "
+            "updated = excluded.updated, "
+            "message_count = excluded.message_count, "
+            "byte_size = CASE WHEN ? THEN excluded.byte_size ELSE chats.byte_size + excluded.byte_size END",
+            (chat_id, get_title(records), model, now, now, start + len(records), size, replaced, replaced)
+        )
+
+    def append(self, chat_id: str, records: List[Dict], expected: int, model: Optional[str] = None) -> None:
+        """
+        Append records to a chat
+        :param chat_id:
+        :param records: List of dictionaries
+        :param expected: Number of records the chat holds before them
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        :raises ConflictError: if the chat does not hold `expected` records
+        """
+        with self._lock:
+            # takes the write lock at once, the length cannot change before the commit
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+                count = row[0] if row is not None else 0
+                if count != expected:
+                    raise ConflictError(f"{chat_id} holds {count} records, not {expected}")
+                self._write(chat_id, records, expected, model, False)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def save(self, chat_id: str, records: List[Dict], model: Optional[str] = None) -> None:
+        """
+        Replace the records of a chat, the store's save_jsonl
+        :param chat_id:
+        :param records: List of dictionaries
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                self._write(chat_id, records, 0, model, True)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+
+class HttpKeyValueClient:
+    """
+    Client of a key-value server with versioned writes over HTTP, the protocol of bench.kv_server:
+
+    - GET /kv/<key> returns the value with its version in the ETag header, 404 if the key is missing
+    - PUT /kv/<key> stores a value, only if the key is at version N with If-Match: "N", or only if it is
+      missing with If-None-Match: *, and answers 412 otherwise
+    - DELETE /kv/<key> removes a key
+    - GET /kv?prefix=<prefix> returns {"items": [{"key", "value", "version"}]} of the keys with a prefix
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        """
+        :param url: Server URL, ex.: http://127.0.0.1:8900
+        :param timeout: Seconds before a request fails
+        """
+        # httpx is already a dependency of openai, imported here so a file store does not load it
+        import httpx
+
+        self.url = url.rstrip("/")
+        self._client = httpx.Client(base_url=self.url, timeout=timeout)
+
+    def get(self, key: str) -> Tuple[Any, int]:
+        """
+        Get a value
+        :param key:
+        :return: (value, version), (None, 0) if the key is missing
+        """
+        response = self._client.get(f"/kv/{quote(key)}")
+        if response.status_code == 404:
+            return None, 0
+        response.raise_for_status()
+        return response.json(), int(response.headers["etag"].strip('"'))
+
+    def put(self, key: str, value: Any, version: Optional[int] = None) -> int:
+        """
+        Store a value
+        :param key:
+        :param value: JSON serializable value
+        :param version: Version the key must be at, 0 if it must be missing, None to write unconditionally
+        :return: the new version
+        :raises ConflictError: if the key is not at `version`
+        """
+        headers = {}
+        if version == 0:
+            headers["if-none-match"] = "*"
+        elif version is not None:
+            headers["if-match"] = f'"{version}"'
+        response = self._client.put(f"/kv/{quote(key)}", content=json.dumps(value), headers=headers)
+        if response.status_code == 412:
+            raise ConflictError(key)
+        response.raise_for_status()
+        return int(response.headers["etag"].strip('"'))
+
+    def delete(self, key: str) -> None:
+        self._client.delete(f"/kv/{quote(key)}").raise_for_status()
+
+    def scan(self, prefix: str) -> List[Tuple[str, Any, int]]:
+        """
+        Get the keys starting with a prefix
+        :param prefix:
+        :return: List of (key, value, version)
+        """
+        response = self._client.get("/kv", params={"prefix": prefix})
+        response.raise_for_status()
+        return [(item["key"], item["value"], item["version"]) for item in response.json()["items"]]
+
+
+class KeyValueChatStore:
+    """
+    Chats in a key-value server shared by several nodes.
+
+    A chat is a metadata key, with the catalog details and the list of its blocks, and one key per append
+    holding its records, named after the chat and a random token. A block is written first and only becomes
+    part of the chat when the compare-and-set of the metadata that lists it succeeds, the metadata is the
+    commit point: of two appends at the same position only one can list its block, and a block whose writer
+    failed or stopped before is never read. Saving a chat lists a new block and bumps the generation of the
+    metadata, appends still aimed at the previous generation are then refused.
+    """
+
+    def __init__(self, client: HttpKeyValueClient, namespace: str = "chats", folder: Optional[str] = None):
+        """
+        :param client: Key-value client
+        :param namespace: Prefix of the keys, ex.: the name of the chats folder
+        :param folder: Chats folder of the store, used to name the path of a chat, defaults to the namespace
+        """
+        self.client = client
+        self.namespace = namespace
+        self.folder = folder if folder is not None else namespace
+
+    def _meta_key(self, chat_id: str) -> str:
+        return f"{self.namespace}/meta/{chat_id}"
+
+    def _block_key(self, chat_id: str, token: str) -> str:
+        return f"{self.namespace}/blocks/{chat_id}/{token}"
+
+    def _update(self, chat_id: str, change: Callable[[Optional[Dict]], Optional[Dict]]) -> None:
+        # compare-and-set loop, `change` is applied to the latest metadata until the write wins
+        while True:
+            meta, version = self.client.get(self._meta_key(chat_id))
+            updated = change(meta)
+            if updated is None:
+                return
+            try:
+                self.client.put(self._meta_key(chat_id), updated, version)
+                return
+            except ConflictError:
+                continue
+
+    @staticmethod
+    def _new_meta(chat_id: str, model: Optional[str] = None, created: Optional[float] = None) -> Dict:
+        now = time.time() if created is None else created
+        return {
+            "id": chat_id, "title": None, "model": model, "created": now, "updated": now,
+            "message_count": 0, "byte_size": 0, "generation": 0, "blocks": []
+        }
+
+    def path(self, chat_id: str) -> str:
+        # only names the chat and its folder, nothing is written there
+        return os.path.join(self.folder, chat_id + ".jsonl")
+
+    def journal(self, file_path: str) -> StoreJournal:
+        return StoreJournal(self, file_path)
+
+    def register(self, chat_id: str, model: Optional[str] = None, created: Optional[float] = None) -> None:
+        self._update(chat_id, lambda meta: self._new_meta(chat_id, model, created) if meta is None else None)
+
+    def get(self, chat_id: str) -> Optional[Dict]:
+        meta, _ = self.client.get(self._meta_key(chat_id))
+        return meta
+
+    def _chats(self) -> List[Dict]:
+        return [meta for _, meta, _ in self.client.scan(f"{self.namespace}/meta/") if meta["message_count"] > 0]
+
+    def count(self) -> int:
+        return len(self._chats())
+
+    def page(self, limit: int = 50, after: Optional[Dict] = None) -> List[Dict]:
+        """
+        Get a page of chats with at least one message, newest first, like ChatCatalog.page.
+        Every page scans the metadata of all chats.
+        :param limit: number of chats per page, -1 for all
+        :param after: last chat of the previous page, None for the first page
+        :return: list of chat details
+        """
+        chats = sorted(self._chats(), key=lambda chat: (chat["created"], chat["id"]), reverse=True)
+        if after is not None:
+            chats = [chat for chat in chats if (chat["created"], chat["id"]) < (after["created"], after["id"])]
+        return chats if limit < 0 else chats[:limit]
+
+    def length(self, chat_id: str) -> int:
+        meta, _ = self.client.get(self._meta_key(chat_id))
+        return meta["message_count"] if meta is not None else 0
+
+    def read(self, chat_id: str, start: int, stop: int) -> List[Dict]:
+        while True:
+            meta, _ = self.client.get(self._meta_key(chat_id))
+            if meta is None:
+                return []
+            stop = min(stop, meta["message_count"])
+            if start >= stop:
+                return []
+            starts = [block_start for block_start, _ in meta["blocks"]]
+            first = bisect.bisect_right(starts, start) - 1
+            records = self._read_blocks(chat_id, meta["blocks"][first:], stop)
+            if records is not None:
+                return records[start - starts[first]:stop - starts[first]]
+            # the chat was saved meanwhile and its old blocks deleted, the new metadata lists the new ones
+
+    def _read_blocks(self, chat_id: str, blocks: List[List], stop: int) -> Optional[List[Dict]]:
+        records = []
+        for block_start, token in blocks:
+            if block_start >= stop:
+                break
+            block, _ = self.client.get(self._block_key(chat_id, token))
+            if block is None:
+                return None
+            records.extend(block)
+        return records
+
+    def append(self, chat_id: str, records: List[Dict], expected: int, model: Optional[str] = None) -> None:
+        """
+        Append records to a chat
+        :param chat_id:
+        :param records: List of dictionaries
+        :param expected: Number of records the chat holds before them
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        :raises ConflictError: if the chat does not hold `expected` records
+        """
+        meta, version = self.client.get(self._meta_key(chat_id))
+        meta = meta or self._new_meta(chat_id, model)
+        if meta["message_count"] != expected:
+            raise ConflictError(f"{chat_id} holds {meta['message_count']} records, not {expected}")
+        generation = meta["generation"]
+
+        token = uuid.uuid4().hex
+        block_key = self._block_key(chat_id, token)
+        self.client.put(block_key, records, 0)
+        size = len(json.dumps(records))
+
+        while True:
+            updated = dict(
+                meta,
+                blocks=meta["blocks"] + [[expected, token]],
+                message_count=expected + len(records),
+                byte_size=meta["byte_size"] + size,
+                title=meta["title"] or get_title(records),
+                model=model or meta["model"],
+                updated=time.time()
+            )
+            try:
+                # the commit point, until it succeeds the block is not part of the chat
+                self.client.put(self._meta_key(chat_id), updated, version)
+                return
+            except ConflictError:
+                meta, version = self.client.get(self._meta_key(chat_id))
+                meta = meta or self._new_meta(chat_id, model)
+                # only a change that is not a write, ex.: the chat was registered meanwhile, is retried
+                if meta["message_count"] != expected or meta["generation"] != generation:
+                    self.client.delete(block_key)
+                    raise ConflictError(f"{chat_id} was written while appending") from None
+
+    def save(self, chat_id: str, records: List[Dict], model: Optional[str] = None) -> None:
+        """
+        Replace the records of a chat with a new generation, the store's save_jsonl
+        :param chat_id:
+        :param records: List of dictionaries
+        :param model: Model of the chat, kept as is when None
+        :return: None
+        """
+        token = uuid.uuid4().hex
+        if records:
+            self.client.put(self._block_key(chat_id, token), records, 0)
+
+        while True:
+            meta, version = self.client.get(self._meta_key(chat_id))
+            current = meta or self._new_meta(chat_id, model)
+            updated = dict(
+                current,
+                generation=current["generation"] + 1,
+                blocks=[[0, token]] if records else [],
+                message_count=len(records),
+                byte_size=len(json.dumps(records)) if records else 0,
+                title=get_title(records),
+                model=model or current["model"],
+                updated=time.time()
+            )
+            try:
+                self.client.put(self._meta_key(chat_id), updated, version)
+                break
+            except ConflictError:
+                continue
+
+        # the blocks of the replaced records, readers still holding the old metadata read the new one instead
+        if meta is not None:
+            for _, old in meta["blocks"]:
+                self.client.delete(self._block_key(chat_id, old))
+
+
+def create_chat_store(folder: str, url: Optional[str] = None):
+    """
+    Create the store of a chats folder
+    :param folder: Folder of the chats
+    :param url: "files", "sqlite" for a SQLiteChatStore in the folder, or the URL of a key-value server,
+        ex.: http://127.0.0.1:8900, defaults to the CHAT_STORE environment variable or "files"
+    :return: FileChatStore, SQLiteChatStore or KeyValueChatStore
+    """
+    url = url or os.environ.get("CHAT_STORE", "files")
+    if url == "files":
+        return FileChatStore(folder)
+    if url == "sqlite":
+        return SQLiteChatStore(folder)
+    if url.startswith(("http://", "https://")):
+        return KeyValueChatStore(
+            HttpKeyValueClient(url),
+            namespace=os.path.basename(os.path.abspath(folder)),
+            folder=folder
+        )
+    raise ValueError(f"Unknown chat store: {url}")
+
+
+def get_chat_store(folder: str):
+    """
+    Get the store of a chats folder, shared by all sessions of the process, see create_chat_store
+    :param folder:
+    :return: FileChatStore, SQLiteChatStore or KeyValueChatStore
+    """
+    key = os.path.abspath(folder)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            os.makedirs(folder, exist_ok=True)
+            store = create_chat_store(folder)
+            _stores[key] = store
+        return store
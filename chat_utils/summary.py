@@ -0,0 +1,193 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from chat_utils.context import ContextWindow
+from chat_utils.core import get_model_details
+from chat_utils.engine import client_registry, get_api_key
+from chat_utils.fs import save_summary
+from chat_utils.scheduler import request_scheduler
+
+# Fast and cheap, summaries do not need a large model
+SUMMARY_MODEL = "llama3-8b-8192"
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and an assistant.
+Update the current summary with the new messages. Keep names, numbers, decisions, preferences
+and open questions, drop pleasantries. Answer with the updated summary only, in at most 300 words.
+"""
+
+
+def _as_text(message: Dict) -> str:
+    content = message.get("content") or ""
+    if message.get("tool_calls"):
+        content += " ".join(
+            f"[calls {call['function']['name']}({call['function']['arguments']})]" for call in message["tool_calls"]
+        )
+    return f"{message.get('role')}: {content}"
+
+
+class Summarizer:
+    """
+    Fold the older turns of a chat into a running summary message.
+
+    After a turn, once the messages that are not summarized yet pass `threshold` tokens, all but the
+    newest `keep` of them are summarized in a background task, a chunk of at most `chunk_tokens` at a
+    time, so a reply never waits for it. The summary is saved next to the chat file with the number
+    of records it covers, and chat_utils.core.load_chat_from_file reads it back.
+    """
+
+    def __init__(
+            self,
+            threshold: int = 4096,
+            keep: int = 6,
+            model: str = SUMMARY_MODEL,
+            chunk_tokens: int = 4096,
+            max_tokens: int = 512
+    ):
+        """
+        :param threshold: Tokens of unsummarized messages that start a summarization
+        :param keep: Number of newest messages always sent verbatim
+        :param model: Model used to summarize, one of get_models()
+        :param chunk_tokens: Maximum tokens of messages folded by one request
+        :param max_tokens: Maximum tokens of the summary
+        """
+        self.threshold = threshold
+        self.keep = keep
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.max_tokens = max_tokens
+        self.context_window = ContextWindow()
+
+    def messages(
+            self,
+            chat_context: Dict
+    ) -> List[Dict]:
+        """
+        Get the history to send: the summary, then the messages it does not cover
+        :param chat_context: Chat context with chat_memory, chat_journal and summary
+        :return: List of messages
+        """
+        state = chat_context.get("summary")
+        memory = chat_context["chat_memory"]
+        if not state:
+            return memory
+        start = max(0, state["summarized"] - chat_context["chat_journal"].base)
+        summary = {
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{state['summary']}"
+        }
+        return [summary, *memory[start:]]
+
+    def schedule(
+            self,
+            chat_context: Dict
+    ) -> Optional[asyncio.Task]:
+        """
+        Start summarizing in the background if the unsummarized messages passed the threshold.
+        Call it after the turn was saved, does nothing while a summarization is running.
+        :param chat_context: Chat context with chat_memory, chat_journal and summary
+        :return: the task, None if nothing was started
+        """
+        task = chat_context.get("summary_task")
+        if task is not None and not task.done():
+            return None
+        if not get_api_key(get_model_details(self.model)["provider"]):
+            return None
+
+        journal = chat_context["chat_journal"]
+        memory = chat_context["chat_memory"]
+        state = chat_context.get("summary") or {"summary": "", "summarized": 0}
+        start = max(0, state["summarized"] - journal.base)
+        if self.context_window.count(memory[start:]) < self.threshold:
+            return None
+
+        stop = len(memory) - self.keep
+        # never leave tool results without the assistant message that requested them
+        while 0 < stop < len(memory) and memory[stop].get("role") == "tool":
+            stop -= 1
+        if journal.base + stop <= state["summarized"]:
+            return None
+
+        task = asyncio.ensure_future(self.summarize(chat_context, state, journal.base + stop))
+        chat_context["summary_task"] = task
+        return task
+
+    async def summarize(
+            self,
+            chat_context: Dict,
+            state: Dict,
+            stop: int
+    ) -> Dict:
+        """
+        Fold the records up to `stop` into the summary, saving it after every chunk
+        :param chat_context: Chat context, only updated while it still holds the same chat
+        :param state: Summary to extend
+        :param stop: Index after the last record to summarize
+        :return: the new summary
+        """
+        journal = chat_context["chat_journal"]
+        # the journal names the chat it writes, ex.: a new chat after a conflict, see chat_utils.store.StoreJournal
+        chat_file = journal.file_path
+        details = get_model_details(self.model)
+        client = client_registry.get(details["provider"], details["base_url"])
+
+        # a rewrite of the chat while a request is out would make the summary cover records that are gone,
+        # chat_utils.fs.discard_summary deletes the saved one
+        rewritten = []
+
+        def watch(journal, records, replaced):
+            if replaced:
+                rewritten.append(True)
+
+        journal.listeners.append(watch)
+        try:
+            while state["summarized"] < stop and not rewritten:
+                # a chat loaded with load_tail may have to be summarized from far before the loaded page
+                records = journal.read(state["summarized"], min(stop, state["summarized"] + 256))
+                if not records:
+                    break
+                chunk, tokens = [], 0
+                for record in records:
+                    record_tokens = self.context_window.message_tokens(record)
+                    if chunk and tokens + record_tokens > self.chunk_tokens:
+                        break
+                    chunk.append(record)
+                    tokens += record_tokens
+
+                # background work only uses capacity the users leave free, it is retried after the next turn
+                if not request_scheduler.try_acquire(details, tokens):
+                    break
+                prompt = "Current summary:\n{}\n\nNew messages:\n{}".format(
+                    state["summary"] or "(none)",
+                    "\n".join(_as_text(record) for record in chunk)
+                )
+                try:
+                    response = await client.chat.completions.create(
+                        model=details["model"],
+                        messages=[
+                            {"role": "system", "content": SUMMARY_PROMPT},
+                            {"role": "user", "content": prompt}
+                        ],
+                        max_tokens=self.max_tokens,
+                        temperature=0
+                    )
+                except Exception:
+                    # the summary is an optimization, a failed request leaves the history as it is
+                    break
+                if rewritten:
+                    break
+
+                state = {
+                    "summary": response.choices[0].message.content.strip(),
+                    "summarized": state["summarized"] + len(chunk),
+                    "model": details["model"]
+                }
+                save_summary(chat_file, state)
+                if chat_context.get("chat_journal") is journal:
+                    chat_context["summary"] = state
+        finally:
+            journal.listeners.remove(watch)
+        return state
+
+
+summarizer = Summarizer()
@@ -0,0 +1,105 @@
+import asyncio
+import functools
+import inspect
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_tool_executor(max_workers: int = 8) -> ThreadPoolExecutor:
+    """
+    Get the thread pool shared by synchronous tools
+    :param max_workers: Number of threads, only used when the pool is created
+    :return: ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+    return _executor
+
+
+def collect_tool_calls(
+        tool_calls: Dict[int, Dict],
+        deltas: List
+) -> None:
+    """
+    Merge streamed tool call deltas into complete tool calls, keyed by their index
+    :param tool_calls: Tool calls collected so far, updated in place
+    :param deltas: choice.delta.tool_calls of a chunk
+    :return: None
+    """
+    for delta in deltas:
+        call = tool_calls.setdefault(delta.index, {
+            "id": None,
+            "type": "function",
+            "function": {
+                "name": "",
+                "arguments": ""
+            }
+        })
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function:
+            if delta.function.name:
+                call["function"]["name"] += delta.function.name
+            if delta.function.arguments:
+                call["function"]["arguments"] += delta.function.arguments
+
+
+async def run_tool_call(
+        tool_call: Dict,
+        tools: Dict[str, Callable],
+        timeout: float = 30.0
+) -> Dict:
+    """
+    Run a tool call, async tools on the event loop and the others on the tool thread pool
+    :param tool_call: Complete tool call as collected by collect_tool_calls
+    :param tools: Mapping of tool names to functions
+    :param timeout: Seconds before the call is abandoned
+    :return: tool message to send back to the model
+    """
+    name = tool_call["function"]["name"]
+    func = tools.get(name)
+
+    try:
+        if func is None:
+            raise KeyError(f"Unknown tool: {name}")
+
+        arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        if inspect.iscoroutinefunction(func):
+            output = await asyncio.wait_for(func(**arguments), timeout)
+        else:
+            loop = asyncio.get_running_loop()
+            output = await asyncio.wait_for(
+                loop.run_in_executor(get_tool_executor(), functools.partial(func, **arguments)),
+                timeout
+            )
+    except asyncio.TimeoutError:
+        output = {"error": f"Tool {name} timed out after {timeout} seconds"}
+    except Exception as e:
+        output = {"error": f"{type(e).__name__}: {e}"}
+
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call["id"],
+        "name": name,
+        # if output is object, convert to string
+        "content": output if isinstance(output, str) else json.dumps(output)
+    }
+
+
+async def run_tool_calls(
+        tool_calls: List[Dict],
+        tools: Dict[str, Callable],
+        timeout: float = 30.0
+) -> List[Dict]:
+    """
+    Run tool calls concurrently, so a turn takes about as long as its slowest tool
+    :param tool_calls: Complete tool calls as collected by collect_tool_calls
+    :param tools: Mapping of tool names to functions
+    :param timeout: Seconds before each call is abandoned
+    :return: tool messages in the order of tool_calls
+    """
+    return list(await asyncio.gather(*[run_tool_call(call, tools, timeout) for call in tool_calls]))
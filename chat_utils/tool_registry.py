@@ -0,0 +1,93 @@
+import importlib
+import pkgutil
+import threading
+from importlib.metadata import entry_points
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class ToolRegistry:
+    """
+    Registry of functions decorated with openai_tool.
+
+    Tool modules are only imported on first use, and the tools list sent with a request is built
+    once per selection of tools and then reused.
+    """
+
+    def __init__(
+            self,
+            packages: Iterable[str] = ("tools",),
+            entry_point_group: Optional[str] = "llm_chatbot.tools"
+    ):
+        """
+        :param packages: Packages whose modules are scanned for tools
+        :param entry_point_group: Entry point group of tools provided by installed distributions, None to skip
+        """
+        self.packages = tuple(packages)
+        self.entry_point_group = entry_point_group
+        self._tools: Optional[Dict[str, Callable]] = None
+        self._payloads: Dict[Tuple[str, ...], List[Dict]] = {}
+        self._lock = threading.Lock()
+
+    def _discover(self) -> Dict[str, Callable]:
+        if self._tools is not None:
+            return self._tools
+
+        with self._lock:
+            if self._tools is not None:
+                return self._tools
+
+            tools = {}
+            for package_name in self.packages:
+                package = importlib.import_module(package_name)
+                for module_info in pkgutil.iter_modules(package.__path__, f"{package_name}."):
+                    module = importlib.import_module(module_info.name)
+                    for value in vars(module).values():
+                        if callable(value) and isinstance(getattr(value, "tool", None), dict):
+                            tools[value.tool["function"]["name"]] = value
+
+            if self.entry_point_group:
+                for entry_point in entry_points(group=self.entry_point_group):
+                    value = entry_point.load()
+                    tools[value.tool["function"]["name"]] = value
+
+            self._tools = tools
+            return tools
+
+    def names(self) -> List[str]:
+        """
+        Get the names of all tools
+        :return: list of tool names
+        """
+        return sorted(self._discover())
+
+    def get(self, name: str) -> Optional[Callable]:
+        """
+        Get a tool by name
+        :param name:
+        :return: tool function, None if there is no such tool
+        """
+        return self._discover().get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._discover()
+
+    def __getitem__(self, name: str) -> Callable:
+        return self._discover()[name]
+
+    def tools(self, names: Optional[Iterable[str]] = None) -> List[Dict]:
+        """
+        Get the `tools` argument of chat.completions.create for a selection of tools
+        :param names: Names of the tools to send, None for all of them
+        :return: list of tool schemas, shared between requests so it must not be modified
+        """
+        tools = self._discover()
+        key = tuple(sorted(tools)) if names is None else tuple(sorted(set(names)))
+
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = [tools[name].tool for name in key]
+            self._payloads[key] = payload
+        return payload
+
+
+tool_registry = ToolRegistry()
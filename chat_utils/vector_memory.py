@@ -0,0 +1,350 @@
+import json
+import os
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where panel serve runs a single process
+    fcntl = None
+
+from chat_utils.catalog import get_chat_id
+from chat_utils.embeddings import HashingEmbedder
+from chat_utils.store import get_chat_store
+
+VECTORS_FILE = "memory.f32"
+IDS_FILE = "memory.ids.jsonl"
+LOCK_FILE = "memory.lock"
+
+# Characters of a message kept as its snippet
+SNIPPET_LENGTH = 500
+
+_memories: Dict[str, "VectorMemory"] = {}
+_memories_lock = threading.Lock()
+
+
+class VectorMemory:
+    """
+    Embeddings of the messages of every saved chat, for retrieval across conversations.
+
+    Vectors are rows of a float32 matrix in a memory-mapped file, grown in steps, and the
+    sidecar holds one json line per row with the chat id, the record index and a snippet.
+    Rows of a rewritten chat are dropped with a tombstone line, so both files are only ever
+    appended to. The processes of a node, ex.: `panel serve --num-procs 4`, share the files:
+    a write holds a file lock and first reads the lines the other processes appended, and a
+    search reads them too.
+    """
+
+    def __init__(
+            self,
+            folder: str,
+            embedder: Callable[[List[str]], np.ndarray] = None,
+            growth: int = 4096
+    ):
+        """
+        :param folder: Folder holding the chat files, the memory is stored next to them
+        :param embedder: Callable taking a list of texts and returning unit length rows, defaults to HashingEmbedder
+        :param growth: Minimum number of rows added when the matrix file is full
+        """
+        self.folder = folder
+        self.embedder = embedder or HashingEmbedder()
+        self.growth = growth
+        self.dim = self.embedder(["dim"]).shape[1]
+        self._vectors_path = os.path.join(folder, VECTORS_FILE)
+        self._ids_path = os.path.join(folder, IDS_FILE)
+        self._lock_path = os.path.join(folder, LOCK_FILE)
+        self._lock = threading.Lock()
+
+        self.rows = 0
+        self._snippets: List[Dict] = []
+        self._chat_codes = array('i')
+        self._indexes = array('q')
+        self._alive = array('b')
+        self._chats: Dict[str, int] = {}
+        self._matrix: Optional[np.memmap] = None
+        self._backfill: Optional[threading.Thread] = None
+        # bytes of the sidecar already read into the arrays above
+        self._offset = 0
+        with self._file_lock():
+            self._load()
+
+    @contextmanager
+    def _file_lock(self):
+        # held while the files are written, by one process of the node at a time
+        with open(self._lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _capacity(self) -> int:
+        return os.path.getsize(self._vectors_path) // (4 * self.dim) if os.path.exists(self._vectors_path) else 0
+
+    def _load(self) -> None:
+        lines = []
+        size = 0
+        if os.path.exists(self._ids_path):
+            with open(self._ids_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    lines.append(json.loads(line))
+                    size += len(line)
+
+        # rows of another embedder are useless, start over
+        capacity = self._capacity()
+        if not lines or lines[0].get("dim") != self.dim:
+            lines = [{"dim": self.dim}]
+            with open(self._ids_path, 'w') as f:
+                f.write(json.dumps(lines[0]) + '\n')
+                size = f.tell()
+
+        kept = lines[:1]
+        for line in lines[1:]:
+            if "drop" in line:
+                self._drop_rows(line["drop"])
+            elif self.rows < capacity:
+                self._add_row(line)
+            else:
+                # the vector of this row never reached the matrix file
+                continue
+            kept.append(line)
+        self._offset = size
+        # a torn last line is cut off too, the next write starts on its own line
+        if len(kept) != len(lines) or os.path.getsize(self._ids_path) != size:
+            with open(self._ids_path, 'w') as f:
+                f.write(''.join(json.dumps(line) + '\n' for line in kept))
+                self._offset = f.tell()
+        self._map(max(capacity, self.rows))
+
+    def _catch_up(self) -> None:
+        # read the rows and tombstones other processes appended since the last read, their vectors are
+        # written before their lines
+        if os.path.getsize(self._ids_path) == self._offset:
+            return
+        with open(self._ids_path, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                entry = json.loads(line)
+                if "drop" in entry:
+                    self._drop_rows(entry["drop"])
+                else:
+                    self._add_row(entry)
+                self._offset += len(line)
+        if self._matrix is None or self.rows > self._matrix.shape[0]:
+            self._map(self._capacity())
+
+    def _map(self, capacity: int) -> None:
+        if capacity == 0:
+            self._matrix = None
+            return
+        size = capacity * self.dim * 4
+        with open(self._vectors_path, 'ab') as f:
+            # never shrink, another process may have grown the file further
+            if os.path.getsize(self._vectors_path) < size:
+                f.truncate(size)
+        capacity = self._capacity()
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def _add_row(self, entry: Dict) -> None:
+        code = self._chats.setdefault(entry["chat"], len(self._chats))
+        self._snippets.append(entry)
+        self._chat_codes.append(code)
+        self._indexes.append(entry["index"])
+        self._alive.append(1)
+        self.rows += 1
+
+    def _drop_rows(self, chat_id: str) -> None:
+        code = self._chats.get(chat_id)
+        if code is None:
+            return
+        codes = np.frombuffer(self._chat_codes, dtype=np.int32)
+        alive = np.frombuffer(self._alive, dtype=np.int8)
+        alive[codes == code] = 0
+
+    def __contains__(self, chat_id: str) -> bool:
+        return chat_id in self._chats
+
+    def add(
+            self,
+            chat_id: str,
+            start: int,
+            records: List[Dict],
+            if_missing: bool = False
+    ) -> int:
+        """
+        Embed and store the user and assistant messages of a chat
+        :param chat_id: Chat id, see chat_utils.catalog.get_chat_id
+        :param start: Index of the first record in the chat file
+        :param records: Records to add
+        :param if_missing: Only add them if the memory has no row of the chat, checked under the file lock
+        :return: number of rows added
+        """
+        selected = [
+            (start + offset, record) for offset, record in enumerate(records)
+            if record.get("role") in ("user", "assistant") and isinstance(record.get("content"), str)
+            and record["content"].strip()
+        ]
+        if not selected:
+            return 0
+        entries = [
+            {"chat": chat_id, "index": index, "role": record["role"], "text": record["content"][:SNIPPET_LENGTH]}
+            for index, record in selected
+        ]
+        vectors = self.embedder([record["content"] for _, record in selected])
+
+        with self._lock, self._file_lock():
+            # the next free row is after the rows of the other processes
+            self._catch_up()
+            if if_missing and chat_id in self._chats:
+                # ex.: another process backfilled it meanwhile
+                return 0
+            capacity = 0 if self._matrix is None else self._matrix.shape[0]
+            if self.rows + len(entries) > capacity:
+                if self._matrix is not None:
+                    self._matrix.flush()
+                self._map(max(self.rows + len(entries), capacity + max(self.growth, capacity // 2)))
+            # the vectors are on disk before the sidecar line that makes them count
+            self._matrix[self.rows:self.rows + len(entries)] = vectors
+            self._matrix.flush()
+            with open(self._ids_path, 'a') as f:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+                self._offset = f.tell()
+            for entry in entries:
+                self._add_row(entry)
+        return len(entries)
+
+    def drop(self, chat_id: str) -> None:
+        """
+        Forget the messages of a chat
+        :param chat_id:
+        :return: None
+        """
+        with self._lock, self._file_lock():
+            self._catch_up()
+            if chat_id not in self._chats:
+                return
+            with open(self._ids_path, 'a') as f:
+                f.write(json.dumps({"drop": chat_id}) + '\n')
+                self._offset = f.tell()
+            self._drop_rows(chat_id)
+
+    def search(
+            self,
+            query: str,
+            k: int = 4,
+            min_score: float = 0.3,
+            exclude_chat: str = None,
+            exclude_from: int = 0
+    ) -> List[Dict]:
+        """
+        Find the stored messages most similar to a text
+        :param query: Text to search for
+        :param k: Maximum number of results
+        :param min_score: Minimum cosine similarity of a result
+        :param exclude_chat: Chat whose messages from `exclude_from` on are skipped, ex.: the ones already in the prompt
+        :param exclude_from: Index of the first skipped record of `exclude_chat`
+        :return: List of {"chat", "index", "role", "text", "score"}, best first
+        """
+        vector = self.embedder([query])[0]
+        with self._lock:
+            self._catch_up()
+            rows = self.rows
+            if rows == 0:
+                return []
+            scores = self._matrix[:rows] @ vector
+            usable = np.frombuffer(self._alive, dtype=np.int8)[:rows] == 1
+            if exclude_chat in self._chats:
+                codes = np.frombuffer(self._chat_codes, dtype=np.int32)[:rows]
+                indexes = np.frombuffer(self._indexes, dtype=np.int64)[:rows]
+                usable &= ~((codes == self._chats[exclude_chat]) & (indexes >= exclude_from))
+            usable &= scores >= min_score
+
+            candidates = np.flatnonzero(usable)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [{**self._snippets[row], "score": float(scores[row])} for row in candidates]
+
+    def backfill(self) -> int:
+        """
+        Add the chats of the folder's store that are not in the memory yet, ex.: saved before it existed
+        :return: number of rows added
+        """
+        added = 0
+        store = get_chat_store(self.folder)
+        for chat in store.page(limit=-1):
+            if chat["id"] not in self:
+                added += self.add(chat["id"], 0, store.read(chat["id"], 0, sys.maxsize), if_missing=True)
+        return added
+
+    def start_backfill(self) -> threading.Thread:
+        """
+        Run backfill in a background thread, once per process however many sessions ask for it
+        :return: the thread
+        """
+        with self._lock:
+            if self._backfill is None:
+                self._backfill = threading.Thread(target=self.backfill, daemon=True, name="vector-memory-backfill")
+                self._backfill.start()
+            return self._backfill
+
+    def on_journal_write(
+            self,
+            journal,
+            records: List[Dict],
+            replaced: bool
+    ) -> None:
+        """
+        ChatJournal listener adding the messages of a chat as they are written
+        :param journal:
+        :param records:
+        :param replaced:
+        :return: None
+        """
+        chat_id = get_chat_id(journal.file_path)
+        if replaced:
+            self.drop(chat_id)
+            self.add(chat_id, 0, records)
+        else:
+            self.add(chat_id, journal.count - len(records), records)
+
+
+def format_memories(
+        memories: List[Dict]
+) -> Optional[Dict]:
+    """
+    Get a system message quoting retrieved messages
+    :param memories: Results of VectorMemory.search
+    :return: message, None when there is nothing to quote
+    """
+    if not memories:
+        return None
+    quotes = "\n".join(f"- ({memory['role']}) {memory['text']}" for memory in memories)
+    return {
+        "role": "system",
+        "content": f"Possibly relevant messages from earlier conversations:\n{quotes}"
+    }
+
+
+def get_vector_memory(folder: str) -> VectorMemory:
+    """
+    Get the vector memory of a chats folder, shared by all sessions of the process
+    :param folder:
+    :return: VectorMemory
+    """
+    key = os.path.abspath(folder)
+    with _memories_lock:
+        memory = _memories.get(key)
+        if memory is None:
+            os.makedirs(folder, exist_ok=True)
+            memory = VectorMemory(folder)
+            _memories[key] = memory
+        return memory
@@ -7,7 +7,7 @@ from typing import Any, Dict, Annotated
 from chat_utils.decorators import openai_tool
 
 
-@openai_tool
+@openai_tool(cache_ttl=60, cache_size=256)
 def get_product_details(
         product_id: Annotated[str, "Product ID, ex.: 'SKU-12345'"]
 ) -> Annotated[str, "Get product details for the given product_id and return in JSON format"]:
@@ -20,7 +20,7 @@ def get_product_details(
     })
 
 
-@openai_tool
+@openai_tool(side_effects=True)
 def send_email(
         email: Annotated[str, "Recipient email address"],
         subject: Annotated[str, "Email subject"],
@@ -34,7 +34,7 @@ def send_email(
     }
 
 
-@openai_tool
+@openai_tool(cache_ttl=300, cache_size=256)
 def get_current_weather(
         location: Annotated[str, "Location name"]
 ) -> Annotated[str, "Get current weather details for the given location in JSON format"]: